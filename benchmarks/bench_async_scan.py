@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+Time the scan phases (plates_by_run and find_analysis_dirs) at several
+values of scan_concurrency, against a synthetic tree on a local filesystem
+that stands in for a network mount by adding a fixed latency to every
+stat, listdir, scandir and open.
+
+    python benchmarks/bench_async_scan.py --num-runs 200 --latency-ms 2 --concurrency 1,4,16,64
+"""
+
+import argparse
+import builtins
+import contextlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# The benchmarks dir, for the modules shared between benchmarks, and the
+# repository root, so that the benchmarks can be run without installing the
+# package.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import generate_fixtures
+
+import covid_qc_collector.config
+import covid_qc_collector.core as core
+
+DELAYED_FUNCTIONS = [
+    (os, 'stat'),
+    (os, 'lstat'),
+    (os, 'listdir'),
+    (os, 'scandir'),
+    (builtins, 'open'),
+]
+
+
+@contextlib.contextmanager
+def inject_latency(latency_seconds):
+    """
+    Sleep before every filesystem call that the collector makes. Higher-level
+    functions like os.path.isdir and glob.glob are delayed via the calls they make.
+    """
+    originals = {}
+    for module, name in DELAYED_FUNCTIONS:
+        original = getattr(module, name)
+        originals[(module, name)] = original
+
+        def delayed(*args, _original=original, **kwargs):
+            time.sleep(latency_seconds)
+            return _original(*args, **kwargs)
+
+        setattr(module, name, delayed)
+    try:
+        yield
+    finally:
+        for (module, name), original in originals.items():
+            setattr(module, name, original)
+
+
+def run_phases(config, latency_seconds):
+    """
+    Run each scan phase from a cold start (no state from previous scans).
+
+    :return: Duration of each phase, and its output.
+    :rtype: dict[str, tuple[float, object]]
+    """
+    if os.path.exists(config['state_dir']):
+        shutil.rmtree(config['state_dir'])
+    os.makedirs(config['state_dir'])
+    results = {}
+    with inject_latency(latency_seconds):
+        start = time.perf_counter()
+        plates_by_run = core.plates_by_run(config)
+        results['plates_by_run'] = (time.perf_counter() - start, plates_by_run)
+        start = time.perf_counter()
+        run_ids = [os.path.basename(run['path']) for run in core.find_analysis_dirs(config, scan_state=core.load_scan_state(config)) if run is not None]
+        results['find_analysis_dirs'] = (time.perf_counter() - start, run_ids)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-runs', type=int, default=200)
+    parser.add_argument('--latency-ms', type=float, default=2.0, help="Latency added to each filesystem call")
+    parser.add_argument('--concurrency', default='1,4,16,64', help="Comma-separated scan_concurrency values")
+    parser.add_argument('--workdir', help="Directory to generate fixtures in (default: a temporary dir)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+
+    workdir = args.workdir or tempfile.mkdtemp()
+    config_path = generate_fixtures.generate_fixture_tree(os.path.join(workdir, 'fixtures'), args.num_runs)
+    config = covid_qc_collector.config.load_config(config_path)
+    config['state_dir'] = os.path.join(workdir, 'state')
+    core.create_output_dirs(config)
+
+    baseline = None
+    for scan_concurrency in [int(c) for c in args.concurrency.split(',')]:
+        config['scan_concurrency'] = scan_concurrency
+        results = run_phases(config, args.latency_ms / 1000)
+        outputs = {phase: output for phase, (_, output) in results.items()}
+        if baseline is None:
+            baseline = results
+        for phase, (seconds, output) in results.items():
+            print(json.dumps({
+                "num_runs": args.num_runs,
+                "latency_ms": args.latency_ms,
+                "scan_concurrency": scan_concurrency,
+                "phase": phase,
+                "seconds": round(seconds, 4),
+                "speedup": round(baseline[phase][0] / seconds, 2),
+                # Results must be the same, however many calls are in flight
+                "same_result": output == baseline[phase][1],
+            }), flush=True)
+        if any(output != baseline[phase][1] for phase, output in outputs.items()):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
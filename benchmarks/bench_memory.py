@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Measure the peak memory (with tracemalloc) of holding one run's parsed QC
+rows, as compact parsed records, compared against the OrderedDict per row
+that the parsers used to produce, and of streaming them to an output file.
+
+    python benchmarks/bench_memory.py --libraries 384 --amplicons 98
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+
+# The benchmarks dir, for the modules shared between benchmarks, and the
+# repository root, so that the benchmarks can be run without installing the
+# package.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bench_parsers
+
+import covid_qc_collector.parsers as parsers
+import covid_qc_collector.writers as writers
+
+
+def parse_run(summary_qc_path, amplicon_depth_paths, as_ordered_dicts):
+    """
+    Parse every QC file in a run, holding all of the records at once.
+
+    :return: Parsed records, by file
+    :rtype: list[list[Mapping[str, object]]]
+    """
+    if as_ordered_dicts:
+        parse = lambda records: [collections.OrderedDict(record) for record in records]
+    else:
+        parse = list
+    run_records = [parse(parsers.iter_ncov_tools_summary_qc(summary_qc_path))]
+    for amplicon_depth_path in amplicon_depth_paths:
+        run_records.append(parse(parsers.iter_amplicon_depth_bed(amplicon_depth_path)))
+
+    return run_records
+
+
+def stream_run(summary_qc_path, amplicon_depth_paths, output_dir):
+    """
+    Write every QC file in a run, as collection does, one record at a time.
+    """
+    writers.write_records(parsers.iter_ncov_tools_summary_qc(summary_qc_path), os.path.join(output_dir, 'summary_qc.json'))
+    for amplicon_depth_path in amplicon_depth_paths:
+        writers.write_records(parsers.iter_amplicon_depth_bed(amplicon_depth_path), os.path.join(output_dir, 'amplicon_depth.json'))
+
+
+def measure_peak(fn, *args):
+    """
+    :return: Peak memory allocated while calling `fn`, in bytes
+    :rtype: int
+    """
+    tracemalloc.start()
+    result = fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--libraries', type=int, default=384, help="Number of libraries in the run (96 per plate)")
+    parser.add_argument('--amplicons', type=int, default=98, help="Number of amplicons per library")
+    args = parser.parse_args()
+
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        summary_qc_path = os.path.join(tmpdir, 'summary_qc.tsv')
+        bench_parsers.write_summary_qc(summary_qc_path, args.libraries)
+        amplicon_depth_paths = []
+        for library_num in range(args.libraries):
+            amplicon_depth_path = os.path.join(tmpdir, 'library_%d.amplicon_depth.bed' % library_num)
+            bench_parsers.write_amplicon_depth_bed(amplicon_depth_path, args.amplicons)
+            amplicon_depth_paths.append(amplicon_depth_path)
+
+        # Parse once first, so that the compiled schemas and interned field
+        # names aren't counted against whichever is measured first.
+        parse_run(summary_qc_path, amplicon_depth_paths, as_ordered_dicts=False)
+
+        before_peak = measure_peak(parse_run, summary_qc_path, amplicon_depth_paths, True)
+        after_peak = measure_peak(parse_run, summary_qc_path, amplicon_depth_paths, False)
+        streaming_peak = measure_peak(stream_run, summary_qc_path, amplicon_depth_paths, tmpdir)
+
+    rows = args.libraries * (args.amplicons + 1)
+    print(json.dumps({
+        "libraries": args.libraries,
+        "rows": rows,
+        "before_peak_bytes": before_peak,
+        "after_peak_bytes": after_peak,
+        "streaming_peak_bytes": streaming_peak,
+        "before_bytes_per_row": round(before_peak / rows),
+        "after_bytes_per_row": round(after_peak / rows),
+        "reduction": round(before_peak / after_peak, 2),
+    }))
+
+
+if __name__ == '__main__':
+    main()
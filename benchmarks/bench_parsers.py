@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""
+Compare the throughput of the schema-driven QC parsers against the
+previous DictReader-based implementation, on large synthetic files.
+
+    python benchmarks/bench_parsers.py --rows 200000
+"""
+
+import argparse
+import collections
+import csv
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+# The repository root, so that the benchmark can be run without installing the package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import covid_qc_collector.parsers as parsers
+
+NCOV_TOOLS_SUMMARY_QC_COLUMNS = [
+    "sample", "run_name", "num_consensus_snvs", "num_consensus_n", "num_consensus_iupac",
+    "num_variants_snvs", "num_variants_indel", "num_variants_indel_triplet", "mean_sequencing_depth",
+    "median_sequencing_depth", "qpcr_ct", "collection_date", "num_weeks", "scaled_variants_snvs",
+    "genome_completeness", "qc_pass", "lineage", "lineage_notes", "watch_mutations",
+]
+
+AMPLICON_DEPTH_BED_COLUMNS = [
+    'reference_name', 'start', 'end', 'amplicon_id', 'pool', 'strand', 'mean_depth',
+]
+
+
+def legacy_parse_ncov_tools_summary_qc(ncov_tools_summary_qc_path):
+    """
+    The DictReader-based parser that `parsers.parse_ncov_tools_summary_qc` replaced.
+    """
+    output = []
+    all_input_fields = NCOV_TOOLS_SUMMARY_QC_COLUMNS
+    int_fields = [
+        'num_consensus_snvs', 'num_consensus_n', 'num_consensus_iupac', 'num_variants_snvs',
+        'num_variants_indel', 'num_variants_indel_triplet', 'median_sequencing_depth', 'num_weeks',
+    ]
+    float_fields = [
+        'mean_sequencing_depth', 'qpcr_ct', 'scaled_variants_snvs', 'genome_completeness',
+    ]
+    with open(ncov_tools_summary_qc_path, 'r') as f:
+        reader = csv.DictReader(f, dialect='excel-tab')
+        for row in reader:
+            qc = collections.OrderedDict()
+            for field in all_input_fields:
+                if row[field] == 'NA':
+                    qc[field] = None
+                elif field in int_fields:
+                    try:
+                        qc[field] = int(row[field])
+                    except ValueError as e:
+                        qc[field] = None
+                elif field in float_fields:
+                    try:
+                        qc[field] = float(row[field])
+                    except ValueError as e:
+                        qc[field] = None
+                elif field == 'sample':
+                    qc['library_id'] = row[field]
+                elif field == 'run_name':
+                    qc['plate_id'] = int(row[field].split('_')[-1])
+                    qc['run_id'] = '_'.join(row[field].split('_')[0:-1])
+                elif field == 'qc_pass':
+                    qc[field] = row[field].split(',')
+                else:
+                    qc[field] = row[field]
+            output.append(qc)
+
+    return output
+
+
+def legacy_parse_amplicon_depth_bed(amplicon_depth_bed_path):
+    """
+    The DictReader-based parser that `parsers.parse_amplicon_depth_bed` replaced.
+    """
+    output = []
+    all_input_fields = AMPLICON_DEPTH_BED_COLUMNS
+    int_fields = ['start', 'end', 'pool']
+    float_fields = ['mean_depth']
+    with open(amplicon_depth_bed_path, 'r') as f:
+        reader = csv.DictReader(f, dialect='excel-tab')
+        for row in reader:
+            amplicon = collections.OrderedDict()
+            for field in all_input_fields:
+                if row[field] == 'NA':
+                    amplicon[field] = None
+                elif field in int_fields:
+                    try:
+                        amplicon[field] = int(row[field])
+                    except ValueError as e:
+                        amplicon[field] = None
+                elif field in float_fields:
+                    try:
+                        amplicon[field] = float(row[field])
+                    except ValueError as e:
+                        amplicon[field] = None
+                elif field == 'reference_name':
+                    pass
+                elif field == 'amplicon_id':
+                    try:
+                        amplicon['amplicon_num'] = int(row[field].split('_')[-1])
+                    except ValueError as e:
+                        amplicon['amplicon_num'] = None
+                else:
+                    amplicon[field] = row[field]
+            output.append(amplicon)
+
+    return output
+
+
+def write_summary_qc(path, num_rows):
+    """
+    """
+    run_id = '220101_VH00123_1_AAAAAAAAA'
+    with open(path, 'w') as f:
+        f.write('\t'.join(NCOV_TOOLS_SUMMARY_QC_COLUMNS) + '\n')
+        for i in range(num_rows):
+            plate_number = i // 96 + 1
+            f.write('\t'.join([
+                'E%010d-%d-A-A%02d' % (i, plate_number, i % 96 + 1),
+                run_id + '_' + str(plate_number),
+                str(random.randint(0, 60)), str(random.randint(0, 3000)), str(random.randint(0, 5)),
+                str(random.randint(0, 60)), str(random.randint(0, 5)), str(random.randint(0, 3)),
+                '%.2f' % random.uniform(0, 3000), str(random.randint(0, 3000)),
+                random.choice(['NA', '%.1f' % random.uniform(15, 35)]),
+                '2022-01-01', str(random.randint(0, 10)), '%.3f' % random.uniform(0, 2),
+                '%.4f' % random.random(),
+                random.choice(['PASS', 'INCOMPLETE_GENOME', 'POSSIBLE_FRAMESHIFT_INDELS,EXCESS_AMBIGUITY']),
+                random.choice(['BA.1', 'BA.2', 'BA.5.2', 'None']),
+                'scorpio call', '',
+            ]) + '\n')
+
+
+def write_amplicon_depth_bed(path, num_rows):
+    """
+    """
+    with open(path, 'w') as f:
+        f.write('\t'.join(AMPLICON_DEPTH_BED_COLUMNS) + '\n')
+        for i in range(num_rows):
+            amplicon_num = i % 98 + 1
+            f.write('MN908947.3\t%d\t%d\tnCoV-2019_%d\t%d\t+\t%.2f\n' % (amplicon_num * 300, amplicon_num * 300 + 250, amplicon_num, amplicon_num % 2 + 1, random.uniform(0, 2000)))
+
+
+def time_parser(parse, path, repeats):
+    """
+    Best time (in seconds) over `repeats` runs, and the parsed output.
+    """
+    best = None
+    output = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = parse(path)
+        duration = time.perf_counter() - start
+        if best is None or duration < best:
+            best = duration
+
+    return best, output
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100000, help="Number of rows in each synthetic file")
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    random.seed(0)
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        summary_qc_path = os.path.join(tmpdir, 'summary_qc.tsv')
+        write_summary_qc(summary_qc_path, args.rows)
+        amplicon_depth_bed_path = os.path.join(tmpdir, 'amplicon_depth.bed')
+        write_amplicon_depth_bed(amplicon_depth_bed_path, args.rows)
+
+        benchmarks = [
+            ('ncov_tools_summary_qc', summary_qc_path, legacy_parse_ncov_tools_summary_qc, parsers.parse_ncov_tools_summary_qc),
+            ('amplicon_depth_bed', amplicon_depth_bed_path, legacy_parse_amplicon_depth_bed, parsers.parse_amplicon_depth_bed),
+        ]
+        for name, path, before, after in benchmarks:
+            before_seconds, before_output = time_parser(before, path, args.repeats)
+            after_seconds, after_output = time_parser(after, path, args.repeats)
+            if json.dumps(before_output) != json.dumps([record.to_dict() for record in after_output]):
+                raise AssertionError("Parser output differs for " + name)
+            results.append({
+                "format": name,
+                "rows": args.rows,
+                "before_rows_per_second": round(args.rows / before_seconds),
+                "after_rows_per_second": round(args.rows / after_seconds),
+                "speedup": round(before_seconds / after_seconds, 2),
+            })
+
+    for result in results:
+        print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+"""
+Time the scan and collect phases of the collector against synthetic
+trees of increasing size, counting filesystem calls and peak memory
+for each phase. Everything runs offline, against a local temporary dir.
+
+    python benchmarks/bench_scan.py --sizes 100,1000,10000
+"""
+
+import argparse
+import builtins
+import contextlib
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# The benchmarks dir, for the modules shared between benchmarks, and the
+# repository root, so that the benchmarks can be run without installing the
+# package.
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import generate_fixtures
+
+import covid_qc_collector.config
+import covid_qc_collector.core as core
+import covid_qc_collector.metrics as metrics
+import covid_qc_collector.output_index as output_index
+import covid_qc_collector.rollups as rollups
+import covid_qc_collector.samplesheet as samplesheet
+
+COUNTED_FUNCTIONS = [
+    (os, 'stat'),
+    (os, 'lstat'),
+    (os, 'listdir'),
+    (os, 'scandir'),
+    (builtins, 'open'),
+]
+
+
+@contextlib.contextmanager
+def count_filesystem_calls(counts):
+    """
+    Count calls to the filesystem functions that the collector uses. Higher-level
+    functions like os.path.exists and glob.glob are counted via the calls they make.
+    """
+    originals = {}
+    for module, name in COUNTED_FUNCTIONS:
+        original = getattr(module, name)
+        originals[(module, name)] = original
+        counts[name] = 0
+
+        def counted(*args, _original=original, _name=name, **kwargs):
+            counts[_name] += 1
+            return _original(*args, **kwargs)
+
+        setattr(module, name, counted)
+    try:
+        yield counts
+    finally:
+        for (module, name), original in originals.items():
+            setattr(module, name, original)
+
+
+def run_phase(results, num_runs, phase, fn, trace_memory):
+    """
+    Run a single phase, recording its duration, filesystem calls and peak memory.
+    """
+    counts = {}
+    metrics.end_scan(0.0)
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with count_filesystem_calls(counts):
+        output = fn()
+    duration_seconds = time.perf_counter() - start
+    result = {
+        "num_runs": num_runs,
+        "phase": phase,
+        "seconds": round(duration_seconds, 4),
+        "filesystem_calls": counts,
+        "collector_counters": metrics.end_scan(duration_seconds)['counters'],
+    }
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["peak_traced_memory_bytes"] = peak
+    result["max_rss_kilobytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps(result), flush=True)
+    results.append(result)
+
+    return output
+
+
+def benchmark(num_runs, workdir, args):
+    """
+    """
+    fixture_dir = os.path.join(workdir, 'runs-' + str(num_runs))
+    generation_start = time.perf_counter()
+    config_path = generate_fixtures.generate_fixture_tree(
+        fixture_dir,
+        num_runs,
+        plates_per_run=args.plates_per_run,
+        libraries_per_plate=args.libraries_per_plate,
+    )
+    logging.warning(json.dumps({"event_type": "fixture_generated", "num_runs": num_runs, "seconds": round(time.perf_counter() - generation_start, 2)}))
+    config = covid_qc_collector.config.load_config(config_path)
+    core.create_output_dirs(config)
+
+    results = []
+    trace_memory = not args.no_trace_memory
+    run_ids = sorted(os.listdir(config['analysis_by_run_dir']))
+
+    sequencer_run_index = run_phase(results, num_runs, 'index_sequencer_output_dirs', lambda: samplesheet.index_sequencer_output_dirs(config['sequencer_output_dirs']), trace_memory)
+    run_phase(results, num_runs, 'find_samplesheet_for_run', lambda: [samplesheet.find_samplesheet_for_run(run_id, config['sequencer_output_dirs'], sequencer_run_index) for run_id in run_ids], trace_memory)
+    run_phase(results, num_runs, 'plates_by_run_cold', lambda: core.plates_by_run(config), trace_memory)
+    run_phase(results, num_runs, 'plates_by_run_warm', lambda: core.plates_by_run(config, sequencer_run_index), trace_memory)
+
+    scan_state = core.load_scan_state(config)
+    ready_runs = run_phase(results, num_runs, 'find_analysis_dirs_cold', lambda: [run for run in core.find_analysis_dirs(config, scan_state=scan_state) if run is not None], trace_memory)
+    if args.collect_runs is not None:
+        ready_runs = ready_runs[:args.collect_runs]
+
+    # As in the collector itself, each scan gets a new index of existing outputs
+    def collect_all():
+        existing_outputs = output_index.new_output_index()
+        for run in ready_runs:
+            core.collect_outputs(config, run, existing_outputs)
+            core.mark_run_collected(config, scan_state, run)
+        rollups.save_rollup_index(config)
+
+    def recollect_all():
+        existing_outputs = output_index.new_output_index()
+        for run in ready_runs:
+            core.collect_outputs(config, run, existing_outputs)
+        rollups.save_rollup_index(config)
+
+    run_phase(results, num_runs, 'collect_outputs_cold', collect_all, trace_memory)
+    run_phase(results, num_runs, 'collect_outputs_warm', recollect_all, trace_memory)
+    run_phase(results, num_runs, 'find_analysis_dirs_warm', lambda: [run for run in core.find_analysis_dirs(config, scan_state=scan_state) if run is not None], trace_memory)
+
+    if not args.keep_fixtures:
+        shutil.rmtree(fixture_dir)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='100,1000,10000', help="Comma-separated numbers of runs to benchmark (default: 100,1000,10000)")
+    parser.add_argument('--plates-per-run', type=int, default=2)
+    parser.add_argument('--libraries-per-plate', type=int, default=8)
+    parser.add_argument('--collect-runs', type=int, help="Only collect this many runs in the collect phases")
+    parser.add_argument('--workdir', help="Directory to generate fixtures in (default: a temporary dir)")
+    parser.add_argument('--keep-fixtures', action='store_true', help="Keep the generated fixtures (only useful with --workdir)")
+    parser.add_argument('--no-trace-memory', action='store_true', help="Skip tracemalloc, which slows down every phase")
+    args = parser.parse_args()
+
+    # Only warnings and above, so that log output doesn't dominate the timings
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    if args.workdir:
+        os.makedirs(args.workdir, exist_ok=True)
+        for num_runs in sizes:
+            benchmark(num_runs, args.workdir, args)
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            for num_runs in sizes:
+                benchmark(num_runs, workdir, args)
+
+
+if __name__ == '__main__':
+    main()
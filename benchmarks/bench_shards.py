@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""
+Run several collector instances as local processes, sharing a synthetic
+analysis_by_run_dir and output_dir, and check that every ready run is
+collected, and that no run is collected by two instances at once. With
+--kill-shard, one instance is killed as soon as it starts, and the others
+are expected to adopt its shard once its heartbeat times out.
+
+    python benchmarks/bench_shards.py --num-runs 200 --num-shards 3 --kill-shard 1
+"""
+
+import argparse
+import collections
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+# The benchmarks dir, for the modules shared between benchmarks, and the
+# repository root, so that the benchmarks can be run without installing the
+# package.
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import generate_fixtures
+
+import covid_qc_collector.config
+import covid_qc_collector.core as core
+
+
+def parse_collect_events(log_path):
+    """
+    :return: (event_type, run_id, timestamp) for each collect_outputs_start and collect_outputs_complete event in the log.
+    :rtype: list[tuple[str, str, str]]
+    """
+    events = []
+    with open(log_path, 'r') as f:
+        for line in f:
+            if '"collect_outputs_' not in line:
+                continue
+            # The log format isn't quite JSON, so the message is picked out by position
+            message = json.loads(line[line.index('"message": ') + len('"message": '):-2])
+            timestamp = line.split('"timestamp": "')[1].split('"')[0]
+            events.append((message['event_type'], message['run_id'], timestamp))
+
+    return events
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-runs', type=int, default=200)
+    parser.add_argument('--num-shards', type=int, default=3)
+    parser.add_argument('--shard-by', default='hash')
+    parser.add_argument('--workers', type=int, default=1, help="--workers for each instance")
+    parser.add_argument('--kill-shard', type=int, help="Kill the instance for this shard as soon as it starts")
+    parser.add_argument('--heartbeat-timeout', type=float, default=5.0)
+    parser.add_argument('--timeout', type=float, default=600.0)
+    parser.add_argument('--workdir', help="Directory to generate fixtures in (default: a temporary dir)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+
+    workdir = args.workdir or tempfile.mkdtemp()
+    config_path = generate_fixtures.generate_fixture_tree(os.path.join(workdir, 'fixtures'), args.num_runs)
+    config = covid_qc_collector.config.load_config(config_path)
+    expected_run_ids = set(os.path.basename(run['path']) for run in core.find_analysis_dirs(config) if run is not None)
+
+    processes = []
+    log_paths = []
+    # The collector is run from this repository, whether or not it's installed
+    collector_env = dict(os.environ)
+    collector_env['PYTHONPATH'] = os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get('PYTHONPATH')]))
+    for shard_index in range(args.num_shards):
+        shard_config = dict(config)
+        shard_config.pop('excluded_runs')
+        shard_config.pop('excluded_run_patterns')
+        shard_config.pop('priority_runs')
+        shard_config.update({
+            "num_shards": args.num_shards,
+            "shard_index": shard_index,
+            "shard_by": args.shard_by,
+            "shard_heartbeat_timeout_seconds": args.heartbeat_timeout,
+            "lease_duration_seconds": args.heartbeat_timeout,
+            # Short enough that a killed instance's shard is rescanned promptly
+            "scan_interval_seconds": args.heartbeat_timeout / 2,
+        })
+        shard_config_path = os.path.join(workdir, 'config-shard-' + str(shard_index) + '.json')
+        with open(shard_config_path, 'w') as f:
+            json.dump(shard_config, f, indent=2)
+        log_path = os.path.join(workdir, 'shard-' + str(shard_index) + '.log')
+        log_paths.append(log_path)
+        with open(log_path, 'w') as log_file:
+            process = subprocess.Popen(
+                [sys.executable, '-m', 'covid_qc_collector', '--config', shard_config_path, '--workers', str(args.workers)],
+                stderr=log_file,
+                env=collector_env,
+            )
+        processes.append(process)
+        if shard_index == args.kill_shard:
+            # Give it just long enough to write its first heartbeat
+            time.sleep(0.5)
+            process.kill()
+
+    start = time.perf_counter()
+    collected_run_ids = set()
+    while time.perf_counter() - start < args.timeout:
+        collected_run_ids = set()
+        for log_path in log_paths:
+            collected_run_ids.update(run_id for event_type, run_id, _ in parse_collect_events(log_path) if event_type == 'collect_outputs_complete')
+        if expected_run_ids <= collected_run_ids:
+            break
+        time.sleep(0.5)
+    duration_seconds = time.perf_counter() - start
+
+    for process in processes:
+        if process.poll() is None:
+            process.send_signal(signal.SIGTERM)
+            process.wait()
+
+    # A run may be collected by more than one instance (eg. after its shard is
+    # adopted), but never by two instances at the same time.
+    collections_by_run_id = collections.defaultdict(list)
+    for shard_index, log_path in enumerate(log_paths):
+        starts = {}
+        for event_type, run_id, timestamp in parse_collect_events(log_path):
+            if event_type == 'collect_outputs_start':
+                starts[run_id] = timestamp
+            else:
+                collections_by_run_id[run_id].append((starts.pop(run_id), timestamp, shard_index))
+    overlapping_run_ids = []
+    for run_id, run_collections in collections_by_run_id.items():
+        run_collections.sort()
+        for previous, current in zip(run_collections, run_collections[1:]):
+            if current[0] < previous[1]:
+                overlapping_run_ids.append(run_id)
+
+    result = {
+        "num_runs": args.num_runs,
+        "num_shards": args.num_shards,
+        "killed_shard": args.kill_shard,
+        "seconds": round(duration_seconds, 2),
+        "num_expected_runs": len(expected_run_ids),
+        "num_collected_runs": len(expected_run_ids & collected_run_ids),
+        "num_runs_collected_more_than_once": sum(1 for c in collections_by_run_id.values() if len(c) > 1),
+        "num_runs_collected_concurrently": len(overlapping_run_ids),
+        "runs_collected_by_shard": collections.Counter(c[2] for cs in collections_by_run_id.values() for c in cs),
+        "workdir": workdir,
+    }
+    print(json.dumps(result))
+
+    if not expected_run_ids <= collected_run_ids or overlapping_run_ids:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+"""
+Generate a synthetic tree of sequencer outputs, FASTQ symlinks and
+analysis outputs, laid out the way the collector expects to find them,
+along with a config file that points at it.
+
+    python benchmarks/generate_fixtures.py --num-runs 1000 --outdir /tmp/covid-qc-fixtures
+"""
+
+import argparse
+import json
+import os
+import random
+
+NCOV_TOOLS_SUMMARY_QC_COLUMNS = [
+    "sample", "run_name", "num_consensus_snvs", "num_consensus_n", "num_consensus_iupac",
+    "num_variants_snvs", "num_variants_indel", "num_variants_indel_triplet", "mean_sequencing_depth",
+    "median_sequencing_depth", "qpcr_ct", "collection_date", "num_weeks", "scaled_variants_snvs",
+    "genome_completeness", "qc_pass", "lineage", "lineage_notes", "watch_mutations",
+]
+
+ARTIC_QC_COLUMNS = [
+    "sample_name", "pct_N_bases", "pct_covered_bases", "longest_no_N_run",
+    "num_aligned_reads", "fasta", "bam", "qc_pass",
+]
+
+ARTIC_VERSION = '1.3'
+NCOV_TOOLS_VERSION = '1.9'
+NUM_AMPLICONS = 98
+
+
+def get_run_id(run_num, sequencer_type):
+    """
+    A run ID in the MiSeq or NextSeq format, with a run date that increases with `run_num`.
+    """
+    year = 20 + (run_num // 3000) % 10
+    month = (run_num // 250) % 12 + 1
+    day = (run_num // 9) % 28 + 1
+    if sequencer_type == 'miseq':
+        run_id = '%02d%02d%02d_M%05d_%d_000000000-%s' % (year, month, day, 1000 + run_num % 3, run_num, 'A%04X' % (run_num % 65536))
+    else:
+        run_id = '%02d%02d%02d_VH%05d_%d_%s' % (year, month, day, 100 + run_num % 2, run_num, 'AAA%06X' % run_num)
+
+    return run_id
+
+
+def get_library_ids(plate_num, num_libraries):
+    """
+    """
+    library_ids = []
+    for library_num in range(num_libraries):
+        container_id = 'E%010d' % random.randint(0, 9999999999)
+        well = 'ABCDEFGH'[library_num // 12 % 8] + '%02d' % (library_num % 12 + 1)
+        library_ids.append('%s-%d-A-%s' % (container_id, plate_num, well))
+    library_ids.append('POS%d-%d-A-H11' % (plate_num, plate_num))
+    library_ids.append('NEG%d-%d-A-H12' % (plate_num, plate_num))
+
+    return library_ids
+
+
+def write_samplesheet(sequencer_run_dir, sequencer_type, library_ids, layout):
+    """
+    MiSeq runs alternate between 'old-style' (SampleSheet.csv in the run dir) and
+    'new-style' (Alignment_1/<timestamp>/SampleSheetUsed.csv) layouts.
+    """
+    if sequencer_type == 'miseq':
+        if layout == 'new':
+            samplesheet_dir = os.path.join(sequencer_run_dir, 'Alignment_1', '20220101_120000')
+            samplesheet_path = os.path.join(samplesheet_dir, 'SampleSheetUsed.csv')
+        else:
+            samplesheet_dir = sequencer_run_dir
+            samplesheet_path = os.path.join(samplesheet_dir, 'SampleSheet.csv')
+        os.makedirs(samplesheet_dir, exist_ok=True)
+        with open(samplesheet_path, 'w') as f:
+            f.write('[Header]\nIEMFileVersion,4\nInvestigator Name,bench\n\n[Reads]\n151\n151\n\n[Data]\n')
+            f.write('Sample_ID,Sample_Name,Sample_Plate,Sample_Well,Index_Plate_Well,I7_Index_ID,index,I5_Index_ID,index2,Sample_Project,Description\n')
+            for sample_num, library_id in enumerate(library_ids, 1):
+                f.write('S%d,%s,,,,N701,ACGTACGT,S502,TGCATGCA,,\n' % (sample_num, library_id))
+    else:
+        samplesheet_dir = os.path.join(sequencer_run_dir, 'Analysis', '1', 'Data')
+        os.makedirs(samplesheet_dir, exist_ok=True)
+        with open(os.path.join(samplesheet_dir, 'SampleSheet.csv'), 'w') as f:
+            f.write('[Header]\nFileFormatVersion,2\nRunName,bench\n\n[BCLConvert_Data]\nSample_ID,Index,Index2\n')
+            for library_id in library_ids:
+                f.write('%s,ACGTACGT,TGCATGCA\n' % library_id)
+            f.write('\n[Cloud_Data]\nSample_ID,ProjectName,LibraryName\n')
+            for library_id in library_ids:
+                f.write('%s,covid-19_production,%s\n' % (library_id, library_id))
+
+
+def write_fastq_symlinks(fastq_input_run_dir, fastq_target, library_ids):
+    """
+    """
+    os.makedirs(fastq_input_run_dir, exist_ok=True)
+    for library_id in library_ids:
+        for read_num in (1, 2):
+            os.symlink(fastq_target, os.path.join(fastq_input_run_dir, '%s_R%d.fastq.gz' % (library_id, read_num)))
+    for read_num in (1, 2):
+        os.symlink(fastq_target, os.path.join(fastq_input_run_dir, 'Undetermined_R%d.fastq.gz' % read_num))
+
+
+def write_plate_outputs(plate_dir, run_id, plate_num, library_ids, plot_size):
+    """
+    """
+    for subdir in ['plots', 'qc_reports', 'qc_sequencing']:
+        os.makedirs(os.path.join(plate_dir, subdir), exist_ok=True)
+
+    for plot_suffix in ['_depth_by_position.pdf', '_amplicon_coverage_heatmap.pdf', '_tree_snps.pdf']:
+        with open(os.path.join(plate_dir, 'plots', run_id + '_' + str(plate_num) + plot_suffix), 'wb') as f:
+            f.write(os.urandom(plot_size))
+
+    with open(os.path.join(plate_dir, 'qc_reports', run_id + '_' + str(plate_num) + '_summary_qc.tsv'), 'w') as f:
+        f.write('\t'.join(NCOV_TOOLS_SUMMARY_QC_COLUMNS) + '\n')
+        for library_id in library_ids:
+            f.write('\t'.join([
+                library_id, run_id + '_' + str(plate_num),
+                str(random.randint(0, 60)), str(random.randint(0, 3000)), str(random.randint(0, 5)),
+                str(random.randint(0, 60)), str(random.randint(0, 5)), str(random.randint(0, 3)),
+                '%.2f' % random.uniform(0, 3000), str(random.randint(0, 3000)),
+                random.choice(['NA', '%.1f' % random.uniform(15, 35)]),
+                '2022-01-01', str(random.randint(0, 10)), '%.3f' % random.uniform(0, 2),
+                '%.4f' % random.random(),
+                random.choice(['PASS', 'INCOMPLETE_GENOME', 'POSSIBLE_FRAMESHIFT_INDELS,EXCESS_AMBIGUITY']),
+                random.choice(['BA.1', 'BA.2', 'BA.5.2', 'None']),
+                'scorpio call', '',
+            ]) + '\n')
+
+    for library_id in library_ids:
+        with open(os.path.join(plate_dir, 'qc_sequencing', library_id + '.amplicon_depth.bed'), 'w') as f:
+            f.write('reference_name\tstart\tend\tamplicon_id\tpool\tstrand\tmean_depth\n')
+            for amplicon_num in range(1, NUM_AMPLICONS + 1):
+                f.write('MN908947.3\t%d\t%d\tnCoV-2019_%d\t%d\t+\t%.2f\n' % (
+                    amplicon_num * 300, amplicon_num * 300 + 250, amplicon_num, 2 - amplicon_num % 2, random.uniform(0, 3000)
+                ))
+
+
+def write_analysis_outputs(analysis_run_dir, run_id, plates, plot_size, complete):
+    """
+    """
+    artic_output_dir = os.path.join(analysis_run_dir, 'ncov2019-artic-nf-v' + ARTIC_VERSION + '-output')
+    os.makedirs(artic_output_dir, exist_ok=True)
+    with open(os.path.join(artic_output_dir, run_id + '.qc.csv'), 'w') as f:
+        f.write(','.join(ARTIC_QC_COLUMNS) + '\n')
+        for plate_num, library_ids in plates.items():
+            for library_id in library_ids:
+                f.write('%s,%.2f,%.2f,%d,%d,%s.fa,%s.bam,%s\n' % (
+                    library_id, random.uniform(0, 100), random.uniform(0, 100), random.randint(0, 29903),
+                    random.randint(0, 2000000), library_id, library_id, random.choice(['TRUE', 'FALSE'])
+                ))
+
+    ncov_tools_output_dir = os.path.join(artic_output_dir, 'ncov-tools-v' + NCOV_TOOLS_VERSION + '-output')
+    for plate_num, library_ids in plates.items():
+        plate_dir = os.path.join(ncov_tools_output_dir, 'by_plate', str(plate_num))
+        write_plate_outputs(plate_dir, run_id, plate_num, library_ids, plot_size)
+
+    if complete:
+        for output_dir in [artic_output_dir, ncov_tools_output_dir]:
+            with open(os.path.join(output_dir, 'analysis_complete.json'), 'w') as f:
+                json.dump({"analysis_complete": True}, f)
+
+
+def generate_fixture_tree(outdir, num_runs, plates_per_run=2, libraries_per_plate=8, plot_size=4096, fraction_incomplete=0.05, seed=0):
+    """
+    Generate a synthetic tree under `outdir`, and write a config file for it.
+
+    :param outdir: Directory to generate the tree in.
+    :type outdir: str
+    :param num_runs: Number of sequencing runs.
+    :type num_runs: int
+    :return: Path to the config file
+    :rtype: str
+    """
+    random.seed(seed)
+    sequencer_output_dirs = {
+        'miseq': os.path.join(outdir, 'sequencers', 'miseq-01', 'output'),
+        'nextseq': os.path.join(outdir, 'sequencers', 'nextseq-01', 'output'),
+    }
+    fastq_input_dir = os.path.join(outdir, 'fastq_input_by_run')
+    analysis_by_run_dir = os.path.join(outdir, 'analysis_by_run')
+    output_dir = os.path.join(outdir, 'output')
+    for d in list(sequencer_output_dirs.values()) + [fastq_input_dir, analysis_by_run_dir]:
+        os.makedirs(d, exist_ok=True)
+    fastq_target = os.path.join(outdir, 'empty.fastq.gz')
+    open(fastq_target, 'w').close()
+
+    for run_num in range(num_runs):
+        sequencer_type = 'miseq' if run_num % 2 == 0 else 'nextseq'
+        run_id = get_run_id(run_num, sequencer_type)
+        plates = {}
+        for plate_num in range(1, plates_per_run + 1):
+            plates[plate_num] = get_library_ids(plate_num, libraries_per_plate)
+        all_library_ids = [library_id for library_ids in plates.values() for library_id in library_ids]
+
+        sequencer_run_dir = os.path.join(sequencer_output_dirs[sequencer_type], run_id)
+        write_samplesheet(sequencer_run_dir, sequencer_type, all_library_ids, 'new' if run_num % 4 == 0 else 'old')
+        write_fastq_symlinks(os.path.join(fastq_input_dir, run_id), fastq_target, all_library_ids)
+        complete = random.random() >= fraction_incomplete
+        write_analysis_outputs(os.path.join(analysis_by_run_dir, run_id), run_id, plates, plot_size, complete)
+
+    # Things that should be ignored
+    os.makedirs(os.path.join(analysis_by_run_dir, 'not_a_run'), exist_ok=True)
+    open(os.path.join(analysis_by_run_dir, 'README.txt'), 'w').close()
+
+    excluded_runs_list = os.path.join(outdir, 'excluded_runs.csv')
+    with open(excluded_runs_list, 'w') as f:
+        f.write('# run_id\n')
+        f.write(get_run_id(0, 'miseq') + '\n')
+
+    config = {
+        "sequencer_output_dirs": list(sequencer_output_dirs.values()),
+        "fastq_input_dir": fastq_input_dir,
+        "analysis_by_run_dir": analysis_by_run_dir,
+        "excluded_runs_list": excluded_runs_list,
+        "artic_output_version": ARTIC_VERSION,
+        "output_dir": output_dir,
+        "scan_interval_seconds": 3600,
+    }
+    config_path = os.path.join(outdir, 'config.json')
+    with open(config_path, 'w') as f:
+        json.dump(config, f, indent=2)
+
+    return config_path
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--outdir', required=True)
+    parser.add_argument('--num-runs', type=int, default=100)
+    parser.add_argument('--plates-per-run', type=int, default=2)
+    parser.add_argument('--libraries-per-plate', type=int, default=8)
+    parser.add_argument('--plot-size', type=int, default=4096, help="Size of each plot file, in bytes")
+    parser.add_argument('--fraction-incomplete', type=float, default=0.05, help="Fraction of runs whose analyses are not complete")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    config_path = generate_fixture_tree(
+        args.outdir,
+        args.num_runs,
+        plates_per_run=args.plates_per_run,
+        libraries_per_plate=args.libraries_per_plate,
+        plot_size=args.plot_size,
+        fraction_incomplete=args.fraction_incomplete,
+        seed=args.seed,
+    )
+    print(config_path)
+
+
+if __name__ == '__main__':
+    main()
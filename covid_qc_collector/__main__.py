@@ -1,25 +1,284 @@
 #!/usr/bin/env python
 
 import argparse
+import concurrent.futures
 import datetime
 import json
 import logging
 import os
+import signal
 import time
 
 import covid_qc_collector.config
 import covid_qc_collector.core as core
+import covid_qc_collector.journal as journal
+import covid_qc_collector.metrics as metrics
+import covid_qc_collector.output_index as output_index
+import covid_qc_collector.rollups as rollups
+import covid_qc_collector.shard as shard
+import covid_qc_collector.state as state
+import covid_qc_collector.status as status
+import covid_qc_collector.watch as watch
+import covid_qc_collector.work_queue as work_queue
 
 DEFAULT_SCAN_INTERVAL_SECONDS = 3600.0
 
+
+def reload_config(config_manager, config):
+    """
+    Get the current config. It's only reloaded if the config file (or one
+    of the lists it refers to) has changed, or on SIGHUP. If it can't be
+    loaded, continue on with the last valid config that was loaded.
+    """
+    if config_manager is not None:
+        config = covid_qc_collector.config.get_config(config_manager)
+
+    return config
+
+
+def write_plates_by_run(config, sequencer_run_index, run_ids=None):
+    """
+    If `run_ids` is provided, only those runs' entries are updated.
+    """
+    logging.info(json.dumps({"event_type": "parse_plates_by_run_started"}))
+    with metrics.timer('plates_by_run'):
+        plates_by_run = core.plates_by_run(config, sequencer_run_index, run_ids)
+    logging.info(json.dumps({"event_type": "parse_plates_by_run_complete"}))
+    plates_by_run_output_file = os.path.join(config['output_dir'], 'plates_by_run.json')
+    tmp_plates_by_run_output_file = state.get_temp_path(plates_by_run_output_file)
+    with open(tmp_plates_by_run_output_file, 'w') as f:
+        json.dump(plates_by_run, f, indent=2)
+        metrics.increment('bytes_written', f.tell())
+    os.replace(tmp_plates_by_run_output_file, plates_by_run_output_file)
+    logging.info(json.dumps({"event_type": "write_plates_by_run_file_complete", "plates_by_run_file": plates_by_run_output_file}))
+
+
+def collect_run(config, run, instance_id=None, existing_outputs=None, collection_journal=None):
+    """
+    Collect outputs for a single run, timing the collection. If `instance_id`
+    is provided (ie. when sharded), a lease is taken on the run first, and the
+    run is skipped if another instance holds it. The lease is renewed until
+    the run has been collected. The run is always locked
+    while it's collected, and skipped if another process on this host (eg.
+    the `collect` command, alongside the daemon) is collecting it.
+
+    :return: True if the run was collected.
+    :rtype: bool
+    """
+    run_id = os.path.basename(run['path'])
+    if instance_id is not None:
+        if not shard.acquire_run_lease(config, run_id, instance_id):
+            logging.info(json.dumps({"event_type": "run_lease_held", "run_id": run_id}))
+            return False
+        shard.write_heartbeat(config, instance_id)
+    run_lock = state.acquire_run_lock(config, run_id)
+    if run_lock is None:
+        logging.info(json.dumps({"event_type": "run_locked", "run_id": run_id}))
+        if instance_id is not None:
+            shard.release_run_lease(config, run_id, instance_id)
+        return False
+    lease_renewal = None
+    if instance_id is not None:
+        lease_renewal = shard.start_lease_renewal(config, run_id, instance_id)
+    status.run_started(run_id)
+    collected = False
+    try:
+        with metrics.timer('collect_outputs', run_id):
+            collected = core.collect_outputs(config, run, existing_outputs, collection_journal)
+    finally:
+        status.run_finished(run_id, collected)
+        state.release_run_lock(run_lock)
+        if instance_id is not None:
+            shard.stop_lease_renewal(lease_renewal)
+            shard.release_run_lease(config, run_id, instance_id)
+
+    return collected
+
+
+def report_scan_metrics(config, scan_duration_seconds):
+    """
+    Log the metrics recorded since the last scan completed, and write them
+    to the Prometheus textfile, if one is configured.
+    """
+    scan_metrics = metrics.end_scan(scan_duration_seconds)
+    event = {"event_type": "scan_metrics"}
+    event.update(scan_metrics)
+    logging.info(json.dumps(event))
+    status.scan_completed(scan_metrics)
+    if 'metrics_textfile' in config:
+        try:
+            metrics.write_prometheus_textfile(scan_metrics, config['metrics_textfile'])
+        except OSError as e:
+            logging.error(json.dumps({"event_type": "write_metrics_textfile_failed", "metrics_textfile": config['metrics_textfile'], "error": str(e)}))
+
+
+def collect_runs(args, config, runs, scan_state, quit_when_safe, instance_id=None, existing_outputs=None, collection_journal=None, config_manager=None):
+    """
+    Collect outputs for runs, using a pool of `args.workers` threads. At most
+    that many runs are in flight at any time. If interrupted, or if
+    `quit_when_safe` is already set, no new runs are started, and runs that
+    are in flight are allowed to finish. Each run is collected with the
+    config that was current when it was started. The QC rollup index is
+    saved once all the runs have been collected.
+
+    :return: The most recently loaded config, and whether we should quit.
+    :rtype: tuple[dict[str, object], bool]
+    """
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as executor:
+            in_flight = {}
+            try:
+                for run in runs:
+                    # Checked before each run is started, so that no run is started
+                    # once it's set.
+                    if quit_when_safe:
+                        break
+                    if run is not None:
+                        status.set_phase('collecting')
+                        config = reload_config(config_manager, config)
+                        in_flight[executor.submit(collect_run, config, run, instance_id, existing_outputs, collection_journal)] = run
+                    # Limit the number of runs in flight to the number of workers,
+                    # so that we never get far ahead of the scan.
+                    while len(in_flight) >= args.workers:
+                        done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in done:
+                            run = in_flight.pop(future)
+                            if future.result():
+                                core.mark_run_collected(config, scan_state, run)
+            except KeyboardInterrupt as e:
+                logging.info(json.dumps({"event_type": "quit_when_safe_enabled", "num_runs_in_flight": len(in_flight)}))
+                quit_when_safe = True
+            # Let any runs that are still being collected finish before moving on
+            for future in concurrent.futures.as_completed(list(in_flight)):
+                run = in_flight.pop(future)
+                if future.result():
+                    core.mark_run_collected(config, scan_state, run)
+    finally:
+        rollups.save_rollup_index(config)
+
+    return config, quit_when_safe
+
+
+def collect_requested_runs(args, config):
+    """
+    Collect the runs named on the command line, and nothing else. Runs are
+    collected even if they haven't changed since they were last collected
+    (though outputs that are already up to date aren't rewritten). Unless
+    `args.skip_readiness_check` is set, runs whose analyses aren't complete
+    are skipped.
+
+    Interrupted runs aren't recovered, because the daemon may be collecting
+    other runs at the same time. This command keeps its own journal, which
+    the daemon replays if the command is killed part-way through a run. Each
+    run is locked (and when sharded, leased) while it's collected, so that
+    it's never collected by the daemon and this command at once.
+
+    :return: True if every requested run was collected.
+    :rtype: bool
+    """
+    core.create_output_dirs(config)
+    instance_id = None
+    if shard.is_sharded(config):
+        instance_id = shard.get_instance_id(config)
+    scan_state = core.load_scan_state(config)
+    existing_outputs = output_index.new_output_index()
+    collection_journal = journal.open_journal(config, per_process=True)
+    requested_runs = []
+    for run_id in args.run_ids:
+        analysis_dir_path = os.path.join(config['analysis_by_run_dir'], run_id)
+        run = core.check_analysis_dir(config, analysis_dir_path, check_complete=not args.skip_readiness_check)
+        if run is None:
+            logging.error(json.dumps({"event_type": "requested_run_not_ready", "run_id": run_id, "analysis_directory_path": analysis_dir_path}))
+        else:
+            # The run is only marked as collected again once it has been
+            # collected by this command
+            requested_runs.append(run)
+            scan_state['runs'].pop(run_id, None)
+    try:
+        collect_runs(args, config, requested_runs, scan_state, False, instance_id, existing_outputs, collection_journal)
+    finally:
+        journal.close_journal(collection_journal)
+    # The daemon may have saved the scan state while these runs were being
+    # collected, so only the requested runs' entries are updated.
+    collected_runs = {run_id: scan_state['runs'][run_id] for run_id in args.run_ids if run_id in scan_state['runs']}
+    scan_state = core.load_scan_state(config)
+    for run_id in args.run_ids:
+        scan_state['runs'].pop(run_id, None)
+    scan_state['runs'].update(collected_runs)
+    core.save_scan_state(config, scan_state)
+    not_collected_run_ids = [run_id for run_id in args.run_ids if not scan_state['runs'].get(run_id, {}).get('collected', False)]
+    logging.info(json.dumps({"event_type": "collect_requested_runs_complete", "run_ids": args.run_ids, "not_collected_run_ids": not_collected_run_ids}))
+
+    return not not_collected_run_ids
+
+
+def get_scan_interval(config):
+    """
+    """
+    try:
+        scan_interval = float(str(config.get('scan_interval_seconds', DEFAULT_SCAN_INTERVAL_SECONDS)))
+    except ValueError as e:
+        scan_interval = DEFAULT_SCAN_INTERVAL_SECONDS
+
+    return scan_interval
+
+
+def get_watch_poll_interval(config):
+    """
+    """
+    try:
+        watch_poll_interval = float(str(config.get('watch_poll_interval_seconds', watch.DEFAULT_WATCH_POLL_INTERVAL_SECONDS)))
+    except ValueError as e:
+        watch_poll_interval = watch.DEFAULT_WATCH_POLL_INTERVAL_SECONDS
+
+    return watch_poll_interval
+
+
+def add_common_arguments(parser, suppress_defaults=False):
+    """
+    Options that can be given either before or after the command. When added
+    to a command's parser, their defaults are suppressed, so that they don't
+    replace values given before the command.
+    """
+    def default(value):
+        return argparse.SUPPRESS if suppress_defaults else value
+
+    parser.add_argument('-c', '--config', default=default(None))
+    parser.add_argument('--log-level', default=default(None))
+    parser.add_argument('--workers', type=int, default=default(1), help="Number of runs to collect in parallel (default: 1)")
+
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-c', '--config')
-    parser.add_argument('--log-level')
+    add_common_arguments(parser)
+    parser.add_argument('--watch', action='store_true', help="Collect runs as soon as their analyses complete, instead of waiting for the next scan")
+    subparsers = parser.add_subparsers(dest='command', metavar='{scan,collect,plates-by-run}')
+    parser.set_defaults(command='scan', once=False)
+    scan_parser = subparsers.add_parser('scan', help="Scan for runs that are ready, and collect them, every scan_interval_seconds (the default)")
+    add_common_arguments(scan_parser, suppress_defaults=True)
+    scan_parser.add_argument('--watch', action='store_true', default=argparse.SUPPRESS, help="Collect runs as soon as their analyses complete, instead of waiting for the next scan")
+    scan_parser.add_argument('--once', action='store_true', help="Scan and collect once, then exit")
+    collect_parser = subparsers.add_parser('collect', help="Collect the given runs, then exit")
+    add_common_arguments(collect_parser, suppress_defaults=True)
+    collect_parser.add_argument('--run-id', dest='run_ids', metavar='RUN_ID', action='extend', nargs='+', required=True, help="Runs to collect")
+    collect_parser.add_argument('--skip-readiness-check', action='store_true', help="Collect runs even if their analyses aren't complete")
+    plates_by_run_parser = subparsers.add_parser('plates-by-run', help="Update the plates_by_run.json entries for the given runs, then exit")
+    add_common_arguments(plates_by_run_parser, suppress_defaults=True)
+    plates_by_run_parser.add_argument('--run-id', dest='run_ids', metavar='RUN_ID', action='extend', nargs='+', required=True, help="Runs to update")
     args = parser.parse_args()
 
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.once and args.watch:
+        parser.error("--once can't be combined with --watch")
+    if args.command != 'scan' and not args.config:
+        parser.error("--config is required for the " + args.command + " command")
+
     config = {}
     scan_interval = DEFAULT_SCAN_INTERVAL_SECONDS
+    config_manager = covid_qc_collector.config.new_config_manager(args.config)
+    # `kill -HUP` forces the config to be reloaded, even if it hasn't changed
+    signal.signal(signal.SIGHUP, lambda signum, frame: covid_qc_collector.config.request_reload(config_manager))
 
     try:
         log_level = getattr(logging, args.log_level.upper())
@@ -34,57 +293,115 @@ def main():
     )
     logging.debug(json.dumps({"event_type": "debug_logging_enabled"}))
 
+    # The one-shot commands only touch the runs they're given, and skip the
+    # scan of the whole analysis_by_run_dir.
+    if args.command in ['collect', 'plates-by-run']:
+        config = covid_qc_collector.config.get_config(config_manager)
+        if not config:
+            exit(1)
+        if args.command == 'collect':
+            exit(0 if collect_requested_runs(args, config) else 1)
+        core.create_output_dirs(config)
+        write_plates_by_run(config, None, args.run_ids)
+        exit(0)
+
     quit_when_safe = False
+    sequencer_run_index = {}
+    collection_journal = None
 
     while(True):
         try:
-            if args.config:
-                try:
-                    config = covid_qc_collector.config.load_config(args.config)
-                    logging.info(json.dumps({"event_type": "config_loaded", "config_file": os.path.abspath(args.config)}))
-                except json.decoder.JSONDecodeError as e:
-                    # If we fail to load the config file, we continue on with the
-                    # last valid config that was loaded.
-                    logging.error(json.dumps({"event_type": "load_config_failed", "config_file": os.path.abspath(args.config)}))
+            config = reload_config(config_manager, config)
 
             core.create_output_dirs(config)
 
+            # Runs that were interrupted the last time the collector stopped
+            # are recovered before anything else is collected.
+            if collection_journal is None:
+                status.start_status_server(config)
+                status.set_phase('recovering')
+                core.recover_interrupted_runs(config)
+                collection_journal = journal.open_journal(config)
+                journal.checkpoint(collection_journal)
+
             scan_start_timestamp = datetime.datetime.now()
 
-            logging.info(json.dumps({"event_type": "parse_plates_by_run_started"}))
-            plates_by_run = core.plates_by_run(config)
-            logging.info(json.dumps({"event_type": "parse_plates_by_run_complete"}))
-            plates_by_run_output_file = os.path.join(config['output_dir'], 'plates_by_run.json')
-            with open(plates_by_run_output_file, 'w') as f:
-                json.dump(plates_by_run, f, indent=2)
-            logging.info(json.dumps({"event_type": "write_plates_by_run_file_complete", "plates_by_run_file": plates_by_run_output_file}))
-
-            for run in core.scan(config):
-                if run is not None:
-                    try:
-                        config = covid_qc_collector.config.load_config(args.config)
-                        logging.info(json.dumps({"event_type": "config_loaded", "config_file": os.path.abspath(args.config)}))
-                    except json.decoder.JSONDecodeError as e:
-                        logging.error(json.dumps({"event_type": "load_config_failed", "config_file": os.path.abspath(args.config)}))
-                    core.collect_outputs(config, run)
-                if quit_when_safe:
-                    exit(0)
+            # When sharded, this instance only scans runs in its own shard (and in
+            # any shards it has adopted), and plates_by_run is only written by
+            # the instance collecting shard 0.
+            instance_id = None
+            run_filter = None
+            write_plates_by_run_this_scan = True
+            if shard.is_sharded(config):
+                instance_id = shard.get_instance_id(config)
+                shard.write_heartbeat(config, instance_id)
+                active_shards = shard.get_active_shards(config)
+                run_filter = shard.get_run_filter(config, active_shards)
+                write_plates_by_run_this_scan = 0 in active_shards
+
+            if write_plates_by_run_this_scan:
+                status.set_phase('plates_by_run')
+                write_plates_by_run(config, sequencer_run_index)
+
+            status.set_phase('scanning')
+            scan_state = core.load_scan_state(config)
+            existing_outputs = output_index.new_output_index()
+            runs = work_queue.iter_by_priority(core.scan(config, scan_state, run_filter, existing_outputs), scan_state, config.get('priority_runs', None))
+            config, quit_when_safe = collect_runs(args, config, runs, scan_state, quit_when_safe, instance_id, existing_outputs, collection_journal, config_manager)
+            core.save_scan_state(config, scan_state)
+            journal.checkpoint(collection_journal)
+            if quit_when_safe:
+                exit(0)
             scan_complete_timestamp = datetime.datetime.now()
             scan_duration_delta = scan_complete_timestamp - scan_start_timestamp
             scan_duration_seconds = scan_duration_delta.total_seconds()
             logging.info(json.dumps({"event_type": "scan_complete", "scan_duration_seconds": scan_duration_seconds}))
-
-            if quit_when_safe:
+            report_scan_metrics(config, scan_duration_seconds)
+            if args.once:
                 exit(0)
 
-            if "scan_interval_seconds" in config:
-                try:
-                    config['scan_interval_seconds'] = float(str(config['scan_interval_seconds']))
-                except ValueError as e:
-                    config['scan_interval_seconds'] = DEFAULT_SCAN_INTERVAL_SECONDS
-            else:
-                    config['scan_interval_seconds'] = DEFAULT_SCAN_INTERVAL_SECONDS
-            time.sleep(config['scan_interval_seconds'])
+            scan_interval = get_scan_interval(config)
+            if not args.watch:
+                # A scan can be started early via the status server
+                status.set_phase('waiting')
+                status.wait_for_scan_request(scan_interval)
+                continue
+
+            # In watch mode, runs are collected as soon as they're ready, and
+            # the full scan above only runs every `scan_interval_seconds` to
+            # catch anything that the watcher missed.
+            next_scan_time = time.monotonic() + scan_interval
+            watch_timeout = min(get_watch_poll_interval(config), scan_interval)
+            status.set_phase('watching')
+            watcher = watch.watch_analysis_by_run_dir(config, scan_state, watch_timeout)
+            try:
+                for changed_run_ids in watcher:
+                    if instance_id is not None:
+                        shard.write_heartbeat(config, instance_id)
+                    if run_filter is not None:
+                        changed_run_ids = set(filter(run_filter, changed_run_ids))
+                    if changed_run_ids:
+                        logging.info(json.dumps({"event_type": "watch_detected_changes", "run_ids": sorted(changed_run_ids)}))
+                        runs = work_queue.iter_by_priority(
+                            (core.check_analysis_dir(config, os.path.join(config['analysis_by_run_dir'], run_id), scan_state=scan_state, existing_outputs=existing_outputs) for run_id in changed_run_ids),
+                            scan_state,
+                            config.get('priority_runs', None),
+                        )
+                        config, quit_when_safe = collect_runs(args, config, runs, scan_state, quit_when_safe, instance_id, existing_outputs, collection_journal, config_manager)
+                        core.save_scan_state(config, scan_state)
+                        journal.checkpoint(collection_journal)
+                        if quit_when_safe:
+                            exit(0)
+                        if write_plates_by_run_this_scan:
+                            status.set_phase('plates_by_run')
+                            write_plates_by_run(config, sequencer_run_index)
+                        status.set_phase('watching')
+                    # Waiting for no time at all checks for (and clears) a
+                    # request for a scan via the status server
+                    if time.monotonic() >= next_scan_time or status.wait_for_scan_request(0):
+                        break
+            finally:
+                watcher.close()
         except KeyboardInterrupt as e:
             logging.info(json.dumps({"event_type": "quit_when_safe_enabled"}))
             quit_when_safe = True
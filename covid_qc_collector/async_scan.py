@@ -0,0 +1,94 @@
+import asyncio
+import concurrent.futures
+import queue
+import threading
+
+# With the default of 1, scanning runs one call at a time in the calling
+# thread, exactly as it did before concurrent scanning was added.
+DEFAULT_SCAN_CONCURRENCY = 1
+
+
+def get_scan_concurrency(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Maximum number of scan operations (eg. checking a single run) in flight at once.
+    :rtype: int
+    """
+    scan_concurrency = max(int(config.get('scan_concurrency', DEFAULT_SCAN_CONCURRENCY)), 1)
+
+    return scan_concurrency
+
+
+async def _run_concurrently(fn, items, concurrency, results, cancelled):
+    """
+    Call `fn` on each item in an executor, with at most `concurrency` calls in
+    flight, putting `(index, result, exception)` on the `results` queue as
+    each call completes.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+
+        async def run_one(index, item):
+            async with semaphore:
+                if cancelled.is_set():
+                    return
+                try:
+                    result = await loop.run_in_executor(executor, fn, item)
+                    results.put((index, result, None))
+                except Exception as e:
+                    results.put((index, None, e))
+
+        await asyncio.gather(*(run_one(index, item) for index, item in enumerate(items)))
+
+
+def iter_concurrently(fn, items, concurrency=DEFAULT_SCAN_CONCURRENCY):
+    """
+    Map `fn` over `items`, running up to `concurrency` calls at once. Scanning
+    is dominated by filesystem metadata calls (stat, listdir), which are slow
+    on network mounts, but spend their time waiting rather than computing, so
+    they overlap well in threads.
+
+    The calls are driven by an asyncio event loop in a background thread, with
+    a thread pool executor for the blocking calls. Results are yielded in the
+    same order as `items`, as soon as they're available, so callers see an
+    ordinary iterator. If `fn` raises, the exception is re-raised here, when
+    its result would have been yielded.
+
+    :param fn: Function to call on each item. Must be safe to call from several threads at once.
+    :type fn: Callable[[object], object]
+    :param items: Items to call `fn` on
+    :type items: Iterable[object]
+    :param concurrency: Maximum number of calls in flight at once
+    :type concurrency: int
+    :return: `fn(item)` for each item
+    :rtype: Iterator[object]
+    """
+    if concurrency <= 1:
+        for item in items:
+            yield fn(item)
+        return
+
+    items = list(items)
+    results = queue.Queue()
+    cancelled = threading.Event()
+    loop_thread = threading.Thread(
+        target=asyncio.run,
+        args=(_run_concurrently(fn, items, concurrency, results, cancelled),),
+        daemon=True,
+    )
+    loop_thread.start()
+    completed = {}
+    try:
+        for index in range(len(items)):
+            while index not in completed:
+                completed_index, result, exception = results.get()
+                completed[completed_index] = (result, exception)
+            result, exception = completed.pop(index)
+            if exception is not None:
+                raise exception
+            yield result
+    finally:
+        # If the caller stops early, calls that haven't started are skipped.
+        cancelled.set()
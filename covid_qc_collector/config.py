@@ -1,17 +1,140 @@
+import fnmatch
 import json
+import logging
+import os
+import re
+import threading
+import types
 
+import covid_qc_collector.state as state
 
-def get_excluded_runs(config):
+REQUIRED_CONFIG_FIELDS = {
+    'sequencer_output_dirs': list,
+    'fastq_input_dir': str,
+    'analysis_by_run_dir': str,
+    'output_dir': str,
+    'artic_output_version': str,
+}
+
+# Optional fields that must be numbers, if present
+NUMERIC_CONFIG_FIELDS = [
+    'scan_interval_seconds',
+    'watch_poll_interval_seconds',
+    'transfer_workers',
+    'scan_concurrency',
+    'num_shards',
+    'shard_index',
+    'lease_duration_seconds',
+    'shard_heartbeat_timeout_seconds',
+    'amplicon_depth_matrix_low_depth_threshold',
+    'status_port',
+]
+
+# Lines in the excluded runs list that start with this are regular expressions
+EXCLUDED_RUN_REGEX_PREFIX = 'regex:'
+GLOB_CHARACTERS = '*?['
+
+
+def parse_excluded_runs(lines):
     """
+    Parse the lines of an excluded runs list. Each line is either a run ID,
+    a glob pattern (eg. `220101_M*`), or a regular expression, prefixed with
+    `regex:` (eg. `regex:2201\\d\\d_VH\\d+_.*`). Patterns must match the whole
+    run ID. Lines starting with `#` are comments.
+
+    :param lines: Lines of the excluded runs list
+    :type lines: Iterable[str]
+    :return: Excluded run IDs, and compiled patterns for excluded runs.
+    :rtype: tuple[set[str], list[re.Pattern]]
     """
     excluded_runs = set()
+    excluded_run_patterns = []
+    for line in lines:
+        if line.startswith('#') or not line.strip():
+            continue
+        entry = line.strip()
+        if entry.startswith(EXCLUDED_RUN_REGEX_PREFIX):
+            pattern = entry[len(EXCLUDED_RUN_REGEX_PREFIX):]
+            try:
+                excluded_run_patterns.append(re.compile(pattern))
+            except re.error as e:
+                raise ValueError("Invalid regular expression in excluded runs list: " + pattern + " (" + str(e) + ")")
+        elif any(c in entry for c in GLOB_CHARACTERS):
+            excluded_run_patterns.append(re.compile(fnmatch.translate(entry)))
+        else:
+            excluded_runs.add(entry)
+
+    return excluded_runs, excluded_run_patterns
+
+
+def get_excluded_runs(config):
+    """
+    :return: Excluded run IDs, and compiled patterns for excluded runs.
+    :rtype: tuple[set[str], list[re.Pattern]]
+    """
     with open(config['excluded_runs_list'], 'r') as f:
-        for line in f.readlines():
-            if not line.startswith('#'):
-                run_id = line.strip()
-                excluded_runs.add(run_id)
+        excluded_runs, excluded_run_patterns = parse_excluded_runs(f)
+
+    return excluded_runs, excluded_run_patterns
+
+
+def is_run_excluded(config, run_id):
+    """
+    :param config: Application config.
+    :type config: Mapping[str, object]
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :return: True if the run is in the excluded runs list, or matches one of its patterns.
+    :rtype: bool
+    """
+    if run_id in config['excluded_runs']:
+        return True
+
+    return any(pattern.fullmatch(run_id) for pattern in config.get('excluded_run_patterns', ()))
+
 
-    return excluded_runs
+def get_priority_runs(config):
+    """
+    Runs listed in the priority runs list are collected ahead of all others.
+    The list is maintained by operators, and may not exist.
+    """
+    priority_runs = set()
+    try:
+        with open(config['priority_runs_list'], 'r') as f:
+            for line in f.readlines():
+                if not line.startswith('#') and line.strip():
+                    run_id = line.strip()
+                    priority_runs.add(run_id)
+    except FileNotFoundError as e:
+        pass
+
+    return priority_runs
+
+
+def validate_config(config):
+    """
+    Check that the required fields are present, and that fields have the
+    right types.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: None
+    :rtype: None
+    :raises ValueError: If the config isn't valid.
+    """
+    if not isinstance(config, dict):
+        raise ValueError("Config must be a JSON object")
+    for field, field_type in REQUIRED_CONFIG_FIELDS.items():
+        if field not in config:
+            raise ValueError("Missing required config field: " + field)
+        if not isinstance(config[field], field_type):
+            raise ValueError("Config field " + field + " must be a " + field_type.__name__)
+    for field in NUMERIC_CONFIG_FIELDS:
+        if field in config:
+            try:
+                float(str(config[field]))
+            except ValueError as e:
+                raise ValueError("Config field " + field + " must be a number")
 
 
 def load_config(config_path: str) -> dict[str, object]:
@@ -21,9 +144,133 @@ def load_config(config_path: str) -> dict[str, object]:
         config = json.load(f)
 
     if 'excluded_runs_list' in config:
-        excluded_runs = get_excluded_runs(config)
+        excluded_runs, excluded_run_patterns = get_excluded_runs(config)
         config['excluded_runs'] = excluded_runs
+        config['excluded_run_patterns'] = excluded_run_patterns
     else:
         config['excluded_runs'] = set()
+        config['excluded_run_patterns'] = []
+
+    if 'priority_runs_list' in config:
+        priority_runs = get_priority_runs(config)
+        config['priority_runs'] = priority_runs
+    else:
+        config['priority_runs'] = set()
 
     return config
+
+
+def freeze_config(config):
+    """
+    Make a read-only snapshot of a config, so that it can be shared between
+    threads without any of them seeing it change.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Read-only config, with lists as tuples and sets as frozensets.
+    :rtype: Mapping[str, object]
+    """
+    frozen_config = {}
+    for key, value in config.items():
+        if isinstance(value, list):
+            value = tuple(value)
+        elif isinstance(value, set):
+            value = frozenset(value)
+        elif isinstance(value, dict):
+            value = types.MappingProxyType(dict(value))
+        frozen_config[key] = value
+
+    return types.MappingProxyType(frozen_config)
+
+
+def _get_watched_paths(config_path, config):
+    """
+    :return: The config file, and the lists it refers to.
+    :rtype: list[str]
+    """
+    watched_paths = [config_path]
+    for list_field in ['excluded_runs_list', 'priority_runs_list']:
+        if list_field in config:
+            watched_paths.append(config[list_field])
+
+    return watched_paths
+
+
+def new_config_manager(config_path):
+    """
+    Create a config manager, which holds the current config, and reloads it
+    when the config file (or the excluded or priority runs list) changes, or
+    when a reload is requested (eg. on SIGHUP). A new config is validated
+    before it replaces the current one. If it can't be loaded, or isn't
+    valid, the last good config is kept.
+
+    :param config_path: Path to the config file (or None, for an empty config).
+    :type config_path: Optional[str]
+    :return: Config manager
+    :rtype: dict[str, object]
+    """
+    config_manager = {
+        "config_path": config_path,
+        "config": freeze_config({}),
+        # Fingerprint of the watched files when the config was last loaded.
+        # None until the first load.
+        "fingerprint": None,
+        "reload_requested": threading.Event(),
+        "lock": threading.Lock(),
+    }
+
+    return config_manager
+
+
+def request_reload(config_manager):
+    """
+    Reload the config the next time it's requested, even if it hasn't changed.
+    Safe to call from a signal handler.
+
+    :param config_manager: Config manager, as returned by `new_config_manager`
+    :type config_manager: dict[str, object]
+    :return: None
+    :rtype: None
+    """
+    config_manager['reload_requested'].set()
+
+
+def get_config(config_manager):
+    """
+    Get the current config, reloading it first if any of the files it's
+    loaded from have changed (costs a stat per file), or if a reload has been
+    requested.
+
+    :param config_manager: Config manager, as returned by `new_config_manager`
+    :type config_manager: dict[str, object]
+    :return: Read-only snapshot of the current config
+    :rtype: Mapping[str, object]
+    """
+    config_path = config_manager['config_path']
+    if not config_path:
+        return config_manager['config']
+
+    with config_manager['lock']:
+        fingerprint = config_manager['fingerprint']
+        reload_requested = config_manager['reload_requested'].is_set()
+        if fingerprint is not None and not reload_requested and state.fingerprint_unchanged(fingerprint):
+            return config_manager['config']
+
+        config_manager['reload_requested'].clear()
+        # The fingerprint is taken before loading, so that a change made
+        # while loading is picked up by the next call.
+        config_manager['fingerprint'] = state.get_path_fingerprint(_get_watched_paths(config_path, config_manager['config']))
+        try:
+            config = load_config(config_path)
+            validate_config(config)
+            # The lists that the new config refers to may not be the ones
+            # that the old one did.
+            watched_paths = _get_watched_paths(config_path, config)
+            if set(watched_paths) != set(config_manager['fingerprint']):
+                config_manager['fingerprint'] = state.get_path_fingerprint(watched_paths)
+            config_manager['config'] = freeze_config(config)
+            logging.info(json.dumps({"event_type": "config_loaded", "config_file": os.path.abspath(config_path)}))
+        except (OSError, ValueError) as e:
+            logging.error(json.dumps({"event_type": "load_config_failed", "config_file": os.path.abspath(config_path), "error": str(e)}))
+
+        return config_manager['config']
@@ -4,12 +4,37 @@ import json
 import logging
 import os
 import re
-import shutil
 
 from typing import Iterator, Optional
 
+import covid_qc_collector.async_scan as async_scan
+import covid_qc_collector.config
+import covid_qc_collector.depth_matrix as depth_matrix
+import covid_qc_collector.journal as journal
+import covid_qc_collector.layout as layout
+import covid_qc_collector.manifest as manifest
+import covid_qc_collector.metrics as metrics
+import covid_qc_collector.output_index as output_index
 import covid_qc_collector.parsers as parsers
+import covid_qc_collector.rollups as rollups
 import covid_qc_collector.samplesheet as samplesheet
+import covid_qc_collector.shard as shard
+import covid_qc_collector.state as state
+import covid_qc_collector.transfer as transfer
+import covid_qc_collector.writers as writers
+
+# 'per_library' writes one JSON file per library. 'per_run' writes a
+# single NDJSON file (plus an index) per run.
+DEFAULT_AMPLICON_DEPTH_OUTPUT_MODE = 'per_library'
+
+
+def glob_paths(pattern):
+    """
+    `glob.glob`, counted as a directory listing.
+    """
+    metrics.increment('directories_listed')
+
+    return glob.glob(pattern)
 
 
 def create_output_dirs(config):
@@ -24,64 +49,176 @@ def create_output_dirs(config):
         os.path.join(base_outdir, 'ncov-tools-plots', 'tree-snps'),
         os.path.join(base_outdir, 'ncov-tools-qc-sequencing'),
         os.path.join(base_outdir, 'ncov-tools-summary'),
+        state.get_state_dir(config),
+        manifest.get_manifests_dir(config),
+        state.get_locks_dir(config),
     ]
+    if config.get('qc_rollups', True):
+        output_dirs.append(rollups.get_rollups_dir(config))
+    if shard.is_sharded(config):
+        output_dirs.append(shard.get_leases_dir(config))
     for output_dir in output_dirs:
         if not os.path.exists(output_dir):
-            os.makedirs(output_dir)    
+            # Another instance may be creating the same dirs at the same time
+            os.makedirs(output_dir, exist_ok=True)
     
 
-def find_analysis_dirs(config, check_complete=True):
+def get_run_fingerprint(analysis_dir_path, run_layout=None):
     """
+    Fingerprint the parts of an analysis dir that change when analyses are
+    added or completed: the run dir itself, the latest artic and ncov-tools
+    output dirs, and their `analysis_complete.json` markers. If the run's
+    plates have been scanned, its `by_plate` dirs and summary QC files too
+    (see `layout.get_fingerprint_paths`).
+
+    :param analysis_dir_path: Path to the analysis dir for a run.
+    :type analysis_dir_path: str
+    :param run_layout: Layout of the analysis dir, if already scanned.
+    :type run_layout: Optional[dict[str, object]]
+    :return: mtimes by path
+    :rtype: dict[str, Optional[int]]
+    """
+    if run_layout is None:
+        run_layout = layout.scan_run_layout(analysis_dir_path)
+
+    fingerprint = state.get_path_fingerprint(layout.get_fingerprint_paths(run_layout))
+
+    return fingerprint
+
+
+def check_analysis_dir(config, analysis_dir_path, is_dir=None, check_complete=True, scan_state=None, existing_outputs=None):
+    """
+    Check whether a single analysis dir is ready to be collected.
+
+    If `scan_state` is provided, a run whose fingerprint hasn't changed since
+    it was last checked (and none of whose outputs have been deleted) is
+    skipped without looking inside it, and a run that isn't ready to collect
+    is recorded in it.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param analysis_dir_path: Path to the analysis dir for a run.
+    :type analysis_dir_path: str
+    :param is_dir: Whether the path is a directory, if already known.
+    :type is_dir: Optional[bool]
+    :param check_complete: Only consider the run ready once its analyses are complete.
+    :type check_complete: bool
+    :param scan_state: Scan state from previous scans.
+    :type scan_state: Optional[dict[str, object]]
+    :param existing_outputs: Index of existing outputs, shared by all runs in a scan.
+    :type existing_outputs: Optional[dict[str, object]]
+    :return: The analysis dir, if it is ready to collect. Otherwise None.
+    :rtype: Optional[dict[str, object]]
     """
     miseq_run_id_regex = "\d{6}_M\d{5}_\d+_\d{9}-[A-Z0-9]{5}"
     nextseq_run_id_regex = "\d{6}_VH\d{5}_\d+_[A-Z0-9]{9}"
-    analysis_by_run_dir = config['analysis_by_run_dir']
-    subdirs = os.scandir(analysis_by_run_dir)
-    
-    for subdir in subdirs:
-        run_id = subdir.name
-        matches_miseq_regex = re.match(miseq_run_id_regex, run_id)
-        matches_nextseq_regex = re.match(nextseq_run_id_regex, run_id)
-        not_excluded = run_id not in config['excluded_runs']
-        ready_to_collect = False
+    analysis_directory_path = os.path.abspath(analysis_dir_path)
+    run_id = os.path.basename(analysis_directory_path)
+    if is_dir is None:
+        metrics.increment('stat_calls')
+        is_dir = os.path.isdir(analysis_directory_path)
+    matches_miseq_regex = re.match(miseq_run_id_regex, run_id)
+    matches_nextseq_regex = re.match(nextseq_run_id_regex, run_id)
+    not_excluded = not covid_qc_collector.config.is_run_excluded(config, run_id)
+    is_candidate = is_dir and not_excluded and ((matches_miseq_regex is not None) or (matches_nextseq_regex is not None))
+    if is_candidate and scan_state is not None and run_id in scan_state['runs']:
+        run_state = scan_state['runs'][run_id]
+        shared_output_keys = run_state.get('outputs', [])
+        if shared_output_keys and existing_outputs is None:
+            existing_outputs = output_index.new_output_index()
+        if state.fingerprint_unchanged(run_state['fingerprint']) and manifest.outputs_exist(config, shared_output_keys, existing_outputs):
+            logging.debug(json.dumps({
+                "event_type": "directory_skipped",
+                "analysis_directory_path": analysis_directory_path,
+                "reason": "unchanged_since_last_scan",
+            }))
+            return None
+
+    fingerprint = None
+    run_layout = None
+    ready_to_collect = False
+    if is_candidate:
+        run_layout = layout.scan_run_layout(analysis_directory_path)
         if check_complete:
-            latest_artic_output = find_latest_artic_output(subdir)
-            if latest_artic_output is not None and os.path.exists(latest_artic_output):
-                latest_ncov_tools_output = find_latest_ncov_tools_output(latest_artic_output)
-                artic_analysis_complete = os.path.exists(os.path.join(latest_artic_output, 'analysis_complete.json'))
-                if latest_ncov_tools_output is not None and os.path.exists(latest_ncov_tools_output):
-                    ncov_tools_analysis_complete = os.path.exists(os.path.join(latest_ncov_tools_output, 'analysis_complete.json'))
-                    ready_to_collect = artic_analysis_complete and ncov_tools_analysis_complete
+            ready_to_collect = run_layout['artic_analysis_complete'] and run_layout['ncov_tools_analysis_complete']
         else:
             ready_to_collect = True
+        if ready_to_collect:
+            # Scanned before fingerprinting, so that the plates are part of
+            # the fingerprint that the run is marked as collected with.
+            layout.scan_plates(run_layout)
+        fingerprint = get_run_fingerprint(analysis_directory_path, run_layout)
+
+    conditions_checked = {
+        "is_directory": is_dir,
+        "matches_illumina_run_id_format": ((matches_miseq_regex is not None) or (matches_nextseq_regex is not None)),
+        "not_excluded": not_excluded,
+        "ready_to_collect": ready_to_collect,
+    }
+    conditions_met = list(conditions_checked.values())
+
+    analysis_dir = {
+        "path": analysis_directory_path,
+        "fingerprint": fingerprint,
+        "layout": run_layout,
+    }
+    if all(conditions_met):
+        logging.info(json.dumps({
+            "event_type": "analysis_directory_found",
+            "sequencing_run_id": run_id,
+            "analysis_directory_path": analysis_directory_path
+        }))
+
+        return analysis_dir
+    else:
+        if is_candidate and scan_state is not None:
+            # A collected run that's being re-analyzed stays collected, so
+            # that it's queued as a re-collection once it's ready.
+            previous_run_state = scan_state['runs'].get(run_id, {})
+            scan_state['runs'][run_id] = {
+                "fingerprint": fingerprint,
+                "collected": previous_run_state.get('collected', False),
+                "ready": False,
+            }
+        logging.debug(json.dumps({
+            "event_type": "directory_skipped",
+            "analysis_directory_path": analysis_directory_path,
+            "conditions_checked": conditions_checked
+        }))
+        return None
+
+
+def find_analysis_dirs(config, check_complete=True, scan_state=None, run_filter=None, existing_outputs=None):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param check_complete: Only consider runs ready once their analyses are complete.
+    :type check_complete: bool
+    :param scan_state: Scan state from previous scans.
+    :type scan_state: Optional[dict[str, object]]
+    :param run_filter: If provided, only entries whose name it returns True for are checked.
+    :type run_filter: Optional[Callable[[str], bool]]
+    :param existing_outputs: Index of existing outputs, shared by all runs in a scan.
+    :type existing_outputs: Optional[dict[str, object]]
+    :return: An analysis dir that is ready to collect, or None, for each entry in the analysis_by_run_dir
+    :rtype: Iterator[Optional[dict[str, object]]]
+    """
+    if existing_outputs is None:
+        existing_outputs = output_index.new_output_index()
+    analysis_by_run_dir = config['analysis_by_run_dir']
+    subdirs = os.scandir(analysis_by_run_dir)
+    metrics.increment('directories_listed')
+    if run_filter is not None:
+        subdirs = (subdir for subdir in subdirs if run_filter(subdir.name))
 
-        conditions_checked = {
-            "is_directory": subdir.is_dir(),
-            "matches_illumina_run_id_format": ((matches_miseq_regex is not None) or (matches_nextseq_regex is not None)),
-            "not_excluded": not_excluded,
-            "ready_to_collect": ready_to_collect,
-        }
-        conditions_met = list(conditions_checked.values())
-
-        analysis_directory_path = os.path.abspath(subdir.path)
-        analysis_dir = {
-            "path": analysis_directory_path,
-        }
-        if all(conditions_met):
-            logging.info(json.dumps({
-                "event_type": "analysis_directory_found",
-                "sequencing_run_id": run_id,
-                "analysis_directory_path": analysis_directory_path
-            }))
-            
-            yield analysis_dir
-        else:
-            logging.debug(json.dumps({
-                "event_type": "directory_skipped",
-                "analysis_directory_path": os.path.abspath(subdir.path),
-                "conditions_checked": conditions_checked
-            }))
-            yield None
+    def check_subdir(subdir):
+        with metrics.timer('readiness_check'):
+            return check_analysis_dir(config, subdir.path, subdir.is_dir(), check_complete, scan_state, existing_outputs)
+
+    # Runs are checked concurrently (up to `scan_concurrency` at once), which
+    # hides the latency of each stat and listdir on network filesystems.
+    for analysis_dir in async_scan.iter_concurrently(check_subdir, subdirs, async_scan.get_scan_concurrency(config)):
+        yield analysis_dir
 
 
 def get_plate_ids_for_run(run_id, artic_qc_path):
@@ -89,183 +226,530 @@ def get_plate_ids_for_run(run_id, artic_qc_path):
     """
     plate_ids = set()
     run = collections.OrderedDict()
+    num_rows = 0
     with open(artic_qc_path, 'r') as f:
         try:
             next(f)
         except StopIteration as e:
             pass
         for line in f:
+            num_rows += 1
             library_id = line.strip().split(',')[0]
             if not (re.match('POS', library_id) or re.match('NEG', library_id)):
                 plate_id = int(library_id.split('-')[1])
                 plate_ids.add(plate_id)
 
+    metrics.increment('files_parsed')
+    metrics.increment('rows_parsed', num_rows)
     plate_ids = list(plate_ids)
 
     return plate_ids
 
             
-def plates_by_run(config):
+def get_plates_by_run_record(config, run_id, samplesheet_path, sequencer_type, samplesheet_cache=None):
     """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :param samplesheet_path: Path to the samplesheet for the run.
+    :type samplesheet_path: str
+    :param sequencer_type: 'miseq' or 'nextseq'
+    :type sequencer_type: str
+    :param samplesheet_cache: Samplesheet cache
+    :type samplesheet_cache: Optional[dict[str, object]]
+    :return: Plate IDs and sample counts for the run, or None if the run has no plates.
+    :rtype: Optional[dict[str, object]]
+    """
+    run = None
+    num_covid19_production_samples_in_samplesheet = samplesheet.count_covid19_production_samples_in_samplesheet(samplesheet_path, sequencer_type, samplesheet_cache)
+    fastq_input_dir = os.path.join(config['fastq_input_dir'], run_id)
+    fastq_input_paths = glob_paths(os.path.join(fastq_input_dir, '*.fastq.gz'))
+    fastq_input_paths = list(filter(lambda x: not re.match('Undetermined_R[12].fastq.gz', os.path.basename(x)), fastq_input_paths))
+    artic_qc_path = os.path.join(config['analysis_by_run_dir'], run_id, 'ncov2019-artic-nf-v' + config['artic_output_version'] + '-output', run_id + '.qc.csv')
+    metrics.increment('stat_calls')
+    if os.path.isfile(artic_qc_path):
+        plate_ids = get_plate_ids_for_run(run_id, artic_qc_path)
+        if plate_ids:
+            run = collections.OrderedDict()
+            run['run_id'] = run_id
+            run['num_fastq_symlink_pairs'] = int(len(fastq_input_paths) / 2)
+            run['num_covid19_production_samples_in_samplesheet'] = num_covid19_production_samples_in_samplesheet
+            run['plate_ids'] = plate_ids
+
+    return run
+
+
+def get_plates_by_run_fingerprint(config, run_id, samplesheet_path):
+    """
+    Fingerprint the inputs that a run's plates_by_run record is computed from.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :param samplesheet_path: Path to the samplesheet for the run.
+    :type samplesheet_path: str
+    :return: Fingerprint of the fastq input dir, samplesheet and artic QC file, and the version of the samplesheet summary
+    :rtype: dict[str, object]
+    """
+    fastq_input_dir = os.path.join(config['fastq_input_dir'], run_id)
+    artic_qc_path = os.path.join(config['analysis_by_run_dir'], run_id, 'ncov2019-artic-nf-v' + config['artic_output_version'] + '-output', run_id + '.qc.csv')
+    fingerprint = {
+        "fastq_input_dir": state.get_path_fingerprint([fastq_input_dir]),
+        "samplesheet": state.get_file_fingerprint(samplesheet_path),
+        "artic_qc": state.get_file_fingerprint(artic_qc_path),
+        "samplesheet_summary_version": samplesheet.SAMPLESHEET_SUMMARY_VERSION,
+    }
+
+    return fingerprint
+
+
+def plates_by_run(config, sequencer_run_index=None, run_ids=None):
+    """
+    Each run's record is cached (in the state dir) along with a fingerprint
+    of its inputs, and only recomputed when the fingerprint changes.
+
+    If `run_ids` is provided, only those runs are looked up. The records for
+    every other run are taken from the cache as they are, without listing the
+    analysis_by_run_dir or the sequencer output dirs. If there's no cache yet,
+    every run is looked up.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param sequencer_run_index: Sequencer run index from a previous call, refreshed in-place.
+    :type sequencer_run_index: Optional[dict[str, object]]
+    :param run_ids: If provided, only these runs are looked up.
+    :type run_ids: Optional[Iterable[str]]
+    :return: Plate IDs and sample counts for each run.
+    :rtype: list[dict[str, object]]
     """
     logging.info(json.dumps({"event_type": "collect_plates_by_run_start"}))
-    plates_by_run = []
-    all_analysis_dirs = sorted(list(os.listdir(config['analysis_by_run_dir'])))
+    samplesheet_cache = samplesheet.load_samplesheet_cache(config)
+    plates_by_run_cache_path = os.path.join(state.get_state_dir(config), 'plates_by_run_cache.json')
+    previous_plates_by_run_cache = state.load_state(plates_by_run_cache_path)
+    num_records_reused = 0
+    num_records_recomputed = 0
+    if run_ids is not None and not previous_plates_by_run_cache:
+        # Without a cache, there are no records to keep for the other runs
+        logging.info(json.dumps({"event_type": "plates_by_run_cache_not_found", "plates_by_run_cache_file": plates_by_run_cache_path}))
+        run_ids = None
+    if run_ids is None:
+        with metrics.timer('samplesheet_lookup'):
+            sequencer_run_index = samplesheet.index_sequencer_output_dirs(config['sequencer_output_dirs'], sequencer_run_index)
+        plates_by_run_cache = {}
+        all_analysis_dirs = sorted(list(os.listdir(config['analysis_by_run_dir'])))
+        metrics.increment('directories_listed')
+    else:
+        requested_run_ids = set(run_ids)
+        with metrics.timer('samplesheet_lookup'):
+            if sequencer_run_index is None:
+                sequencer_run_index = samplesheet.index_sequencer_runs(config['sequencer_output_dirs'], requested_run_ids)
+            else:
+                sequencer_run_index = samplesheet.index_sequencer_output_dirs(config['sequencer_output_dirs'], sequencer_run_index)
+        plates_by_run_cache = {run_id: cached for run_id, cached in previous_plates_by_run_cache.items() if run_id not in requested_run_ids}
+        all_analysis_dirs = []
+        for run_id in sorted(requested_run_ids):
+            metrics.increment('stat_calls')
+            if os.path.isdir(os.path.join(config['analysis_by_run_dir'], run_id)):
+                all_analysis_dirs.append(run_id)
+            else:
+                logging.warning(json.dumps({"event_type": "analysis_dir_not_found", "run_id": run_id}))
     all_run_ids = filter(lambda x: re.match('\d{6}_[VM]', x) != None, all_analysis_dirs)
-    for run_id in all_run_ids:
-        if run_id in config['excluded_runs']:
-            continue
+    run_ids = [run_id for run_id in all_run_ids if not covid_qc_collector.config.is_run_excluded(config, run_id)]
+
+    def get_run_record(run_id):
+        """
+        :return: Samplesheet path, inputs fingerprint, record, and whether the cached record was reused.
+        """
         sequencer_type = None
         if re.match('\d{6}_M\d{5}_', run_id):
             sequencer_type = 'miseq'
         elif re.match('\d{6}_VH\d{5}_', run_id):
             sequencer_type = 'nextseq'
-        samplesheet_path = samplesheet.find_samplesheet_for_run(run_id, config['sequencer_output_dirs'])
-        if samplesheet_path and sequencer_type:
+        with metrics.timer('samplesheet_lookup'):
+            samplesheet_path = samplesheet.find_samplesheet_for_run(run_id, config['sequencer_output_dirs'], sequencer_run_index)
+        if not (samplesheet_path and sequencer_type):
+            return None, None, None, False
+        fingerprint = get_plates_by_run_fingerprint(config, run_id, samplesheet_path)
+        cached = previous_plates_by_run_cache.get(run_id, None)
+        if cached is not None and cached['fingerprint'] == fingerprint:
+            return samplesheet_path, fingerprint, cached['record'], True
+        run = get_plates_by_run_record(config, run_id, samplesheet_path, sequencer_type, samplesheet_cache)
+
+        return samplesheet_path, fingerprint, run, False
+
+    # Each run's lookups are independent (and only touch that run's entries
+    # in the sequencer run index and samplesheet cache), so they're made
+    # concurrently. Records are still returned in run ID order.
+    run_records = async_scan.iter_concurrently(get_run_record, run_ids, async_scan.get_scan_concurrency(config))
+    for run_id, (samplesheet_path, fingerprint, run, reused) in zip(run_ids, run_records):
+        if samplesheet_path:
             logging.info(json.dumps({
                 "event_type": "found_samplesheet_file",
                 "run_id": run_id,
                 "samplesheet_path": samplesheet_path
             }))
-            num_covid19_production_samples_in_samplesheet = samplesheet.count_covid19_production_samples_in_samplesheet(samplesheet_path, sequencer_type)
-            fastq_input_dir = os.path.join(config['fastq_input_dir'], run_id)
-            fastq_input_paths = glob.glob(os.path.join(fastq_input_dir, '*.fastq.gz'))
-            fastq_input_paths = list(filter(lambda x: not re.match('Undetermined_R[12].fastq.gz', os.path.basename(x)), fastq_input_paths))
-            artic_qc_path = os.path.join(config['analysis_by_run_dir'], run_id, 'ncov2019-artic-nf-v' + config['artic_output_version'] + '-output', run_id + '.qc.csv')
-            if os.path.isfile(artic_qc_path):
-                plate_ids = get_plate_ids_for_run(run_id, artic_qc_path)
-                if plate_ids:
-                    run = collections.OrderedDict()
-                    run['run_id'] = run_id
-                    run['num_fastq_symlink_pairs'] = int(len(fastq_input_paths) / 2)
-                    run['num_covid19_production_samples_in_samplesheet'] = num_covid19_production_samples_in_samplesheet
-                    run['plate_ids'] = plate_ids
-                    plates_by_run.append(run)
+            if reused:
+                num_records_reused += 1
+            else:
+                num_records_recomputed += 1
+            plates_by_run_cache[run_id] = {
+                "fingerprint": fingerprint,
+                "record": run,
+            }
         else:
             logging.error(json.dumps({
                 "event_type": "failed_to_find_samplesheet_file",
                 "run_id": run_id
             }))
 
+    samplesheet.save_samplesheet_cache(config, samplesheet_cache)
+    state.save_state(plates_by_run_cache, plates_by_run_cache_path)
+    plates_by_run = [cached['record'] for run_id, cached in sorted(plates_by_run_cache.items()) if cached['record']]
+
     logging.info(json.dumps({
-        "event_type": "collect_plates_by_run_complete"
+        "event_type": "collect_plates_by_run_complete",
+        "num_records_reused": num_records_reused,
+        "num_records_recomputed": num_records_recomputed,
     }))
 
     return plates_by_run
 
 
-def scan(config: dict[str, object]) -> Iterator[Optional[dict[str, str]]]:
+def load_scan_state(config):
     """
-    Scanning involves looking for all existing runs and...
+    Load the scan state, which records the fingerprint of every run checked
+    by previous scans.
 
     :param config: Application config.
     :type config: dict[str, object]
-    :return: A run directory to analyze, or None
-    :rtype: Iterator[Optional[dict[str, object]]]
+    :return: Scan state
+    :rtype: dict[str, object]
     """
-    logging.info(json.dumps({"event_type": "scan_start"}))
-    for analysis_dir in find_analysis_dirs(config):    
-        yield analysis_dir
+    scan_state_path = os.path.join(state.get_state_dir(config), 'scan_state.json')
+    scan_state = state.load_state(scan_state_path)
+    if 'runs' not in scan_state:
+        scan_state['runs'] = {}
+
+    return scan_state
+
+
+def save_scan_state(config, scan_state):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param scan_state: Scan state
+    :type scan_state: dict[str, object]
+    :return: None
+    :rtype: None
+    """
+    scan_state_path = os.path.join(state.get_state_dir(config), 'scan_state.json')
+    state.save_state(scan_state, scan_state_path)
+    logging.debug(json.dumps({"event_type": "save_scan_state_complete", "scan_state_file": scan_state_path}))
 
 
-def find_latest_artic_output(analysis_dir):
+def recover_interrupted_runs(config):
     """
+    Replay the collection journal, and recover any runs that were being
+    collected when the collector last stopped. Outputs that were completed
+    before the run was interrupted are added to its manifest, so they're not
+    collected again, and any temporary files left behind are removed. The run
+    is then forgotten by the scan state, so that the next scan collects
+    whatever it's missing.
+
+    Journals left by `collect` commands that were killed are recovered too,
+    then removed. Runs that are locked (because a `collect` command is
+    collecting them right now) are left alone.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: IDs of the runs that were interrupted
+    :rtype: list[str]
     """
-    artic_output_dir_glob = "ncov2019-artic-nf-v*-output"
-    artic_output_dirs = glob.glob(os.path.join(analysis_dir, artic_output_dir_glob))
-    latest_artic_output_dir = None
-    if len(artic_output_dirs) > 0:
-        latest_artic_output_dir = os.path.abspath(artic_output_dirs[-1])
+    abandoned_journal_paths = journal.find_abandoned_journals(config)
+    interrupted_runs = journal.replay(config, abandoned_journal_paths)
+    if not interrupted_runs and not abandoned_journal_paths:
+        return []
+
+    recovered_run_ids = []
+    scan_state = load_scan_state(config)
+    for run_id, recorded_outputs in interrupted_runs.items():
+        run_lock = state.acquire_run_lock(config, run_id)
+        if run_lock is None:
+            logging.info(json.dumps({"event_type": "interrupted_run_locked", "run_id": run_id}))
+            continue
+        try:
+            manifest.add_recorded_outputs(config, run_id, recorded_outputs)
+            removed_temp_files = journal.remove_temp_files(config, run_id)
+        finally:
+            state.release_run_lock(run_lock)
+        scan_state['runs'].pop(run_id, None)
+        recovered_run_ids.append(run_id)
+        logging.warning(json.dumps({"event_type": "interrupted_run_recovered", "run_id": run_id, "num_outputs_recovered": len(recorded_outputs), "removed_temp_files": removed_temp_files}))
+    save_scan_state(config, scan_state)
+    for journal_path in abandoned_journal_paths:
+        os.remove(journal_path)
 
-    return latest_artic_output_dir
+    return sorted(recovered_run_ids)
 
 
-def find_latest_ncov_tools_output(artic_output_dir):
+def mark_run_collected(config, scan_state, analysis_dir):
     """
+    Record that a run has been collected, so that later scans can skip it
+    until its fingerprint changes. The run's own output dirs are added to the
+    fingerprint, and its outputs in shared dirs are recorded alongside it,
+    so that the run is collected again if any of its outputs are deleted.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param scan_state: Scan state
+    :type scan_state: dict[str, object]
+    :param analysis_dir: Analysis dir, as produced by `find_analysis_dirs`
+    :type analysis_dir: dict[str, object]
+    :return: None
+    :rtype: None
+    """
+    if analysis_dir.get('fingerprint') is None:
+        return
+    run_id = os.path.basename(analysis_dir['path'])
+    run_output_dirs, shared_output_keys = manifest.get_run_outputs(config, run_id)
+    fingerprint = dict(analysis_dir['fingerprint'])
+    fingerprint.update(state.get_path_fingerprint(run_output_dirs))
+    scan_state['runs'][run_id] = {
+        "fingerprint": fingerprint,
+        "collected": True,
+        "ready": True,
+        "outputs": shared_output_keys,
+    }
+
+
+def scan(config: dict[str, object], scan_state: Optional[dict[str, object]]=None, run_filter=None, existing_outputs=None) -> Iterator[Optional[dict[str, str]]]:
     """
-    ncov_tools_output_dir_glob = "ncov-tools-v*-output"
-    latest_ncov_tools_output_dir = None
-    if artic_output_dir is not None and os.path.exists(artic_output_dir):
-        ncov_tools_output_dirs = glob.glob(os.path.join(artic_output_dir, ncov_tools_output_dir_glob))
-        if len(ncov_tools_output_dirs) > 0:
-            latest_ncov_tools_output_dir = os.path.abspath(ncov_tools_output_dirs[-1])
+    Scanning involves looking for all existing runs and...
 
-    return latest_ncov_tools_output_dir
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param scan_state: Scan state from previous scans, used to skip unchanged runs.
+    :type scan_state: Optional[dict[str, object]]
+    :param run_filter: If provided, only runs whose ID it returns True for are scanned (eg. runs in this instance's shards)
+    :type run_filter: Optional[Callable[[str], bool]]
+    :param existing_outputs: Index of existing outputs, shared by all runs in the scan.
+    :type existing_outputs: Optional[dict[str, object]]
+    :return: A run directory to analyze, or None
+    :rtype: Iterator[Optional[dict[str, object]]]
+    """
+    logging.info(json.dumps({"event_type": "scan_start"}))
+    for analysis_dir in find_analysis_dirs(config, scan_state=scan_state, run_filter=run_filter, existing_outputs=existing_outputs):
+        yield analysis_dir
 
 
-def get_plate_numbers(ncov_tools_output_path):
+def get_amplicon_depth_src_files(ncov_tools_output_path, plate_number, plate):
     """
+    :param ncov_tools_output_path: Path to the latest ncov-tools output for the run.
+    :type ncov_tools_output_path: str
+    :param plate_number: Plate number
+    :type plate_number: str
+    :param plate: Files by subdir for the plate, from the run layout.
+    :type plate: dict[str, set[str]]
+    :return: Paths to the plate's amplicon depth BED files, sorted.
+    :rtype: list[str]
     """
-    plate_numbers = []
-    for plate_path in glob.glob(os.path.join(ncov_tools_output_path, 'by_plate', '*')):
-        plate_number = os.path.basename(plate_path)
-        plate_numbers.append(plate_number)
+    qc_sequencing_dir = os.path.join(ncov_tools_output_path, 'by_plate', plate_number, 'qc_sequencing')
+    amplicon_depth_src_files = [
+        os.path.join(qc_sequencing_dir, filename)
+        for filename in sorted(plate['qc_sequencing'])
+        if filename.endswith('.amplicon_depth.bed')
+    ]
 
-    return plate_numbers
+    return amplicon_depth_src_files
 
 
-def collect_outputs(config: dict[str, object], analysis_dir: Optional[dict[str, str]]):
+def write_run_amplicon_depth(run_id, amplicon_depth_src_files, dst_file, index_dst_file):
+    """
+    Write the amplicon depths for every library on a run to a single NDJSON file,
+    one line per library, in one pass over the amplicon depth BED files. An index
+    with the byte offset and length of each library's line is written alongside,
+    so that a single library can be read without parsing the whole file. The
+    index is keyed by plate number, then library ID, because control libraries
+    (eg. NEG-1-A-H11) can have the same library ID on more than one plate.
+
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :param amplicon_depth_src_files: (plate_number, path) for each amplicon depth BED file.
+    :type amplicon_depth_src_files: list[tuple[str, str]]
+    :param dst_file: Path to write the NDJSON file to.
+    :type dst_file: str
+    :param index_dst_file: Path to write the index to.
+    :type index_dst_file: str
+    :return: Number of libraries written
+    :rtype: int
+    """
+    index = collections.OrderedDict()
+    index['run_id'] = run_id
+    index['amplicon_depth_file'] = os.path.basename(dst_file)
+    index['plates'] = collections.OrderedDict()
+    num_libraries = 0
+    tmp_dst_file = state.get_temp_path(dst_file)
+    with open(tmp_dst_file, 'wb') as f:
+        for plate_number, amplicon_depth_src_file in amplicon_depth_src_files:
+            library_id = os.path.basename(amplicon_depth_src_file).split('.')[0]
+            library = collections.OrderedDict()
+            library['library_id'] = library_id
+            library['plate_number'] = plate_number
+            library['amplicon_depth'] = [record.to_dict() for record in parsers.iter_amplicon_depth_bed(amplicon_depth_src_file)]
+            line = (json.dumps(library, separators=(',', ':')) + '\n').encode('utf-8')
+            index['plates'].setdefault(plate_number, collections.OrderedDict())[library_id] = {
+                "offset": f.tell(),
+                "length": len(line),
+            }
+            f.write(line)
+            num_libraries += 1
+        metrics.increment('bytes_written', f.tell())
+    os.replace(tmp_dst_file, dst_file)
+    state.save_state(index, index_dst_file)
+
+    return num_libraries
+
+
+def collect_outputs(config: dict[str, object], analysis_dir: Optional[dict[str, str]], existing_outputs=None, collection_journal=None):
     """
     
 
     :param config: Application config.
     :type config: dict[str, object]
-    :return: 
-    :rtype: 
+    :param existing_outputs: Index of existing outputs, shared by all runs in a scan. Updated as outputs are written.
+    :type existing_outputs: Optional[dict[str, object]]
+    :param collection_journal: Journal to record the run's progress in, so that it can be resumed if interrupted.
+    :type collection_journal: Optional[dict[str, object]]
+    :return: False if the run has no artic output to collect (only possible if its readiness wasn't checked), otherwise True.
+    :rtype: bool
     """
-    logging.info(json.dumps({"event_type": "collect_outputs_start"}))
     run_id = os.path.basename(analysis_dir['path'])
+    logging.info(json.dumps({"event_type": "collect_outputs_start", "run_id": run_id}))
+
+    # Everything we need to know about the run's analysis dir is taken from
+    # its layout, which is only scanned once.
+    run_layout = analysis_dir.get('layout', None)
+    if run_layout is None:
+        run_layout = layout.scan_run_layout(analysis_dir['path'])
+    if run_layout['latest_artic_output'] is None:
+        # Checked before the run is journaled, so that it isn't mistaken for
+        # an interrupted run.
+        logging.error(json.dumps({"event_type": "artic_output_not_found", "run_id": run_id, "analysis_directory_path": analysis_dir['path']}))
+        return False
+    if run_layout['plates'] is None:
+        layout.scan_plates(run_layout)
+    # Likewise, whether each output already exists is answered by the index.
+    if existing_outputs is None:
+        existing_outputs = output_index.new_output_index()
+
+    # Each output's sources are fingerprinted when it's written, so that
+    # it's regenerated if they change (eg. when the run is re-analyzed).
+    if collection_journal is not None:
+        journal.begin_run(collection_journal, run_id)
+    run_manifest = manifest.load_run_manifest(config, run_id, collection_journal)
+
+    # Sources that are shared by more than one output are only fingerprinted once.
+    src_fingerprints = {}
+
+    output_encoding = writers.get_output_encoding(config)
+
+    latest_artic_output_path = run_layout['latest_artic_output']
+    artic_qc_src_file = os.path.join(latest_artic_output_path, run_id + '.qc.csv')
+    latest_ncov_tools_output_path = run_layout['latest_ncov_tools_output']
+
+    # plate numbers for run
+    plates = run_layout['plates']
+    plate_numbers = list(plates)
+
+    summary_qc_src_files = {}
+    for plate_number in plate_numbers:
+        summary_qc_src_file = os.path.join(
+            latest_ncov_tools_output_path,
+            'by_plate',
+            plate_number,
+            'qc_reports',
+            run_id + '_' + plate_number + '_summary_qc.tsv'
+        )
+        if os.path.basename(summary_qc_src_file) in plates[plate_number]['qc_reports']:
+            summary_qc_src_files[plate_number] = summary_qc_src_file
+
+    # qc-rollups
+    # Rollups are accumulated while the QC files are parsed for their own
+    # outputs. If those outputs are up to date but the rollup isn't, the QC
+    # files are parsed for the rollup alone.
+    qc_rollup_dst_file = os.path.join(rollups.get_rollups_dir(config), writers.get_object_filename(run_id + '_qc_rollup', output_encoding))
+    qc_rollup_src_files = list(summary_qc_src_files.values())
+    if os.path.basename(artic_qc_src_file) in run_layout['artic_output_files']:
+        qc_rollup_src_files.insert(0, artic_qc_src_file)
+    qc_rollup_needed = False
+    if config.get('qc_rollups', True) and qc_rollup_src_files:
+        qc_rollup_src_fingerprint = manifest.get_source_fingerprint(qc_rollup_src_files, src_fingerprints)
+        qc_rollup_needed = not manifest.output_up_to_date(run_manifest, qc_rollup_dst_file, qc_rollup_src_fingerprint, existing_outputs)
+    artic_qc_rollup = rollups.new_artic_qc_rollup()
+    run_summary_qc_rollup = rollups.new_summary_qc_rollup()
+    plate_summary_qc_rollups = {}
 
     # artic-qc
-    latest_artic_output_path = find_latest_artic_output(analysis_dir['path'])
-    artic_qc_src_file = os.path.join(latest_artic_output_path, run_id + '.qc.csv')
-    artic_qc_dst_file = os.path.join(config['output_dir'], "artic-qc", run_id + "_qc.json")
-    if os.path.exists(artic_qc_src_file) and not os.path.exists(artic_qc_dst_file):
-        artic_qc = parsers.parse_artic_qc(artic_qc_src_file, run_id)
-        with open(artic_qc_dst_file, 'w') as f:
-            json.dump(artic_qc, f, indent=2)
+    artic_qc_dst_file = os.path.join(config['output_dir'], "artic-qc", writers.get_output_filename(run_id + "_qc", output_encoding))
+    if os.path.basename(artic_qc_src_file) in run_layout['artic_output_files']:
+        artic_qc_src_fingerprint = manifest.get_source_fingerprint([artic_qc_src_file], src_fingerprints)
+        artic_qc = parsers.iter_artic_qc(artic_qc_src_file, run_id)
+        if qc_rollup_needed:
+            artic_qc = rollups.iter_with_rollups(artic_qc, [artic_qc_rollup], rollups.add_artic_qc_record)
+        if not manifest.output_up_to_date(run_manifest, artic_qc_dst_file, artic_qc_src_fingerprint, existing_outputs):
+            writers.write_records(artic_qc, artic_qc_dst_file, output_encoding)
+            output_index.add(existing_outputs, artic_qc_dst_file)
+            manifest.record_output(run_manifest, artic_qc_dst_file, artic_qc_src_fingerprint)
             logging.info(json.dumps({
                 "event_type": "write_artic_qc_complete",
                 "run_id": run_id,
                 "src_file": artic_qc_src_file,
                 "dst_file": artic_qc_dst_file
             }))
+        elif qc_rollup_needed:
+            # Parsed for the rollup only
+            collections.deque(artic_qc, maxlen=0)
 
     # ncov-tools-plots
-    latest_ncov_tools_output_path = find_latest_ncov_tools_output(latest_artic_output_path)
-
-    # plate numbers for run
-    plate_numbers = get_plate_numbers(latest_ncov_tools_output_path)
+    # The plots are collected first, then transferred concurrently.
+    plot_transfers = []
+    plot_src_fingerprints = {}
 
     # ncov-tools-plots/depth-by-position
     depth_by_position_outdir = os.path.join(config['output_dir'], 'ncov-tools-plots', 'depth-by-position')
     for plate_number in plate_numbers:
         depth_by_position_src_file = os.path.join(latest_ncov_tools_output_path, 'by_plate', plate_number, 'plots', run_id + '_' + plate_number + '_depth_by_position.pdf')
         depth_by_position_dst_file = os.path.join(depth_by_position_outdir, run_id + '_' + plate_number + '_depth_by_position.pdf')
-        if os.path.exists(depth_by_position_src_file) and not os.path.exists(depth_by_position_dst_file):
-            shutil.copyfile(depth_by_position_src_file, depth_by_position_dst_file)
-            logging.info(json.dumps({
+        if os.path.basename(depth_by_position_src_file) not in plates[plate_number]['plots']:
+            continue
+        plot_src_fingerprints[depth_by_position_dst_file] = manifest.get_source_fingerprint([depth_by_position_src_file])
+        if not manifest.output_up_to_date(run_manifest, depth_by_position_dst_file, plot_src_fingerprints[depth_by_position_dst_file], existing_outputs):
+            plot_transfers.append({
                 "event_type": "copy_depth_by_position_file_complete",
                 "run_id": run_id,
                 "plate_number": plate_number,
                 "src_file": depth_by_position_src_file,
                 "dst_file": depth_by_position_dst_file
-            }))
+            })
 
     # ncov-tools-plots/depth-heatmap
-    depth_by_position_outdir = os.path.join(config['output_dir'], 'ncov-tools-plots', 'depth-heatmap')
+    depth_heatmap_outdir = os.path.join(config['output_dir'], 'ncov-tools-plots', 'depth-heatmap')
     for plate_number in plate_numbers:
         depth_heatmap_src_file = os.path.join(latest_ncov_tools_output_path, 'by_plate', plate_number, 'plots', run_id + '_' + plate_number + '_amplicon_coverage_heatmap.pdf')
-        depth_heatmap_dst_file = os.path.join(depth_by_position_outdir, run_id + '_' + plate_number + '_amplicon_coverage_heatmap.pdf')
-        if os.path.exists(depth_heatmap_src_file) and not os.path.exists(depth_heatmap_dst_file):
-            shutil.copyfile(depth_heatmap_src_file, depth_heatmap_dst_file)
-            logging.info(json.dumps({
+        depth_heatmap_dst_file = os.path.join(depth_heatmap_outdir, run_id + '_' + plate_number + '_amplicon_coverage_heatmap.pdf')
+        if os.path.basename(depth_heatmap_src_file) not in plates[plate_number]['plots']:
+            continue
+        plot_src_fingerprints[depth_heatmap_dst_file] = manifest.get_source_fingerprint([depth_heatmap_src_file])
+        if not manifest.output_up_to_date(run_manifest, depth_heatmap_dst_file, plot_src_fingerprints[depth_heatmap_dst_file], existing_outputs):
+            plot_transfers.append({
                 "event_type": "copy_depth_heatmap_file_complete",
                 "run_id": run_id,
                 "plate_number": plate_number,
                 "src_file": depth_heatmap_src_file,
                 "dst_file": depth_heatmap_dst_file
-            }))
+            })
 
     # ncov-tools-plots/tree-snps
     tree_snps_outdir = os.path.join(config['output_dir'], 'ncov-tools-plots', 'tree-snps')
@@ -281,53 +765,119 @@ def collect_outputs(config: dict[str, object], analysis_dir: Optional[dict[str,
             tree_snps_outdir,
             run_id + '_' + plate_number + '_tree_snps.pdf'
         )
-        if os.path.exists(tree_snps_src_file) and not os.path.exists(tree_snps_dst_file):
-            shutil.copyfile(tree_snps_src_file, tree_snps_dst_file)
-            logging.info(json.dumps({
+        if os.path.basename(tree_snps_src_file) not in plates[plate_number]['plots']:
+            continue
+        plot_src_fingerprints[tree_snps_dst_file] = manifest.get_source_fingerprint([tree_snps_src_file])
+        if not manifest.output_up_to_date(run_manifest, tree_snps_dst_file, plot_src_fingerprints[tree_snps_dst_file], existing_outputs):
+            plot_transfers.append({
                 "event_type": "copy_tree_snps_file_complete",
                 "run_id": run_id,
                 "plate_number": plate_number,
                 "src_file": tree_snps_src_file,
                 "dst_file": tree_snps_dst_file
-            }))
+            })
+
+    transfer.transfer_files(
+        plot_transfers,
+        transfer.get_transfer_mode(config),
+        int(config.get('transfer_workers', transfer.DEFAULT_TRANSFER_WORKERS)),
+    )
+    for plot_transfer in plot_transfers:
+        output_index.add(existing_outputs, plot_transfer['dst_file'])
+        manifest.record_output(run_manifest, plot_transfer['dst_file'], plot_src_fingerprints[plot_transfer['dst_file']])
 
     # ncov-tools-qc-sequencing
     qc_sequencing_outdir = os.path.join(config['output_dir'], 'ncov-tools-qc-sequencing', run_id)
-    if not os.path.exists(qc_sequencing_outdir):
-        os.makedirs(qc_sequencing_outdir)
-    for plate_number in plate_numbers:
-        amplicon_depth_files_glob = os.path.join(latest_ncov_tools_output_path, 'by_plate', plate_number, 'qc_sequencing', '*.amplicon_depth.bed')
-        for amplicon_depth_src_file in glob.glob(amplicon_depth_files_glob):
-            library_id = os.path.basename(amplicon_depth_src_file).split('.')[0]
-            amplicon_depth_dst_file = os.path.join(
+    output_index.make_dir(existing_outputs, qc_sequencing_outdir)
+    amplicon_depth_output_mode = config.get('amplicon_depth_output_mode', DEFAULT_AMPLICON_DEPTH_OUTPUT_MODE)
+    if amplicon_depth_output_mode == 'per_run':
+        amplicon_depth_dst_file = os.path.join(qc_sequencing_outdir, run_id + '_amplicon_depth.ndjson')
+        amplicon_depth_index_dst_file = os.path.join(qc_sequencing_outdir, run_id + '_amplicon_depth.index.json')
+        amplicon_depth_src_files = []
+        for plate_number in plate_numbers:
+            for amplicon_depth_src_file in get_amplicon_depth_src_files(latest_ncov_tools_output_path, plate_number, plates[plate_number]):
+                amplicon_depth_src_files.append((plate_number, amplicon_depth_src_file))
+        amplicon_depth_src_fingerprint = manifest.get_source_fingerprint([src_file for _, src_file in amplicon_depth_src_files])
+        if not (manifest.output_up_to_date(run_manifest, amplicon_depth_dst_file, amplicon_depth_src_fingerprint, existing_outputs) and output_index.contains(existing_outputs, amplicon_depth_index_dst_file)):
+            num_libraries = write_run_amplicon_depth(run_id, amplicon_depth_src_files, amplicon_depth_dst_file, amplicon_depth_index_dst_file)
+            output_index.add(existing_outputs, amplicon_depth_dst_file)
+            output_index.add(existing_outputs, amplicon_depth_index_dst_file)
+            manifest.record_output(run_manifest, amplicon_depth_dst_file, amplicon_depth_src_fingerprint)
+            logging.info(json.dumps({"event_type": "run_amplicon_depth_file_complete", "run_id": run_id, "num_libraries": num_libraries, "dst_file": amplicon_depth_dst_file, "index_file": amplicon_depth_index_dst_file}))
+    else:
+        # Control libraries (eg. NEG-1-A-H11) can have the same library ID on
+        # more than one plate. The first plate's is collected.
+        amplicon_depth_dst_files = set()
+        for plate_number in plate_numbers:
+            for amplicon_depth_src_file in get_amplicon_depth_src_files(latest_ncov_tools_output_path, plate_number, plates[plate_number]):
+                library_id = os.path.basename(amplicon_depth_src_file).split('.')[0]
+                amplicon_depth_dst_file = os.path.join(
+                    qc_sequencing_outdir,
+                    writers.get_output_filename(library_id + '_amplicon_depth', output_encoding)
+                )
+                if amplicon_depth_dst_file in amplicon_depth_dst_files:
+                    continue
+                amplicon_depth_dst_files.add(amplicon_depth_dst_file)
+                amplicon_depth_src_fingerprint = manifest.get_source_fingerprint([amplicon_depth_src_file])
+                if not manifest.output_up_to_date(run_manifest, amplicon_depth_dst_file, amplicon_depth_src_fingerprint, existing_outputs):
+                    amplicon_depth = parsers.iter_amplicon_depth_bed(amplicon_depth_src_file)
+                    writers.write_records(amplicon_depth, amplicon_depth_dst_file, output_encoding)
+                    output_index.add(existing_outputs, amplicon_depth_dst_file)
+                    manifest.record_output(run_manifest, amplicon_depth_dst_file, amplicon_depth_src_fingerprint)
+                    logging.info(json.dumps({"event_type": "amplicon_depth_file_complete", "run_id": run_id, "plate_number": plate_number, "library_id": library_id, "src_file": amplicon_depth_src_file, "dst_file": amplicon_depth_dst_file}))
+
+    # Plate depth matrices (amplicon x library)
+    if config.get('amplicon_depth_matrix', False):
+        low_depth_threshold = float(config.get('amplicon_depth_matrix_low_depth_threshold', depth_matrix.DEFAULT_LOW_DEPTH_THRESHOLD))
+        for plate_number in plate_numbers:
+            depth_matrix_src_files = get_amplicon_depth_src_files(latest_ncov_tools_output_path, plate_number, plates[plate_number])
+            if not depth_matrix_src_files:
+                continue
+            depth_matrix_dst_file = os.path.join(
                 qc_sequencing_outdir,
-                library_id + '_amplicon_depth.json'
+                writers.get_object_filename(run_id + '_' + plate_number + '_amplicon_depth_matrix', output_encoding)
             )
-            if not os.path.exists(amplicon_depth_dst_file):
-                amplicon_depth = parsers.parse_amplicon_depth_bed(amplicon_depth_src_file)
-                with open(amplicon_depth_dst_file, 'w') as f:
-                    json.dump(amplicon_depth, f, indent=2)
-                    logging.info(json.dumps({"event_type": "amplicon_depth_file_complete", "run_id": run_id, "plate_number": plate_number, "library_id": library_id, "src_file": amplicon_depth_src_file, "dst_file": amplicon_depth_dst_file}))
-        
-    
+            depth_matrix_src_fingerprint = manifest.get_source_fingerprint(depth_matrix_src_files)
+            if not manifest.output_up_to_date(run_manifest, depth_matrix_dst_file, depth_matrix_src_fingerprint, existing_outputs):
+                plate_depth_matrix = depth_matrix.build_plate_depth_matrix(run_id, plate_number, depth_matrix_src_files, low_depth_threshold)
+                writers.write_object(depth_matrix.to_json_compatible(plate_depth_matrix), depth_matrix_dst_file, output_encoding)
+                output_index.add(existing_outputs, depth_matrix_dst_file)
+                manifest.record_output(run_manifest, depth_matrix_dst_file, depth_matrix_src_fingerprint)
+                logging.info(json.dumps({"event_type": "amplicon_depth_matrix_file_complete", "run_id": run_id, "plate_number": plate_number, "num_libraries": len(plate_depth_matrix['libraries']), "num_amplicons": len(plate_depth_matrix['median_depth']), "dst_file": depth_matrix_dst_file}))
+
     # ncov-tools-qc-summary
     qc_summary_outdir = os.path.join(config['output_dir'], 'ncov-tools-summary')
-    for plate_number in plate_numbers:
-        summary_qc_src_file = os.path.join(
-            latest_ncov_tools_output_path,
-            'by_plate',
-            plate_number,
-            'qc_reports',
-            run_id + '_' + plate_number + '_summary_qc.tsv'
-        )
+    for plate_number, summary_qc_src_file in summary_qc_src_files.items():
         summary_qc_dst_file = os.path.join(
             qc_summary_outdir,
-            run_id + '_' + plate_number + '_summary_qc.json'
+            writers.get_output_filename(run_id + '_' + plate_number + '_summary_qc', output_encoding)
         )
-        if os.path.exists(summary_qc_src_file) and not os.path.exists(summary_qc_dst_file):
-            ncov_tools_summary_qc = parsers.parse_ncov_tools_summary_qc(summary_qc_src_file)
-            with open(summary_qc_dst_file, 'w') as f:
-                json.dump(ncov_tools_summary_qc, f, indent=2)
-                logging.info(json.dumps({"event_type": "ncov-tools_summary_qc_file_complete", "run_id": run_id, "plate_number": plate_number, "src_file": summary_qc_src_file, "dst_file": summary_qc_dst_file}))
-
-    logging.info(json.dumps({"event_type": "collect_outputs_complete"}))
+        summary_qc_src_fingerprint = manifest.get_source_fingerprint([summary_qc_src_file], src_fingerprints)
+        ncov_tools_summary_qc = parsers.iter_ncov_tools_summary_qc(summary_qc_src_file)
+        if qc_rollup_needed:
+            plate_summary_qc_rollups[plate_number] = rollups.new_summary_qc_rollup()
+            ncov_tools_summary_qc = rollups.iter_with_rollups(ncov_tools_summary_qc, [run_summary_qc_rollup, plate_summary_qc_rollups[plate_number]], rollups.add_summary_qc_record)
+        if not manifest.output_up_to_date(run_manifest, summary_qc_dst_file, summary_qc_src_fingerprint, existing_outputs):
+            writers.write_records(ncov_tools_summary_qc, summary_qc_dst_file, output_encoding)
+            output_index.add(existing_outputs, summary_qc_dst_file)
+            manifest.record_output(run_manifest, summary_qc_dst_file, summary_qc_src_fingerprint)
+            logging.info(json.dumps({"event_type": "ncov-tools_summary_qc_file_complete", "run_id": run_id, "plate_number": plate_number, "src_file": summary_qc_src_file, "dst_file": summary_qc_dst_file}))
+        elif qc_rollup_needed:
+            # Parsed for the rollup only
+            collections.deque(ncov_tools_summary_qc, maxlen=0)
+
+    if qc_rollup_needed:
+        run_rollup = rollups.build_run_rollup(run_id, artic_qc_rollup, run_summary_qc_rollup, plate_summary_qc_rollups)
+        writers.write_object(run_rollup, qc_rollup_dst_file, output_encoding)
+        output_index.add(existing_outputs, qc_rollup_dst_file)
+        manifest.record_output(run_manifest, qc_rollup_dst_file, qc_rollup_src_fingerprint)
+        rollups.add_rollup_index_entry(run_rollup, qc_rollup_dst_file)
+        logging.info(json.dumps({"event_type": "qc_rollup_file_complete", "run_id": run_id, "dst_file": qc_rollup_dst_file}))
+
+    manifest.save_run_manifest(run_manifest)
+    if collection_journal is not None:
+        journal.end_run(collection_journal, run_id)
+
+    logging.info(json.dumps({"event_type": "collect_outputs_complete", "run_id": run_id}))
+
+    return True
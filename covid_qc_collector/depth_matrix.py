@@ -0,0 +1,148 @@
+import array
+import math
+import os
+import statistics
+
+import covid_qc_collector.parsers as parsers
+
+# Amplicons with a mean depth below this are counted as dropouts
+DEFAULT_LOW_DEPTH_THRESHOLD = 10.0
+
+
+def get_library_id(amplicon_depth_bed_path):
+    """
+    :param amplicon_depth_bed_path: Path to an amplicon depth BED file (`<library_id>.amplicon_depth.bed`)
+    :type amplicon_depth_bed_path: str
+    :return: Library ID
+    :rtype: str
+    """
+    return os.path.basename(amplicon_depth_bed_path).split('.')[0]
+
+
+def get_amplicon_sort_key(amplicon):
+    """
+    Amplicons are ordered by pool, then by amplicon number. Amplicons with no
+    pool or number (because it was 'NA', or couldn't be parsed) come last.
+
+    :param amplicon: Amplicon depth record
+    :type amplicon: Mapping[str, object]
+    :return: Sort key
+    :rtype: tuple
+    """
+    pool = amplicon['pool']
+    # An amplicon_id of 'NA' is output as `amplicon_id: None`, with no
+    # `amplicon_num` at all.
+    amplicon_num = amplicon.get('amplicon_num', None)
+
+    return (pool is None, pool or 0, amplicon_num is None, amplicon_num or 0)
+
+
+def build_plate_depth_matrix(run_id, plate_number, amplicon_depth_src_files, low_depth_threshold=DEFAULT_LOW_DEPTH_THRESHOLD):
+    """
+    Build a dense matrix of mean amplicon depths for a plate, in one pass over
+    its amplicon depth BED files. Rows are libraries, and columns are
+    amplicons, ordered by pool, then by amplicon number. Each row is an
+    `array.array` of doubles, with NaN for any amplicon missing from a
+    library's BED file.
+
+    Summary statistics for each amplicon across the plate are calculated
+    once the matrix is complete: the median depth, and the fraction of
+    libraries with depth below `low_depth_threshold`.
+
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :param plate_number: Plate number
+    :type plate_number: str
+    :param amplicon_depth_src_files: Paths to the plate's amplicon depth BED files
+    :type amplicon_depth_src_files: list[str]
+    :param low_depth_threshold: Depth below which an amplicon is counted as a dropout
+    :type low_depth_threshold: float
+    :return: Depth matrix
+    :rtype: dict[str, object]
+    """
+    library_ids = []
+    rows = []
+    # Columns are assigned in the order amplicons are first seen, and
+    # reordered by pool once every file has been read.
+    column_by_amplicon = {}
+    amplicons = []
+    for amplicon_depth_src_file in amplicon_depth_src_files:
+        row = array.array('d', [math.nan]) * len(amplicons)
+        for record in parsers.iter_amplicon_depth_bed(amplicon_depth_src_file):
+            amplicon_num = record.get('amplicon_num', None)
+            if amplicon_num is None:
+                # Amplicons with no number are told apart by their position
+                amplicon_key = (record['pool'], None, record['start'], record['end'])
+            else:
+                amplicon_key = (record['pool'], amplicon_num)
+            column = column_by_amplicon.get(amplicon_key, None)
+            if column is None:
+                column = len(amplicons)
+                column_by_amplicon[amplicon_key] = column
+                amplicons.append(record)
+                for previous_row in rows:
+                    previous_row.append(math.nan)
+                row.append(math.nan)
+            # A mean depth of 'NA' is parsed as None
+            mean_depth = record['mean_depth']
+            row[column] = math.nan if mean_depth is None else mean_depth
+        library_ids.append(get_library_id(amplicon_depth_src_file))
+        rows.append(row)
+
+    column_order = sorted(range(len(amplicons)), key=lambda column: get_amplicon_sort_key(amplicons[column]))
+    amplicons = [amplicons[column] for column in column_order]
+    rows = [array.array('d', (row[column] for column in column_order)) for row in rows]
+
+    pools = {}
+    for column, amplicon in enumerate(amplicons):
+        pool = pools.setdefault(str(amplicon['pool']), {"offset": column, "length": 0})
+        pool['length'] += 1
+
+    median_depth = []
+    fraction_below_threshold = []
+    for column in range(len(amplicons)):
+        depths = [row[column] for row in rows if not math.isnan(row[column])]
+        if depths:
+            median_depth.append(statistics.median(depths))
+            fraction_below_threshold.append(sum(1 for depth in depths if depth < low_depth_threshold) / len(depths))
+        else:
+            median_depth.append(None)
+            fraction_below_threshold.append(None)
+
+    depth_matrix = {
+        "run_id": run_id,
+        "plate_number": plate_number,
+        "low_depth_threshold": low_depth_threshold,
+        "libraries": library_ids,
+        "amplicons": {
+            "amplicon_num": [amplicon.get('amplicon_num', None) for amplicon in amplicons],
+            "pool": [amplicon['pool'] for amplicon in amplicons],
+            "start": [amplicon['start'] for amplicon in amplicons],
+            "end": [amplicon['end'] for amplicon in amplicons],
+        },
+        "pools": pools,
+        "mean_depth": rows,
+        "median_depth": median_depth,
+        "fraction_below_threshold": fraction_below_threshold,
+    }
+
+    return depth_matrix
+
+
+def to_json_compatible(depth_matrix):
+    """
+    Convert the matrix rows to lists, with `None` in place of NaN (which
+    isn't valid JSON).
+
+    :param depth_matrix: Depth matrix, as returned by `build_plate_depth_matrix`
+    :type depth_matrix: dict[str, object]
+    :return: Depth matrix, ready to be encoded as JSON
+    :rtype: dict[str, object]
+    """
+    json_compatible_depth_matrix = dict(depth_matrix)
+    json_compatible_depth_matrix['mean_depth'] = [
+        [None if math.isnan(depth) else depth for depth in row]
+        for row in depth_matrix['mean_depth']
+    ]
+
+    return json_compatible_depth_matrix
@@ -0,0 +1,254 @@
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+
+import covid_qc_collector.state as state
+
+JOURNAL_FILENAME = 'journal.ndjson'
+# Journals kept by other processes (eg. the `collect` command) are named
+# `journal.<pid>.ndjson`.
+PROCESS_JOURNAL_GLOB = 'journal.*.ndjson'
+
+
+def get_journal_path(config, pid=None):
+    """
+    The journal is kept in the state dir, so that each instance has its own
+    when sharded.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param pid: If provided, the path to the journal for that process, rather than the daemon's.
+    :type pid: Optional[int]
+    :return: Path to the collection journal.
+    :rtype: str
+    """
+    if pid is not None:
+        return os.path.join(state.get_state_dir(config), 'journal.' + str(pid) + '.ndjson')
+
+    return os.path.join(state.get_state_dir(config), JOURNAL_FILENAME)
+
+
+def open_journal(config, per_process=False):
+    """
+    Open the collection journal for appending. The journal is a write-ahead
+    log of collection progress: a `run_started` entry is written before a
+    run's outputs are collected, an `output_recorded` entry as each output is
+    completed, and a `run_completed` entry once the run's manifest has been
+    saved. Each entry is flushed as soon as it's written, so the journal
+    survives the collector being killed.
+
+    A per-process journal is used by processes that run alongside the daemon
+    (eg. the `collect` command), so that the daemon's checkpoints never
+    truncate their entries. It's locked for as long as it's open, so that
+    it's only replayed once the process that wrote it has exited.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param per_process: Use a journal for this process alone, instead of the daemon's.
+    :type per_process: bool
+    :return: Journal
+    :rtype: dict[str, object]
+    """
+    journal_path = get_journal_path(config, os.getpid() if per_process else None)
+    collection_journal = {
+        "path": journal_path,
+        "file": open(journal_path, 'a'),
+        "lock": threading.Lock(),
+        "per_process": per_process,
+    }
+    if per_process:
+        fcntl.flock(collection_journal['file'], fcntl.LOCK_EX)
+
+    return collection_journal
+
+
+def close_journal(collection_journal):
+    """
+    Close the journal. A per-process journal is removed, because every run
+    it recorded has either completed, or will be recovered from it.
+
+    :param collection_journal: Journal, as returned by `open_journal`
+    :type collection_journal: dict[str, object]
+    :return: None
+    :rtype: None
+    """
+    with collection_journal['lock']:
+        if collection_journal['per_process'] and not replay_journal(collection_journal['path']):
+            os.remove(collection_journal['path'])
+        collection_journal['file'].close()
+
+
+def _append(collection_journal, entry):
+    """
+    Append an entry to the journal, and flush it.
+    """
+    line = json.dumps(entry) + '\n'
+    with collection_journal['lock']:
+        collection_journal['file'].write(line)
+        collection_journal['file'].flush()
+
+
+def begin_run(collection_journal, run_id):
+    """
+    :param collection_journal: Journal, as returned by `open_journal`
+    :type collection_journal: dict[str, object]
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :return: None
+    :rtype: None
+    """
+    _append(collection_journal, {"entry_type": "run_started", "run_id": run_id})
+
+
+def record_output(collection_journal, run_id, output_key, source_fingerprint):
+    """
+    :param collection_journal: Journal, as returned by `open_journal`
+    :type collection_journal: dict[str, object]
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :param output_key: Path to the output, relative to `output_dir`
+    :type output_key: str
+    :param source_fingerprint: Fingerprint of the output's sources
+    :type source_fingerprint: list[Optional[dict[str, object]]]
+    :return: None
+    :rtype: None
+    """
+    _append(collection_journal, {"entry_type": "output_recorded", "run_id": run_id, "output_key": output_key, "sources": source_fingerprint})
+
+
+def end_run(collection_journal, run_id):
+    """
+    :param collection_journal: Journal, as returned by `open_journal`
+    :type collection_journal: dict[str, object]
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :return: None
+    :rtype: None
+    """
+    _append(collection_journal, {"entry_type": "run_completed", "run_id": run_id})
+
+
+def checkpoint(collection_journal):
+    """
+    Empty the journal. Only safe when no runs are being collected, and every
+    completed run's manifest has been saved.
+
+    :param collection_journal: Journal, as returned by `open_journal`
+    :type collection_journal: dict[str, object]
+    :return: None
+    :rtype: None
+    """
+    with collection_journal['lock']:
+        collection_journal['file'].truncate(0)
+
+
+def replay_journal(journal_path):
+    """
+    Read a journal, and find the runs that were started but never completed
+    (because the collector was killed, or collecting them failed).
+
+    :param journal_path: Path to the journal
+    :type journal_path: str
+    :return: For each interrupted run, the outputs that were completed before it was interrupted, with their source fingerprints.
+    :rtype: dict[str, dict[str, list[Optional[dict[str, object]]]]]
+    """
+    interrupted_runs = {}
+    try:
+        with open(journal_path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.decoder.JSONDecodeError as e:
+                    # The last entry may have been cut short
+                    logging.warning(json.dumps({"event_type": "journal_entry_unreadable", "journal_file": journal_path}))
+                    continue
+                if entry['entry_type'] == 'run_started':
+                    interrupted_runs[entry['run_id']] = {}
+                elif entry['entry_type'] == 'output_recorded':
+                    interrupted_runs.setdefault(entry['run_id'], {})[entry['output_key']] = entry['sources']
+                elif entry['entry_type'] == 'run_completed':
+                    interrupted_runs.pop(entry['run_id'], None)
+    except FileNotFoundError as e:
+        pass
+
+    return interrupted_runs
+
+
+def find_abandoned_journals(config):
+    """
+    Find the per-process journals whose process has exited without removing
+    them (because it was killed). A per-process journal is locked by its
+    process while it's running, so one that can be locked is abandoned.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Paths to abandoned journals
+    :rtype: list[str]
+    """
+    abandoned_journal_paths = []
+    for journal_path in sorted(glob.glob(os.path.join(state.get_state_dir(config), PROCESS_JOURNAL_GLOB))):
+        try:
+            with open(journal_path, 'r') as f:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (FileNotFoundError, BlockingIOError) as e:
+            continue
+        abandoned_journal_paths.append(journal_path)
+
+    return abandoned_journal_paths
+
+
+def replay(config, abandoned_journal_paths=None):
+    """
+    Read the journal left by a previous instance (and any abandoned
+    per-process journals), and find the runs that were started but never
+    completed.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param abandoned_journal_paths: Per-process journals to replay, as returned by `find_abandoned_journals`
+    :type abandoned_journal_paths: Optional[list[str]]
+    :return: For each interrupted run, the outputs that were completed before it was interrupted, with their source fingerprints.
+    :rtype: dict[str, dict[str, list[Optional[dict[str, object]]]]]
+    """
+    interrupted_runs = replay_journal(get_journal_path(config))
+    for journal_path in abandoned_journal_paths or []:
+        for run_id, recorded_outputs in replay_journal(journal_path).items():
+            interrupted_runs.setdefault(run_id, {}).update(recorded_outputs)
+
+    return interrupted_runs
+
+
+def remove_temp_files(config, run_id):
+    """
+    Remove any temporary files left behind by outputs that were being written
+    when a run was interrupted. Outputs are always written to a temporary
+    path ending in `.tmp` (see `state.get_temp_path`) and then renamed, so an
+    output is either complete, or a temporary file. The run must be locked
+    (see `state.acquire_run_lock`), so that no other process is writing it.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :return: Paths of the files removed
+    :rtype: list[str]
+    """
+    output_dir = config['output_dir']
+    temp_file_patterns = [
+        os.path.join(output_dir, '*', run_id + '*.tmp'),
+        os.path.join(output_dir, '*', '*', run_id + '*.tmp'),
+        os.path.join(output_dir, 'ncov-tools-qc-sequencing', run_id, '*.tmp'),
+    ]
+    removed_temp_files = []
+    for temp_file_pattern in temp_file_patterns:
+        for temp_file in glob.glob(temp_file_pattern):
+            try:
+                os.remove(temp_file)
+                removed_temp_files.append(temp_file)
+            except FileNotFoundError as e:
+                pass
+
+    return removed_temp_files
@@ -0,0 +1,178 @@
+import fnmatch
+import os
+import re
+
+import covid_qc_collector.metrics as metrics
+
+ARTIC_OUTPUT_DIR_GLOB = "ncov2019-artic-nf-v*-output"
+NCOV_TOOLS_OUTPUT_DIR_GLOB = "ncov-tools-v*-output"
+ANALYSIS_COMPLETE_FILE = 'analysis_complete.json'
+
+# Subdirs of each `by_plate/<plate_number>` dir that outputs are collected from
+PLATE_SUBDIRS = [
+    'plots',
+    'qc_sequencing',
+    'qc_reports',
+]
+
+
+def natural_sort_key(name):
+    """
+    Sort key that compares each run of digits numerically, so that versioned
+    output dirs are ordered by version (`ncov-tools-v1.10-output` sorts after
+    `ncov-tools-v1.9-output`), and plate `10` sorts after plate `9`.
+
+    :param name: Name of the file or dir
+    :type name: str
+    :return: Sort key
+    :rtype: tuple
+    """
+    # Splitting on a capture group alternates non-digit and digit parts,
+    # so parts at the same position are always of the same type.
+    parts = re.split('(\\d+)', name)
+    key = tuple(int(part) if i % 2 else part for i, part in enumerate(parts))
+
+    return key
+
+
+def _list_dir(path):
+    """
+    List a directory, as a dict of DirEntry by name. A missing directory is treated as empty.
+    """
+    entries = {}
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                entries[entry.name] = entry
+    except (FileNotFoundError, NotADirectoryError) as e:
+        pass
+    metrics.increment('directories_listed')
+
+    return entries
+
+
+def _find_latest_output_dir(entries, output_dir_glob):
+    """
+    :return: Names of the matching output dirs, in version order, and the latest one (or None).
+    :rtype: tuple[list[str], Optional[str]]
+    """
+    output_dir_names = sorted(
+        (name for name, entry in entries.items() if fnmatch.fnmatch(name, output_dir_glob) and entry.is_dir()),
+        key=natural_sort_key,
+    )
+    latest_output_dir_name = None
+    if output_dir_names:
+        latest_output_dir_name = output_dir_names[-1]
+
+    return output_dir_names, latest_output_dir_name
+
+
+def scan_run_layout(analysis_dir_path):
+    """
+    Walk the top levels of a run's analysis dir, recording the artic and
+    ncov-tools output dirs (ordered by version), the files in the latest
+    of each, and whether their analyses are complete. The per-plate
+    contents of the ncov-tools output are added by `scan_plates`.
+
+    :param analysis_dir_path: Path to the analysis dir for a run.
+    :type analysis_dir_path: str
+    :return: Run layout
+    :rtype: dict[str, object]
+    """
+    layout = {
+        "path": analysis_dir_path,
+        "artic_output_dirs": [],
+        "latest_artic_output": None,
+        "artic_output_files": set(),
+        "artic_analysis_complete": False,
+        "ncov_tools_output_dirs": [],
+        "latest_ncov_tools_output": None,
+        "ncov_tools_analysis_complete": False,
+        "plates": None,
+    }
+    run_entries = _list_dir(analysis_dir_path)
+    layout['artic_output_dirs'], latest_artic_output_name = _find_latest_output_dir(run_entries, ARTIC_OUTPUT_DIR_GLOB)
+    if latest_artic_output_name is None:
+        return layout
+
+    latest_artic_output = os.path.join(analysis_dir_path, latest_artic_output_name)
+    layout['latest_artic_output'] = latest_artic_output
+    artic_output_entries = _list_dir(latest_artic_output)
+    layout['artic_output_files'] = {name for name, entry in artic_output_entries.items() if not entry.is_dir()}
+    layout['artic_analysis_complete'] = ANALYSIS_COMPLETE_FILE in layout['artic_output_files']
+    layout['ncov_tools_output_dirs'], latest_ncov_tools_output_name = _find_latest_output_dir(artic_output_entries, NCOV_TOOLS_OUTPUT_DIR_GLOB)
+    if latest_ncov_tools_output_name is None:
+        return layout
+
+    latest_ncov_tools_output = os.path.join(latest_artic_output, latest_ncov_tools_output_name)
+    layout['latest_ncov_tools_output'] = latest_ncov_tools_output
+    ncov_tools_output_entries = _list_dir(latest_ncov_tools_output)
+    layout['ncov_tools_analysis_complete'] = ANALYSIS_COMPLETE_FILE in ncov_tools_output_entries
+
+    return layout
+
+
+def scan_plates(layout):
+    """
+    Add the plates in the latest ncov-tools output, and the files in each
+    of their PLATE_SUBDIRS, to a run layout.
+
+    :param layout: Run layout, as produced by `scan_run_layout`. Updated in-place.
+    :type layout: dict[str, object]
+    :return: Files by subdir, by plate number
+    :rtype: dict[str, dict[str, set[str]]]
+    """
+    plates = {}
+    if layout['latest_ncov_tools_output'] is not None:
+        by_plate_dir = os.path.join(layout['latest_ncov_tools_output'], 'by_plate')
+        plate_entries_by_number = _list_dir(by_plate_dir)
+        for plate_number in sorted(plate_entries_by_number, key=natural_sort_key):
+            plate_entry = plate_entries_by_number[plate_number]
+            if not plate_entry.is_dir():
+                continue
+            plate_entries = _list_dir(plate_entry.path)
+            plate = {}
+            for subdir in PLATE_SUBDIRS:
+                plate[subdir] = set()
+                if subdir in plate_entries and plate_entries[subdir].is_dir():
+                    plate[subdir] = set(_list_dir(plate_entries[subdir].path))
+            plates[plate_number] = plate
+    layout['plates'] = plates
+
+    return plates
+
+
+def get_fingerprint_paths(layout):
+    """
+    If the layout's plates have been scanned (see `scan_plates`), the
+    `by_plate` dir, each plate's dir and PLATE_SUBDIRS, and each plate's
+    summary QC file are included too. Dir mtimes only change when files are
+    added, removed or replaced, so the artic and summary QC files are
+    included to catch them being rewritten in-place.
+
+    :param layout: Run layout, as produced by `scan_run_layout`
+    :type layout: dict[str, object]
+    :return: The run dir, the latest artic and ncov-tools output dirs, their `analysis_complete.json` markers, the artic QC file, and the plate dirs.
+    :rtype: list[str]
+    """
+    run_id = os.path.basename(layout['path'])
+    fingerprint_paths = [layout['path']]
+    for output_dir in [layout['latest_artic_output'], layout['latest_ncov_tools_output']]:
+        if output_dir is not None:
+            fingerprint_paths.append(output_dir)
+            fingerprint_paths.append(os.path.join(output_dir, ANALYSIS_COMPLETE_FILE))
+    if layout['latest_artic_output'] is not None:
+        fingerprint_paths.append(os.path.join(layout['latest_artic_output'], run_id + '.qc.csv'))
+    if layout['latest_ncov_tools_output'] is not None and layout['plates'] is not None:
+        by_plate_dir = os.path.join(layout['latest_ncov_tools_output'], 'by_plate')
+        fingerprint_paths.append(by_plate_dir)
+        for plate_number, plate in layout['plates'].items():
+            plate_dir = os.path.join(by_plate_dir, plate_number)
+            fingerprint_paths.append(plate_dir)
+            for subdir in PLATE_SUBDIRS:
+                fingerprint_paths.append(os.path.join(plate_dir, subdir))
+            summary_qc_filename = run_id + '_' + plate_number + '_summary_qc.tsv'
+            if summary_qc_filename in plate['qc_reports']:
+                fingerprint_paths.append(os.path.join(plate_dir, 'qc_reports', summary_qc_filename))
+
+    return fingerprint_paths
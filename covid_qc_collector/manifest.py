@@ -0,0 +1,207 @@
+import json
+import logging
+import os
+
+import covid_qc_collector.journal as journal
+import covid_qc_collector.output_index as output_index
+import covid_qc_collector.state as state
+
+
+def get_manifests_dir(config):
+    """
+    Manifests describe the contents of the output dir, so they're kept
+    alongside it, where every instance can see them (when sharded).
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Path to the dir where run manifests are kept.
+    :rtype: str
+    """
+    manifests_dir = os.path.join(config['output_dir'], '.manifests')
+
+    return manifests_dir
+
+
+def load_run_manifest(config, run_id, collection_journal=None):
+    """
+    Load the manifest of outputs that have been collected for a run. The
+    manifest records the size and mtime of the source files that each output
+    was generated from, keyed by the output's path, relative to `output_dir`.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :param collection_journal: If provided, each output is also written to the journal as it's recorded, so that it isn't lost if the collector is killed before the manifest is saved.
+    :type collection_journal: Optional[dict[str, object]]
+    :return: Run manifest
+    :rtype: dict[str, object]
+    """
+    run_manifest_path = os.path.join(get_manifests_dir(config), run_id + '.json')
+    run_manifest = state.load_state(run_manifest_path)
+    run_manifest.setdefault('outputs', {})
+    run_manifest['run_id'] = run_id
+    run_manifest['journal'] = collection_journal
+    run_manifest['path'] = run_manifest_path
+    run_manifest['output_dir'] = config['output_dir']
+    run_manifest['changed'] = False
+
+    return run_manifest
+
+
+def save_run_manifest(run_manifest):
+    """
+    Write the run manifest, if any outputs have been recorded since it was loaded.
+
+    :param run_manifest: Run manifest, as returned by `load_run_manifest`
+    :type run_manifest: dict[str, object]
+    :return: None
+    :rtype: None
+    """
+    if not run_manifest['changed']:
+        return
+    os.makedirs(os.path.dirname(run_manifest['path']), exist_ok=True)
+    state.save_state({"outputs": run_manifest['outputs']}, run_manifest['path'])
+    run_manifest['changed'] = False
+
+
+def get_source_fingerprint(src_files, fingerprint_cache=None):
+    """
+    :param src_files: Paths to the source files that an output is generated from.
+    :type src_files: list[str]
+    :param fingerprint_cache: File fingerprints by path, for sources that are shared by several outputs. Updated with any new fingerprints.
+    :type fingerprint_cache: Optional[dict[str, Optional[dict[str, object]]]]
+    :return: Path, size and mtime of each source file (None for any that don't exist).
+    :rtype: list[Optional[dict[str, object]]]
+    """
+    if fingerprint_cache is None:
+        fingerprint_cache = {}
+    source_fingerprint = []
+    for src_file in src_files:
+        if src_file not in fingerprint_cache:
+            fingerprint_cache[src_file] = state.get_file_fingerprint(src_file)
+        source_fingerprint.append(fingerprint_cache[src_file])
+
+    return source_fingerprint
+
+
+def get_run_outputs(config, run_id):
+    """
+    Find what to check so that deleting any of a run's outputs can be
+    noticed without a stat per output: each dir that only holds this run's
+    outputs (eg. `ncov-tools-qc-sequencing/<run_id>`), whose mtime changes
+    if any output in it is deleted, and the outputs in dirs shared with
+    other runs, which can be looked up in the output index (one listing of
+    each shared dir per scan).
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :return: Paths to the run's own output dirs, and the keys (relative to `output_dir`) of its outputs in shared dirs.
+    :rtype: tuple[list[str], list[str]]
+    """
+    run_manifest = load_run_manifest(config, run_id)
+    run_output_dirs = set()
+    shared_output_keys = []
+    for output_key in run_manifest['outputs']:
+        output_dir = os.path.dirname(os.path.join(config['output_dir'], output_key))
+        if os.path.basename(output_dir) == run_id:
+            run_output_dirs.add(output_dir)
+        else:
+            shared_output_keys.append(output_key)
+
+    return sorted(run_output_dirs), sorted(shared_output_keys)
+
+
+def outputs_exist(config, output_keys, existing_outputs):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param output_keys: Keys of outputs (relative to `output_dir`), as returned by `get_run_outputs`
+    :type output_keys: list[str]
+    :param existing_outputs: Output index
+    :type existing_outputs: dict[str, object]
+    :return: True if every output is in the output index.
+    :rtype: bool
+    """
+    return all(output_index.contains(existing_outputs, os.path.join(config['output_dir'], output_key)) for output_key in output_keys)
+
+
+def record_output(run_manifest, dst_file, source_fingerprint):
+    """
+    Record that an output has been generated from sources with the given fingerprint.
+
+    :param run_manifest: Run manifest, as returned by `load_run_manifest`
+    :type run_manifest: dict[str, object]
+    :param dst_file: Path to the output
+    :type dst_file: str
+    :param source_fingerprint: Fingerprint of the output's sources, as returned by `get_source_fingerprint`
+    :type source_fingerprint: list[Optional[dict[str, object]]]
+    :return: None
+    :rtype: None
+    """
+    output_key = os.path.relpath(dst_file, run_manifest['output_dir'])
+    run_manifest['outputs'][output_key] = {"sources": source_fingerprint}
+    run_manifest['changed'] = True
+    if run_manifest['journal'] is not None:
+        journal.record_output(run_manifest['journal'], run_manifest['run_id'], output_key, source_fingerprint)
+
+
+def add_recorded_outputs(config, run_id, recorded_outputs):
+    """
+    Add outputs recovered from the journal to a run's manifest, and save it.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :param recorded_outputs: Source fingerprints by output path (relative to `output_dir`), as returned by `journal.replay`
+    :type recorded_outputs: dict[str, list[Optional[dict[str, object]]]]
+    :return: None
+    :rtype: None
+    """
+    run_manifest = load_run_manifest(config, run_id)
+    for output_key, source_fingerprint in recorded_outputs.items():
+        run_manifest['outputs'][output_key] = {"sources": source_fingerprint}
+        run_manifest['changed'] = True
+    save_run_manifest(run_manifest)
+
+
+def output_up_to_date(run_manifest, dst_file, source_fingerprint, existing_outputs):
+    """
+    Check whether an output needs to be (re-)generated. It does if it doesn't
+    exist, or if any of its sources have been replaced or modified since it
+    was generated (eg. because the run was re-analyzed).
+
+    Outputs that exist but aren't in the manifest were collected before
+    manifests were kept. They're assumed to be up to date, and are recorded
+    with their current sources, so that upgrading doesn't trigger a full
+    re-collection.
+
+    :param run_manifest: Run manifest, as returned by `load_run_manifest`
+    :type run_manifest: dict[str, object]
+    :param dst_file: Path to the output
+    :type dst_file: str
+    :param source_fingerprint: Current fingerprint of the output's sources, as returned by `get_source_fingerprint`
+    :type source_fingerprint: list[Optional[dict[str, object]]]
+    :param existing_outputs: Output index
+    :type existing_outputs: dict[str, object]
+    :return: True if the output exists and was generated from the current sources.
+    :rtype: bool
+    """
+    if not output_index.contains(existing_outputs, dst_file):
+        return False
+
+    output_key = os.path.relpath(dst_file, run_manifest['output_dir'])
+    recorded_output = run_manifest['outputs'].get(output_key, None)
+    if recorded_output is None:
+        logging.debug(json.dumps({"event_type": "existing_output_adopted", "dst_file": dst_file}))
+        record_output(run_manifest, dst_file, source_fingerprint)
+        return True
+
+    if recorded_output['sources'] != source_fingerprint:
+        logging.info(json.dumps({"event_type": "output_sources_changed", "dst_file": dst_file, "previous_sources": recorded_output['sources'], "current_sources": source_fingerprint}))
+        return False
+
+    return True
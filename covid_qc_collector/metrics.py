@@ -0,0 +1,147 @@
+import contextlib
+import os
+import threading
+import time
+
+# Counters that are tracked for every scan, and cumulatively for the lifetime of the process.
+COUNTERS = [
+    'directories_listed',
+    'stat_calls',
+    'files_parsed',
+    'rows_parsed',
+    'bytes_copied',
+    'bytes_written',
+]
+
+PROMETHEUS_METRIC_PREFIX = 'covid_qc_collector'
+
+_lock = threading.Lock()
+_scan_counters = dict.fromkeys(COUNTERS, 0)
+_total_counters = dict.fromkeys(COUNTERS, 0)
+_phase_seconds = {}
+_run_seconds = {}
+
+
+def increment(counter, amount=1):
+    """
+    :param counter: One of COUNTERS
+    :type counter: str
+    :param amount: Amount to increment the counter by.
+    :type amount: int
+    :return: None
+    :rtype: None
+    """
+    with _lock:
+        _scan_counters[counter] += amount
+        _total_counters[counter] += amount
+
+
+@contextlib.contextmanager
+def timer(phase, run_id=None):
+    """
+    Time a block of code, adding its duration to the total for `phase` (and
+    for `run_id`, if provided). Phases may be nested, and the same phase may
+    be timed many times per scan, possibly from several threads at once.
+
+    :param phase: Name of the phase being timed.
+    :type phase: str
+    :param run_id: Sequencing run ID, if the block is for a single run.
+    :type run_id: Optional[str]
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration_seconds = time.perf_counter() - start
+        with _lock:
+            _phase_seconds[phase] = _phase_seconds.get(phase, 0.0) + duration_seconds
+            if run_id is not None:
+                _run_seconds[run_id] = _run_seconds.get(run_id, 0.0) + duration_seconds
+
+
+def get_total_counters():
+    """
+    :return: Counters since the process was started.
+    :rtype: dict[str, int]
+    """
+    with _lock:
+        total_counters = dict(_total_counters)
+
+    return total_counters
+
+
+def end_scan(scan_duration_seconds):
+    """
+    Take the metrics recorded since the end of the previous scan, and reset
+    them for the next scan. Cumulative counters are not reset.
+
+    :param scan_duration_seconds: Duration of the scan that just completed.
+    :type scan_duration_seconds: float
+    :return: Scan metrics
+    :rtype: dict[str, object]
+    """
+    with _lock:
+        scan_metrics = {
+            "scan_duration_seconds": scan_duration_seconds,
+            "phase_seconds": {phase: round(seconds, 6) for phase, seconds in _phase_seconds.items()},
+            "run_seconds": {run_id: round(seconds, 6) for run_id, seconds in _run_seconds.items()},
+            "counters": dict(_scan_counters),
+            "total_counters": dict(_total_counters),
+        }
+        for counter in COUNTERS:
+            _scan_counters[counter] = 0
+        _phase_seconds.clear()
+        _run_seconds.clear()
+
+    return scan_metrics
+
+
+def format_prometheus(scan_metrics):
+    """
+    Format scan metrics in the Prometheus text exposition format.
+
+    :param scan_metrics: Scan metrics, as produced by `end_scan`
+    :type scan_metrics: dict[str, object]
+    :return: Metrics in Prometheus text format
+    :rtype: str
+    """
+    lines = []
+    metric_name = PROMETHEUS_METRIC_PREFIX + '_last_scan_duration_seconds'
+    lines.append('# HELP ' + metric_name + ' Duration of the last scan.')
+    lines.append('# TYPE ' + metric_name + ' gauge')
+    lines.append(metric_name + ' ' + repr(float(scan_metrics['scan_duration_seconds'])))
+
+    metric_name = PROMETHEUS_METRIC_PREFIX + '_last_scan_phase_seconds'
+    lines.append('# HELP ' + metric_name + ' Time spent in each phase during the last scan.')
+    lines.append('# TYPE ' + metric_name + ' gauge')
+    for phase, seconds in sorted(scan_metrics['phase_seconds'].items()):
+        lines.append(metric_name + '{phase="' + phase + '"} ' + repr(float(seconds)))
+
+    for counter in COUNTERS:
+        metric_name = PROMETHEUS_METRIC_PREFIX + '_last_scan_' + counter
+        lines.append('# TYPE ' + metric_name + ' gauge')
+        lines.append(metric_name + ' ' + str(scan_metrics['counters'][counter]))
+        metric_name = PROMETHEUS_METRIC_PREFIX + '_' + counter + '_total'
+        lines.append('# TYPE ' + metric_name + ' counter')
+        lines.append(metric_name + ' ' + str(scan_metrics['total_counters'][counter]))
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_prometheus_textfile(scan_metrics, textfile_path):
+    """
+    Write scan metrics to a file for the node_exporter textfile collector.
+
+    :param scan_metrics: Scan metrics, as produced by `end_scan`
+    :type scan_metrics: dict[str, object]
+    :param textfile_path: Path to write to. Should end in `.prom`
+    :type textfile_path: str
+    :return: None
+    :rtype: None
+    """
+    # Imported here, because state imports metrics
+    import covid_qc_collector.state as state
+    tmp_textfile_path = state.get_temp_path(textfile_path)
+    with open(tmp_textfile_path, 'w') as f:
+        f.write(format_prometheus(scan_metrics))
+    os.replace(tmp_textfile_path, textfile_path)
@@ -0,0 +1,90 @@
+import os
+import threading
+
+import covid_qc_collector.metrics as metrics
+
+
+def new_output_index():
+    """
+    Create an empty index of the files that exist in the output dir. Each
+    dir is listed the first time a path in it is looked up, and never again
+    for the lifetime of the index, so a new index should be created for
+    each scan. The index may be shared between threads.
+
+    :return: Output index
+    :rtype: dict[str, object]
+    """
+    existing_outputs = {
+        "dirs": {},
+        "lock": threading.Lock(),
+    }
+
+    return existing_outputs
+
+
+def _get_dir_entries(existing_outputs, dir_path):
+    """
+    :return: Names of the entries in `dir_path` (empty if it doesn't exist), listing it if it hasn't been listed yet.
+    :rtype: set[str]
+    """
+    with existing_outputs['lock']:
+        if dir_path not in existing_outputs['dirs']:
+            try:
+                entries = set(os.listdir(dir_path))
+            except (FileNotFoundError, NotADirectoryError) as e:
+                entries = set()
+            metrics.increment('directories_listed')
+            existing_outputs['dirs'][dir_path] = entries
+
+        return existing_outputs['dirs'][dir_path]
+
+
+def contains(existing_outputs, path):
+    """
+    :param existing_outputs: Output index
+    :type existing_outputs: dict[str, object]
+    :param path: Path to an output file or dir
+    :type path: str
+    :return: True if the path existed when its dir was listed, or has been added since.
+    :rtype: bool
+    """
+    dir_path, name = os.path.split(path)
+
+    return name in _get_dir_entries(existing_outputs, dir_path)
+
+
+def add(existing_outputs, path):
+    """
+    Record that an output has been written.
+
+    :param existing_outputs: Output index
+    :type existing_outputs: dict[str, object]
+    :param path: Path to the output file or dir
+    :type path: str
+    :return: None
+    :rtype: None
+    """
+    dir_path, name = os.path.split(path)
+    entries = _get_dir_entries(existing_outputs, dir_path)
+    with existing_outputs['lock']:
+        entries.add(name)
+
+
+def make_dir(existing_outputs, dir_path):
+    """
+    Create an output dir, if it isn't already in the index.
+
+    :param existing_outputs: Output index
+    :type existing_outputs: dict[str, object]
+    :param dir_path: Path to the output dir
+    :type dir_path: str
+    :return: None
+    :rtype: None
+    """
+    if contains(existing_outputs, dir_path):
+        return
+    os.makedirs(dir_path, exist_ok=True)
+    add(existing_outputs, dir_path)
+    # A dir that was just created is empty, so it never needs to be listed.
+    with existing_outputs['lock']:
+        existing_outputs['dirs'].setdefault(dir_path, set())
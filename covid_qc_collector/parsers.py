@@ -1,101 +1,334 @@
 import collections
+import collections.abc
 import re
 import csv
 
+import covid_qc_collector.metrics as metrics
+
+# Each QC format is described by a schema: the columns to read (in output
+# order), and how to convert each one. A column may have:
+#
+#   'type':   A function used to convert the value. If it raises a
+#             ValueError, the output value is None. Defaults to str.
+#   'rename': The output key, if different from the column name.
+#   'derive': A function (record, value, context) that adds one or more
+#             output fields to the record, in place of 'type' and 'rename'.
+#   'drop':   If True, the column isn't included in the output.
+#
+# In every case, a value of 'NA' is output as None, under the column name.
+#
+# Schemas are compiled against the header of each file into a tuple of
+# (column_index, name, key, converter, derive) per column, which each row is
+# converted by in a single loop. Each row is output as a Record.
+
+DIGITS_REGEX = re.compile("\\d+")
+CONTROL_LIBRARY_ID_WITH_DATE_REGEX = re.compile("\\w{3}\\d{8}-nCoVWGS-\\d+-\\w+")
+CONTROL_LIBRARY_ID_REGEX = re.compile("\\w{3}\\d+-\\d+-\\w+-\\w+")
+
+
+def _get_plate_id_from_artic_library_id(library_id):
+    """
+    """
+    plate_id = None
+    if library_id.startswith('POS') or library_id.startswith('NEG'):
+        # Format like POSYYYYMMDD-nCoVWGS-1-A or NEGYYYYMMDD-nCoVWGS-1-A
+        if CONTROL_LIBRARY_ID_WITH_DATE_REGEX.match(library_id):
+            try:
+                plate_id = DIGITS_REGEX.search(library_id.split('-')[2]).group(0)
+            except AttributeError as e:
+                pass
+        # Format like POSNN-1-A-A01 or NEGNN-1-A-B01
+        elif CONTROL_LIBRARY_ID_REGEX.match(library_id):
+            try:
+                plate_id = DIGITS_REGEX.search(library_id.split('-')[1]).group(0)
+            except AttributeError as e:
+                pass
+    else:
+        try:
+            plate_id = DIGITS_REGEX.search(library_id.split('-')[1]).group(0)
+        except (AttributeError, IndexError) as e:
+            pass
+
+    return plate_id
+
+
+def _derive_artic_library_fields(record, library_id, context):
+    """
+    """
+    record['library_id'] = library_id
+    plate_id = _get_plate_id_from_artic_library_id(library_id)
+    if plate_id:
+        record['plate_id'] = int(plate_id)
+    record['run_id'] = context['run_id']
+
+
+def _derive_genome_completeness(record, pct_covered_bases, context):
+    """
+    """
+    try:
+        record['genome_completeness'] = float(pct_covered_bases)
+    except ValueError as e:
+        record['pct_covered_bases'] = None
+
+
+def _derive_plate_and_run_id(record, run_name, context):
+    """
+    """
+    record['plate_id'] = int(run_name.split('_')[-1])
+    record['run_id'] = '_'.join(run_name.split('_')[0:-1])
+
+
+def _derive_amplicon_num(record, amplicon_id, context):
+    """
+    """
+    try:
+        record['amplicon_num'] = int(amplicon_id.split('_')[-1])
+    except ValueError as e:
+        record['amplicon_num'] = None
+
+
+def _split_on_comma(value):
+    """
+    """
+    return value.split(',')
+
+
+ARTIC_QC_SCHEMA = {
+    'dialect': 'excel',
+    'columns': [
+        {'name': 'sample_name',       'derive': _derive_artic_library_fields},
+        {'name': 'pct_N_bases',       'drop': True},
+        {'name': 'pct_covered_bases', 'derive': _derive_genome_completeness},
+        {'name': 'longest_no_N_run',  'type': int},
+        {'name': 'num_aligned_reads', 'type': int},
+        {'name': 'fasta'},
+        {'name': 'bam'},
+        {'name': 'qc_pass',           'drop': True},
+    ],
+}
+
+NCOV_TOOLS_SUMMARY_QC_SCHEMA = {
+    'dialect': 'excel-tab',
+    'columns': [
+        {'name': 'sample',                     'rename': 'library_id'},
+        {'name': 'run_name',                   'derive': _derive_plate_and_run_id},
+        {'name': 'num_consensus_snvs',         'type': int},
+        {'name': 'num_consensus_n',            'type': int},
+        {'name': 'num_consensus_iupac',        'type': int},
+        {'name': 'num_variants_snvs',          'type': int},
+        {'name': 'num_variants_indel',         'type': int},
+        {'name': 'num_variants_indel_triplet', 'type': int},
+        {'name': 'mean_sequencing_depth',      'type': float},
+        {'name': 'median_sequencing_depth',    'type': int},
+        {'name': 'qpcr_ct',                    'type': float},
+        {'name': 'collection_date'},
+        {'name': 'num_weeks',                  'type': int},
+        {'name': 'scaled_variants_snvs',       'type': float},
+        {'name': 'genome_completeness',        'type': float},
+        {'name': 'qc_pass',                    'type': _split_on_comma},
+        {'name': 'lineage'},
+        {'name': 'lineage_notes'},
+        {'name': 'watch_mutations'},
+    ],
+}
+
+AMPLICON_DEPTH_BED_SCHEMA = {
+    'dialect': 'excel-tab',
+    'columns': [
+        {'name': 'reference_name', 'drop': True},
+        {'name': 'start',          'type': int},
+        {'name': 'end',            'type': int},
+        {'name': 'amplicon_id',    'derive': _derive_amplicon_num},
+        {'name': 'pool',           'type': int},
+        {'name': 'strand'},
+        {'name': 'mean_depth',     'type': float},
+    ],
+}
+
+
+class Record(collections.abc.Mapping):
+    """
+    A parsed row: a read-only mapping of field names to values, in the same
+    order they were added by the row converter. Records are much smaller
+    than dicts, because the field names (and their positions) are shared by
+    every record with the same fields, so only the values are stored per
+    record. Use `to_dict` to convert a record for JSON serialization.
+    """
+    __slots__ = ('_index', '_values')
+
+    def __init__(self, index, values):
+        self._index = index
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._index[key]]
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return 'Record(' + repr(self.to_dict()) + ')'
+
+    def to_dict(self):
+        """
+        :return: The record's fields, as a dict.
+        :rtype: dict[str, object]
+        """
+        return dict(zip(self._index, self._values))
+
+
+# Field positions, by field names, shared by every record with the same fields
+_record_field_indexes = {}
+
+
+def _make_record(fields):
+    """
+    :param fields: Field values, by name
+    :type fields: dict[str, object]
+    :return: Record with the same fields and values
+    :rtype: Record
+    """
+    names = tuple(fields)
+    index = _record_field_indexes.get(names, None)
+    if index is None:
+        index = _record_field_indexes.setdefault(names, {name: position for position, name in enumerate(names)})
+
+    return Record(index, tuple(fields.values()))
+
+
+# Compiled columns, by schema and header
+_compiled_schemas = {}
+
+
+def _compile_column(index, column):
+    """
+    Precompute how a single column of a row is converted.
+
+    :return: (column_index, name, key, convert, derive). `key` is None if the column is dropped, and `convert` is None if the value is output as-is.
+    :rtype: tuple[int, str, Optional[str], Optional[Callable[[str], object]], Optional[Callable[[dict[str, object], str, dict[str, object]], None]]]
+    """
+    name = column['name']
+    key = column.get('rename', name)
+    convert = column.get('type', str)
+    if convert is str:
+        convert = None
+    derive = column.get('derive', None)
+    if column.get('drop', False):
+        key, convert, derive = None, None, None
+    elif derive is not None:
+        convert = None
+
+    return (index, name, key, convert, derive)
+
+
+def compile_schema(schema, header, context=None):
+    """
+    Compile a schema against the header of a file, producing a function that
+    converts a single row (as a list of values) to an output record. Each
+    column's position and conversion is worked out once per header, so
+    converting a row is a single loop over the precomputed columns.
+
+    :param schema: Schema describing the columns of the file.
+    :type schema: dict[str, object]
+    :param header: Column names, in the order they appear in the file.
+    :type header: list[str]
+    :param context: Values that are not in the file, but are needed to derive fields (eg. run_id)
+    :type context: Optional[dict[str, object]]
+    :return: Row converter
+    :rtype: Callable[[list[str]], Record]
+    :raises KeyError: If a column in the schema is missing from the header.
+    """
+    if context is None:
+        context = {}
+    # Files of the same format almost always share a header, so the compiled
+    # columns are cached and only the context differs between files.
+    cache_key = (id(schema), tuple(header))
+    if cache_key not in _compiled_schemas:
+        column_indexes = {column_name: index for index, column_name in enumerate(header)}
+        _compiled_schemas[cache_key] = tuple(_compile_column(column_indexes[column['name']], column) for column in schema['columns'])
+    compiled_columns = _compiled_schemas[cache_key]
+    num_columns = len(header)
+
+    def convert_row(row):
+        if len(row) < num_columns:
+            row = row + [None] * (num_columns - len(row))
+        record = {}
+        for index, name, key, convert, derive in compiled_columns:
+            value = row[index]
+            if value == 'NA':
+                record[name] = None
+            elif derive is not None:
+                derive(record, value, context)
+            elif convert is not None:
+                try:
+                    record[key] = convert(value)
+                except (ValueError, TypeError) as e:
+                    record[key] = None
+            elif key is not None:
+                record[key] = value
+
+        return _make_record(record)
+
+    return convert_row
+
+
+def iter_records(path, schema, context=None):
+    """
+    Parse a file according to its schema, yielding one record per row.
+
+    :param path: Path to the file
+    :type path: str
+    :param schema: Schema describing the columns of the file.
+    :type schema: dict[str, object]
+    :param context: Values that are not in the file, but are needed to derive fields (eg. run_id)
+    :type context: Optional[dict[str, object]]
+    :return: Parsed records
+    :rtype: Iterator[Record]
+    """
+    with open(path, 'r', newline='') as f:
+        reader = csv.reader(f, dialect=schema['dialect'])
+        try:
+            header = next(reader)
+        except StopIteration as e:
+            return
+        convert_row = compile_schema(schema, header, context)
+        num_rows = 0
+        try:
+            for row in reader:
+                if not row:
+                    continue
+                num_rows += 1
+                yield convert_row(row)
+        finally:
+            metrics.increment('files_parsed')
+            metrics.increment('rows_parsed', num_rows)
+
+
+def iter_artic_qc(artic_qc_path, run_id):
+    """
+    """
+    return iter_records(artic_qc_path, ARTIC_QC_SCHEMA, {'run_id': run_id})
+
+
+def iter_ncov_tools_summary_qc(ncov_tools_summary_qc_path):
+    """
+    """
+    return iter_records(ncov_tools_summary_qc_path, NCOV_TOOLS_SUMMARY_QC_SCHEMA)
+
+
+def iter_amplicon_depth_bed(amplicon_depth_bed_path):
+    """
+    """
+    return iter_records(amplicon_depth_bed_path, AMPLICON_DEPTH_BED_SCHEMA)
+
 
 def parse_artic_qc(artic_qc_path, run_id):
     """
     """
-    output = []
-    all_input_fields = [
-        "sample_name",
-        "pct_N_bases",
-        "pct_covered_bases",
-        "longest_no_N_run",
-        "num_aligned_reads",
-        "fasta",
-        "bam",
-        "qc_pass",
-    ]
-
-    int_fields = [
-        'longest_no_N_run',
-        'num_aligned_reads',
-    ]
-
-    float_fields = [
-        'pct_N_bases',
-        'pct_covered_bases',
-    ]
-
-    boolean_fields = [
-        'qc_pass',
-    ]
-    
-    with open(artic_qc_path, 'r') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            qc = collections.OrderedDict()
-            for field in all_input_fields:
-                if row[field] == 'NA':
-                    qc[field] = None
-                elif field == 'sample_name':
-                    library_id = row[field]
-                    qc['library_id'] = library_id
-                    plate_id = None
-                    if library_id.startswith('POS') or library_id.startswith('NEG'):
-                        # Format like POSYYYYMMDD-nCoVWGS-1-A or NEGYYYYMMDD-nCoVWGS-1-A
-                        if re.match("\\w{3}\\d{8}-nCoVWGS-\\d+-\\w+", library_id):
-                            try:
-                                plate_id = re.search("\\d+", library_id.split('-')[2]).group(0)
-                            except AttributeError as e:
-                                pass
-                        # Format like POSNN-1-A-A01 or NEGNN-1-A-B01
-                        elif re.match("\\w{3}\\d+-\\d+-\\w+-\\w+", library_id):
-                            try:
-                                plate_id = re.search("\\d+", library_id.split('-')[1]).group(0)
-                            except AttributeError as e:
-                                pass
-                    else:
-                        try:
-                            plate_id = re.search("\\d+", library_id.split('-')[1]).group(0)
-                        except AttributeError as e:
-                            pass
-                    if plate_id:
-                        qc['plate_id'] = int(plate_id)
-                    qc['run_id'] = run_id
-                elif field == 'pct_N_bases':
-                    pass
-                elif field == 'qc_pass':
-                    pass
-                elif field == 'pct_covered_bases':
-                    try:
-                        qc['genome_completeness'] = float(row[field])
-                    except ValueError as e:
-                        qc[field] = None
-                elif field in int_fields:
-                    try:
-                        qc[field] = int(row[field])
-                    except ValueError as e:
-                        qc[field] = None
-                elif field in float_fields:
-                    try:
-                        qc[field] = float(row[field])
-                    except ValueError as e:
-                        qc[field] = None
-                elif field in boolean_fields:
-                    try:
-                        qc[field] = bool(row[field])
-                    except ValueError as e:
-                        qc[field] = None
-                elif field == 'run_name':
-                    qc['plate_id'] = int(row[field].split('_')[-1])
-                    qc['run_id'] = '_'.join(row[field].split('_')[0:-1])
-                elif field == 'qc_pass':
-                    qc[field] = row[field].split(',')
-                else:
-                    qc[field] = row[field]
-            output.append(qc)
+    output = list(iter_artic_qc(artic_qc_path, run_id))
 
     return output
 
@@ -103,73 +336,7 @@ def parse_artic_qc(artic_qc_path, run_id):
 def parse_ncov_tools_summary_qc(ncov_tools_summary_qc_path):
     """
     """
-    output = []
-    all_input_fields = [
-        "sample",
-        "run_name",
-        "num_consensus_snvs",
-        "num_consensus_n",
-        "num_consensus_iupac",
-        "num_variants_snvs",
-        "num_variants_indel",
-        "num_variants_indel_triplet",
-        "mean_sequencing_depth",
-        "median_sequencing_depth",
-        "qpcr_ct",
-        "collection_date",
-        "num_weeks",
-        "scaled_variants_snvs",
-        "genome_completeness",
-        "qc_pass",
-        "lineage",
-        "lineage_notes",
-        "watch_mutations",
-    ]
-
-    int_fields = [
-        'num_consensus_snvs',
-        'num_consensus_n',
-        'num_consensus_iupac',
-        'num_variants_snvs',
-        'num_variants_indel',
-        'num_variants_indel_triplet',
-        'median_sequencing_depth',
-        'num_weeks',
-    ]
-
-    float_fields = [
-        'mean_sequencing_depth',
-        'qpcr_ct',
-        'scaled_variants_snvs',
-        'genome_completeness',
-    ]
-    with open(ncov_tools_summary_qc_path, 'r') as f:
-        reader = csv.DictReader(f, dialect='excel-tab')
-        for row in reader:
-            qc = collections.OrderedDict()
-            for field in all_input_fields:
-                if row[field] == 'NA':
-                    qc[field] = None
-                elif field in int_fields:
-                    try:
-                        qc[field] = int(row[field])
-                    except ValueError as e:
-                        qc[field] = None
-                elif field in float_fields:
-                    try:
-                        qc[field] = float(row[field])
-                    except ValueError as e:
-                        qc[field] = None
-                elif field == 'sample':
-                    qc['library_id'] = row[field]
-                elif field == 'run_name':
-                    qc['plate_id'] = int(row[field].split('_')[-1])
-                    qc['run_id'] = '_'.join(row[field].split('_')[0:-1])
-                elif field == 'qc_pass':
-                    qc[field] = row[field].split(',')
-                else:
-                    qc[field] = row[field]
-            output.append(qc)
+    output = list(iter_ncov_tools_summary_qc(ncov_tools_summary_qc_path))
 
     return output
 
@@ -177,53 +344,6 @@ def parse_ncov_tools_summary_qc(ncov_tools_summary_qc_path):
 def parse_amplicon_depth_bed(amplicon_depth_bed_path):
     """
     """
-    output = []
-    all_input_fields = [
-        'reference_name',
-        'start',
-        'end',
-        'amplicon_id',
-        'pool',
-        'strand',
-        'mean_depth',
-    ]
-
-    int_fields = [
-        'start',
-        'end',
-        'pool',
-    ]
-
-    float_fields = [
-        'mean_depth',
-    ]
-
-    with open(amplicon_depth_bed_path, 'r') as f:
-        reader = csv.DictReader(f, dialect='excel-tab')
-        for row in reader:
-            amplicon = collections.OrderedDict()
-            for field in all_input_fields:
-                if row[field] == 'NA':
-                    amplicon[field] = None
-                elif field in int_fields:
-                    try:
-                        amplicon[field] = int(row[field])
-                    except ValueError as e:
-                        amplicon[field] = None
-                elif field in float_fields:
-                    try:
-                        amplicon[field] = float(row[field])
-                    except ValueError as e:
-                        amplicon[field] = None
-                elif field == 'reference_name':
-                    pass
-                elif field == 'amplicon_id':
-                    try:
-                        amplicon['amplicon_num'] = int(row[field].split('_')[-1])
-                    except ValueError as e:
-                        amplicon['amplicon_num'] = None
-                else:
-                    amplicon[field] = row[field]
-            output.append(amplicon)
+    output = list(iter_amplicon_depth_bed(amplicon_depth_bed_path))
 
     return output
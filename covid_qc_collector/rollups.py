@@ -0,0 +1,250 @@
+import collections
+import fcntl
+import os
+import statistics
+import threading
+
+import covid_qc_collector.state as state
+
+# Genome completeness is binned into tenths, from [0.0, 0.1) to [0.9, 1.0]
+NUM_GENOME_COMPLETENESS_BINS = 10
+
+# Index entries for runs collected since the index was last saved, by run ID.
+# The index is saved once per scan, rather than once per run, so that a
+# backfill doesn't rewrite it (for every run so far) for each run.
+_pending_index_entries = {}
+# Serializes access to the pending entries between threads. Other processes
+# (eg. other shards) are excluded with a lock in the locks dir.
+_index_lock = threading.Lock()
+
+
+def get_rollups_dir(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Path to the dir where QC rollups are written.
+    :rtype: str
+    """
+    return os.path.join(config['output_dir'], 'qc-rollups')
+
+
+def _median(values):
+    """
+    :return: Median of the values, or None if there aren't any.
+    :rtype: Optional[float]
+    """
+    if not values:
+        return None
+
+    return statistics.median(values)
+
+
+def new_summary_qc_rollup():
+    """
+    :return: Empty accumulator for ncov-tools summary QC records.
+    :rtype: dict[str, object]
+    """
+    rollup = {
+        "num_libraries": 0,
+        "num_qc_pass": 0,
+        "qc_flags": collections.Counter(),
+        "lineages": collections.Counter(),
+        "median_sequencing_depths": [],
+        "genome_completeness_histogram": [0] * NUM_GENOME_COMPLETENESS_BINS,
+    }
+
+    return rollup
+
+
+def add_summary_qc_record(rollup, record):
+    """
+    :param rollup: Accumulator, as returned by `new_summary_qc_rollup`
+    :type rollup: dict[str, object]
+    :param record: ncov-tools summary QC record
+    :type record: dict[str, object]
+    :return: None
+    :rtype: None
+    """
+    rollup['num_libraries'] += 1
+    qc_flags = record['qc_pass'] or []
+    if qc_flags == ['PASS']:
+        rollup['num_qc_pass'] += 1
+    rollup['qc_flags'].update(qc_flags)
+    if record['lineage']:
+        rollup['lineages'][record['lineage']] += 1
+    if record['median_sequencing_depth'] is not None:
+        rollup['median_sequencing_depths'].append(record['median_sequencing_depth'])
+    genome_completeness = record['genome_completeness']
+    if genome_completeness is not None:
+        genome_completeness_bin = min(max(int(genome_completeness * NUM_GENOME_COMPLETENESS_BINS), 0), NUM_GENOME_COMPLETENESS_BINS - 1)
+        rollup['genome_completeness_histogram'][genome_completeness_bin] += 1
+
+
+def finish_summary_qc_rollup(rollup):
+    """
+    :param rollup: Accumulator, as returned by `new_summary_qc_rollup`
+    :type rollup: dict[str, object]
+    :return: Summary of the accumulated records
+    :rtype: dict[str, object]
+    """
+    num_libraries = rollup['num_libraries']
+    summary = {
+        "num_libraries": num_libraries,
+        "num_qc_pass": rollup['num_qc_pass'],
+        "qc_pass_rate": rollup['num_qc_pass'] / num_libraries if num_libraries else None,
+        "median_sequencing_depth": _median(rollup['median_sequencing_depths']),
+        "genome_completeness_histogram": list(rollup['genome_completeness_histogram']),
+        "qc_flags": dict(rollup['qc_flags'].most_common()),
+        "lineages": dict(rollup['lineages'].most_common()),
+    }
+
+    return summary
+
+
+def new_artic_qc_rollup():
+    """
+    :return: Empty accumulator for artic QC records.
+    :rtype: dict[str, object]
+    """
+    rollup = {
+        "num_libraries": 0,
+        "genome_completeness": [],
+        "num_aligned_reads": [],
+    }
+
+    return rollup
+
+
+def add_artic_qc_record(rollup, record):
+    """
+    :param rollup: Accumulator, as returned by `new_artic_qc_rollup`
+    :type rollup: dict[str, object]
+    :param record: artic QC record
+    :type record: dict[str, object]
+    :return: None
+    :rtype: None
+    """
+    rollup['num_libraries'] += 1
+    # A `pct_covered_bases` of NA (or one that can't be parsed) is output as
+    # `pct_covered_bases: None`, with no `genome_completeness` at all.
+    genome_completeness = record.get('genome_completeness', None)
+    if genome_completeness is not None:
+        rollup['genome_completeness'].append(genome_completeness)
+    num_aligned_reads = record.get('num_aligned_reads', None)
+    if num_aligned_reads is not None:
+        rollup['num_aligned_reads'].append(num_aligned_reads)
+
+
+def finish_artic_qc_rollup(rollup):
+    """
+    :param rollup: Accumulator, as returned by `new_artic_qc_rollup`
+    :type rollup: dict[str, object]
+    :return: Summary of the accumulated records
+    :rtype: dict[str, object]
+    """
+    summary = {
+        "num_libraries": rollup['num_libraries'],
+        "median_genome_completeness": _median(rollup['genome_completeness']),
+        "median_num_aligned_reads": _median(rollup['num_aligned_reads']),
+    }
+
+    return summary
+
+
+def iter_with_rollups(records, rollups, add_record):
+    """
+    Pass records through unchanged, adding each one to the rollups on the
+    way, so that rollups are accumulated in the same pass that the records
+    are parsed and written.
+
+    :param records: Records
+    :type records: Iterable[dict[str, object]]
+    :param rollups: Accumulators
+    :type rollups: list[dict[str, object]]
+    :param add_record: Function that adds a record to an accumulator (eg. `add_summary_qc_record`)
+    :type add_record: Callable[[dict[str, object], dict[str, object]], None]
+    :return: The same records
+    :rtype: Iterator[dict[str, object]]
+    """
+    for record in records:
+        for rollup in rollups:
+            add_record(rollup, record)
+        yield record
+
+
+def build_run_rollup(run_id, artic_qc_rollup, run_summary_qc_rollup, plate_summary_qc_rollups):
+    """
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :param artic_qc_rollup: artic QC accumulator for the run
+    :type artic_qc_rollup: dict[str, object]
+    :param run_summary_qc_rollup: ncov-tools summary QC accumulator for the whole run
+    :type run_summary_qc_rollup: dict[str, object]
+    :param plate_summary_qc_rollups: ncov-tools summary QC accumulators, by plate number
+    :type plate_summary_qc_rollups: dict[str, dict[str, object]]
+    :return: Run rollup
+    :rtype: dict[str, object]
+    """
+    run_rollup = {
+        "run_id": run_id,
+        "artic_qc": finish_artic_qc_rollup(artic_qc_rollup),
+        "summary_qc": finish_summary_qc_rollup(run_summary_qc_rollup),
+        "plates": {
+            plate_number: finish_summary_qc_rollup(plate_rollup)
+            for plate_number, plate_rollup in plate_summary_qc_rollups.items()
+        },
+    }
+
+    return run_rollup
+
+
+def add_rollup_index_entry(run_rollup, rollup_file):
+    """
+    Add (or replace) a run's entry in the rollup index, which holds the
+    headline numbers for every run, and the name of its rollup file. The
+    entry is written by the next `save_rollup_index`.
+
+    :param run_rollup: Run rollup, as returned by `build_run_rollup`
+    :type run_rollup: dict[str, object]
+    :param rollup_file: Path to the run's rollup file
+    :type rollup_file: str
+    :return: None
+    :rtype: None
+    """
+    run_summary_qc = run_rollup['summary_qc']
+    index_entry = {
+        "rollup_file": os.path.basename(rollup_file),
+        "num_plates": len(run_rollup['plates']),
+        "num_libraries": run_summary_qc['num_libraries'],
+        "num_qc_pass": run_summary_qc['num_qc_pass'],
+        "qc_pass_rate": run_summary_qc['qc_pass_rate'],
+        "median_sequencing_depth": run_summary_qc['median_sequencing_depth'],
+        "median_genome_completeness": run_rollup['artic_qc']['median_genome_completeness'],
+    }
+    with _index_lock:
+        _pending_index_entries[run_rollup['run_id']] = index_entry
+
+
+def save_rollup_index(config):
+    """
+    Write the entries added since the index was last saved to
+    `qc-rollups/index.json`, in a single update.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: None
+    :rtype: None
+    """
+    with _index_lock:
+        if not _pending_index_entries:
+            return
+        index_path = os.path.join(get_rollups_dir(config), 'index.json')
+        lock_path = os.path.join(state.get_locks_dir(config), 'qc_rollup_index.lock')
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            index = state.load_state(index_path)
+            runs = index.get('runs', {})
+            runs.update(_pending_index_entries)
+            index['runs'] = dict(sorted(runs.items()))
+            state.save_state(index, index_path)
+        _pending_index_entries.clear()
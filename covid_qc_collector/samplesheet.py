@@ -1,59 +1,173 @@
+import csv
 import glob
 import json
 import logging
 import os
 import re
 
+import covid_qc_collector.metrics as metrics
+import covid_qc_collector.state as state
 
-def find_samplesheet_for_run(run_id, sequencer_output_dirs):
+
+def get_sequencer_type_for_run(run_id):
     """
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :return: 'miseq', 'nextseq' or None
+    :rtype: Optional[str]
     """
-    samplesheets = []
-    samplesheet_path = None
     sequencer_type = None
     if re.match('\d{6}_M', run_id):
         sequencer_type = 'miseq'
     elif re.match('\d{6}_VH', run_id):
         sequencer_type = 'nextseq'
-    else:
-        return samplesheet_path
 
-    sequencer_run_dir = ""
-    if sequencer_type == 'miseq':
-        for sequencer_output_dir in sequencer_output_dirs:
-            if not re.search('miseq', sequencer_output_dir):
-                continue
-            for run_dir in os.listdir(sequencer_output_dir):
-                if os.path.basename(run_dir) == run_id:
-                    sequencer_run_dir = os.path.join(sequencer_output_dir, run_dir)
+    return sequencer_type
+
+
+def index_sequencer_output_dirs(sequencer_output_dirs, sequencer_run_index=None):
+    """
+    Build or refresh an index of the run dirs found in each sequencer output dir.
+    A sequencer output dir is only listed again if its mtime has changed since
+    it was last indexed. The index is updated in-place.
+
+    :param sequencer_output_dirs: Sequencer output dirs to index.
+    :type sequencer_output_dirs: list[str]
+    :param sequencer_run_index: Index from a previous call, to be refreshed.
+    :type sequencer_run_index: Optional[dict[str, object]]
+    :return: Index of sequencer run dirs, by sequencer output dir and run ID.
+    :rtype: dict[str, object]
+    """
+    if sequencer_run_index is None:
+        sequencer_run_index = {}
+    sequencer_run_index.setdefault('sequencer_output_dirs', {})
+
+    for sequencer_output_dir in sequencer_output_dirs:
+        if re.search('miseq', sequencer_output_dir):
+            sequencer_type = 'miseq'
+        elif re.search('nextseq', sequencer_output_dir):
+            sequencer_type = 'nextseq'
+        else:
+            continue
+        metrics.increment('stat_calls')
+        try:
+            mtime_ns = os.stat(sequencer_output_dir).st_mtime_ns
+        except FileNotFoundError as e:
+            logging.error(json.dumps({"event_type": "sequencer_output_dir_not_found", "sequencer_output_dir": sequencer_output_dir}))
+            sequencer_run_index['sequencer_output_dirs'].pop(sequencer_output_dir, None)
+            continue
+
+        indexed_dir = sequencer_run_index['sequencer_output_dirs'].get(sequencer_output_dir, None)
+        if indexed_dir is not None and indexed_dir['mtime_ns'] == mtime_ns:
+            continue
+
+        previously_indexed_runs = {}
+        if indexed_dir is not None:
+            previously_indexed_runs = indexed_dir['runs']
+        runs = {}
+        metrics.increment('directories_listed')
+        for run_dir in os.listdir(sequencer_output_dir):
+            if run_dir in previously_indexed_runs:
+                runs[run_dir] = previously_indexed_runs[run_dir]
+            else:
+                runs[run_dir] = {
+                    "sequencer_type": sequencer_type,
+                    "run_dir": os.path.abspath(os.path.join(sequencer_output_dir, run_dir)),
+                    "demultiplexing_outdir": None,
+                    "samplesheet_path": None,
+                    "fingerprint": None,
+                }
+        sequencer_run_index['sequencer_output_dirs'][sequencer_output_dir] = {
+            "mtime_ns": mtime_ns,
+            "runs": runs,
+        }
+        logging.debug(json.dumps({"event_type": "indexed_sequencer_output_dir", "sequencer_output_dir": sequencer_output_dir, "num_run_dirs": len(runs)}))
+
+    return sequencer_run_index
+
+
+def index_sequencer_runs(sequencer_output_dirs, run_ids):
+    """
+    Build an index of just the given runs, without listing the sequencer
+    output dirs, by checking for each run's dir directly. The index has the
+    same structure as one built by `index_sequencer_output_dirs`, but no
+    mtime is recorded for each sequencer output dir, so if it's refreshed by
+    `index_sequencer_output_dirs`, every dir is listed in full.
+
+    :param sequencer_output_dirs: Sequencer output dirs to search.
+    :type sequencer_output_dirs: list[str]
+    :param run_ids: Sequencing run IDs to index.
+    :type run_ids: Iterable[str]
+    :return: Index of the runs' sequencer run dirs, by sequencer output dir and run ID.
+    :rtype: dict[str, object]
+    """
+    sequencer_run_index = {'sequencer_output_dirs': {}}
+    run_ids = list(run_ids)
+    for sequencer_output_dir in sequencer_output_dirs:
+        if re.search('miseq', sequencer_output_dir):
+            sequencer_type = 'miseq'
+        elif re.search('nextseq', sequencer_output_dir):
+            sequencer_type = 'nextseq'
+        else:
+            continue
+        runs = {}
+        for run_id in run_ids:
+            run_dir = os.path.join(sequencer_output_dir, run_id)
+            metrics.increment('stat_calls')
+            if os.path.isdir(run_dir):
+                runs[run_id] = {
+                    "sequencer_type": sequencer_type,
+                    "run_dir": os.path.abspath(run_dir),
+                    "demultiplexing_outdir": None,
+                    "samplesheet_path": None,
+                    "fingerprint": None,
+                }
+        sequencer_run_index['sequencer_output_dirs'][sequencer_output_dir] = {
+            "mtime_ns": None,
+            "runs": runs,
+        }
 
+    return sequencer_run_index
+
+
+def find_samplesheet_in_sequencer_run_dir(run_id, sequencer_run_dir, sequencer_type):
+    """
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :param sequencer_run_dir: Path to the sequencer output dir for the run.
+    :type sequencer_run_dir: str
+    :param sequencer_type: 'miseq' or 'nextseq'
+    :type sequencer_type: str
+    :return: Most recent demultiplexing output dir (if any), and the samplesheet path (if a single samplesheet was found).
+    :rtype: tuple[Optional[str], Optional[str]]
+    """
+    samplesheets = []
+    samplesheet_path = None
+    most_recent_demultiplexing_outdir = None
+    if sequencer_type == 'miseq':
+        metrics.increment('stat_calls')
         if os.path.exists(os.path.join(sequencer_run_dir, 'Alignment_1')):
             # Run is 'new-style' MiSeq Output directory
+            metrics.increment('directories_listed')
             demultiplexing_output_dirs = os.listdir(os.path.join(sequencer_run_dir, 'Alignment_1'))
-            most_recent_demultiplexing_outdir = sorted(demultiplexing_output_dirs)[-1]
+            most_recent_demultiplexing_outdir = os.path.join(sequencer_run_dir, 'Alignment_1', sorted(demultiplexing_output_dirs)[-1])
             samplesheets = [os.path.join(most_recent_demultiplexing_outdir, 'SampleSheetUsed.csv')]
         else:
             # Run is 'old-style' MiSeq Output directory
             standard_samplesheet_path = os.path.join(sequencer_run_dir, 'SampleSheet.csv')
+            metrics.increment('stat_calls')
             if os.path.exists(standard_samplesheet_path):
                 samplesheets = [standard_samplesheet_path]
                 logging.debug(json.dumps({"event_type": "found_samplesheets", "run_id": run_id, "sequencer_run_dir": sequencer_run_dir, "samplesheet_paths": samplesheets}))
             else:
+                metrics.increment('directories_listed')
                 samplesheets = glob.glob(os.path.join(sequencer_run_dir, 'SampleSheet*.csv'))
                 logging.debug(json.dumps({"event_type": "found_samplesheets", "run_id": run_id, "sequencer_run_dir": sequencer_run_dir, "samplesheet_paths": samplesheets}))
-            
-    elif sequencer_type == 'nextseq':
-        logging.debug(json.dumps({"event_type": "determined_sequencer_type", "run_id": run_id, "sequencer_type": sequencer_type}))
-        for sequencer_output_dir in sequencer_output_dirs:
-            if not re.search('nextseq', sequencer_output_dir):
-                continue
-            for run_dir in os.listdir(sequencer_output_dir):
-                run_dir = os.path.abspath(os.path.join(sequencer_output_dir, run_dir))
-                if os.path.basename(run_dir) == run_id:
-                    sequencer_run_dir = run_dir
-                    logging.debug(json.dumps({"event_type": "found_sequencer_output_dir", "run_id": run_id, "sequencer_output_dir": sequencer_run_dir}))
 
+    elif sequencer_type == 'nextseq':
+        metrics.increment('stat_calls')
         if os.path.exists(os.path.join(sequencer_run_dir, 'Analysis')):
+            metrics.increment('directories_listed', 2)
             demultiplexing_output_dirs = os.listdir(os.path.join(sequencer_run_dir, 'Analysis'))
             most_recent_demultiplexing_outdir = os.path.join(sequencer_run_dir, 'Analysis', sorted(demultiplexing_output_dirs)[-1])
             logging.debug(json.dumps({"event_type": "determined_most_recent_demultiplexing_outdir", "run_id": run_id, "demultiplexing_outdir": most_recent_demultiplexing_outdir}))
@@ -62,36 +176,249 @@ def find_samplesheet_for_run(run_id, sequencer_output_dirs):
     if len(samplesheets) == 1:
         samplesheet_path = samplesheets[0]
 
+    return most_recent_demultiplexing_outdir, samplesheet_path
+
+
+def get_sequencer_run_fingerprint_paths(indexed_run):
+    """
+    The paths that need to be re-checked to know whether a previously-resolved
+    samplesheet is still current for an indexed run.
+
+    :param indexed_run: Index entry for a sequencer run.
+    :type indexed_run: dict[str, object]
+    :return: Paths to fingerprint.
+    :rtype: list[str]
+    """
+    sequencer_run_dir = indexed_run['run_dir']
+    if indexed_run['sequencer_type'] == 'miseq':
+        fingerprint_paths = [sequencer_run_dir, os.path.join(sequencer_run_dir, 'Alignment_1')]
+    else:
+        fingerprint_paths = [sequencer_run_dir, os.path.join(sequencer_run_dir, 'Analysis')]
+    if indexed_run['demultiplexing_outdir'] is not None:
+        fingerprint_paths.append(indexed_run['demultiplexing_outdir'])
+        if indexed_run['sequencer_type'] == 'nextseq':
+            fingerprint_paths.append(os.path.join(indexed_run['demultiplexing_outdir'], 'Data'))
+
+    return fingerprint_paths
+
+
+def find_samplesheet_for_run(run_id, sequencer_output_dirs, sequencer_run_index=None):
+    """
+    Samplesheet paths are resolved once per sequencer run, and stored in the
+    sequencer run index. They are only resolved again if the run dir or its
+    demultiplexing output dirs change.
+
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :param sequencer_output_dirs: Sequencer output dirs to search.
+    :type sequencer_output_dirs: list[str]
+    :param sequencer_run_index: Index produced by `index_sequencer_output_dirs`. If not provided, one will be built.
+    :type sequencer_run_index: Optional[dict[str, object]]
+    :return: Path to the samplesheet for the run, or None if a single samplesheet couldn't be found.
+    :rtype: Optional[str]
+    """
+    samplesheet_path = None
+    sequencer_type = get_sequencer_type_for_run(run_id)
+    if sequencer_type is None:
+        return samplesheet_path
+
+    if sequencer_run_index is None:
+        sequencer_run_index = index_sequencer_output_dirs(sequencer_output_dirs)
+
+    indexed_run = None
+    for sequencer_output_dir in sequencer_output_dirs:
+        indexed_dir = sequencer_run_index['sequencer_output_dirs'].get(sequencer_output_dir, None)
+        if indexed_dir is None or run_id not in indexed_dir['runs']:
+            continue
+        if indexed_dir['runs'][run_id]['sequencer_type'] == sequencer_type:
+            indexed_run = indexed_dir['runs'][run_id]
+
+    if indexed_run is None:
+        return samplesheet_path
+
+    logging.debug(json.dumps({"event_type": "found_sequencer_output_dir", "run_id": run_id, "sequencer_output_dir": indexed_run['run_dir']}))
+    if indexed_run['fingerprint'] is not None and state.fingerprint_unchanged(indexed_run['fingerprint']):
+        samplesheet_path = indexed_run['samplesheet_path']
+    else:
+        demultiplexing_outdir, samplesheet_path = find_samplesheet_in_sequencer_run_dir(run_id, indexed_run['run_dir'], sequencer_type)
+        indexed_run['demultiplexing_outdir'] = demultiplexing_outdir
+        indexed_run['samplesheet_path'] = samplesheet_path
+        indexed_run['fingerprint'] = state.get_path_fingerprint(get_sequencer_run_fingerprint_paths(indexed_run))
+
     return samplesheet_path
 
 
-def count_covid19_production_samples_in_samplesheet(samplesheet_path, sequencer_type):
+# MiSeq samplesheets identify COVID-19 libraries by the format of their Sample_Name
+MISEQ_SAMPLE_ID_REGEX = re.compile('S\\d{1,3}')
+MISEQ_COVID19_LIBRARY_ID_REGEX = re.compile('|'.join([
+    '[ER]\\d{10}',                                  # Container ID only
+    '[FHSTW]\\d{6}',                                # Foreign Container ID
+    'X\\d{5}',                                      # Foreign Container ID
+    '[ER]\\d{10}-\\d{1,4}-[A-Z0-9]{1,2}-[A-H]\\d{2}', # Container ID-Plate Num-Index Set ID-Well
+]))
+# NextSeq samplesheets identify COVID-19 libraries by their project
+NEXTSEQ_COVID19_PROJECT_ID = 'covid-19_production'
+# Incremented whenever the way samplesheets are summarized changes, so that
+# cached summaries from earlier versions are recomputed.
+SAMPLESHEET_SUMMARY_VERSION = 2
+
+
+def parse_samplesheet_data_sections(samplesheet_path):
+    """
+    Parse the data sections of a samplesheet (`[Data]` for MiSeq, `[*_Data]` for NextSeq).
+    Other sections are skipped.
+
+    :param samplesheet_path: Path to the samplesheet
+    :type samplesheet_path: str
+    :return: Rows from each data section, by section name. The first row of each section is its header.
+    :rtype: dict[str, list[list[str]]]
+    """
+    data_sections = {}
+    current_section = None
+    num_rows = 0
+    with open(samplesheet_path, 'r', newline='') as f:
+        for row in csv.reader(f):
+            num_rows += 1
+            if not row or not any(row):
+                continue
+            if row[0].startswith('['):
+                section_name = row[0].strip().strip('[]')
+                if section_name == 'Data' or section_name.endswith('_Data'):
+                    current_section = data_sections.setdefault(section_name, [])
+                else:
+                    current_section = None
+            elif current_section is not None:
+                current_section.append(row)
+    metrics.increment('files_parsed')
+    metrics.increment('rows_parsed', num_rows)
+
+    return data_sections
+
+
+def summarize_miseq_samplesheet(data_sections):
+    """
+    """
+    summary = {
+        "num_samples": 0,
+        "num_covid19_production_samples": 0,
+        "num_positive_controls": 0,
+        "num_negative_controls": 0,
+    }
+    for row in data_sections.get('Data', [])[1:]:
+        summary['num_samples'] += 1
+        if len(row) < 2 or not MISEQ_SAMPLE_ID_REGEX.fullmatch(row[0]):
+            continue
+        library_id = row[1]
+        if library_id.startswith('POS'):
+            summary['num_positive_controls'] += 1
+            summary['num_covid19_production_samples'] += 1
+        elif library_id.startswith('NEG'):
+            summary['num_negative_controls'] += 1
+            summary['num_covid19_production_samples'] += 1
+        elif MISEQ_COVID19_LIBRARY_ID_REGEX.fullmatch(library_id):
+            summary['num_covid19_production_samples'] += 1
+
+    return summary
+
+
+def summarize_nextseq_samplesheet(data_sections):
+    """
+    """
+    summary = {
+        "num_samples": 0,
+        "num_covid19_production_samples": 0,
+        "num_positive_controls": 0,
+        "num_negative_controls": 0,
+    }
+    # A sample is listed in more than one section (eg. BCLConvert_Data and
+    # Cloud_Data), so every count is of distinct Sample_IDs.
+    sample_ids = set()
+    covid19_production_sample_ids = set()
+    for section in data_sections.values():
+        for row in section[1:]:
+            library_id = row[0]
+            sample_ids.add(library_id)
+            # The project may be in any column other than the Sample_ID, depending on the section.
+            if NEXTSEQ_COVID19_PROJECT_ID in row[1:-1]:
+                covid19_production_sample_ids.add(library_id)
+    summary['num_samples'] = len(sample_ids)
+    summary['num_covid19_production_samples'] = len(covid19_production_sample_ids)
+    summary['num_positive_controls'] = len([library_id for library_id in covid19_production_sample_ids if library_id.startswith('POS')])
+    summary['num_negative_controls'] = len([library_id for library_id in covid19_production_sample_ids if library_id.startswith('NEG')])
+
+    return summary
+
+
+def load_samplesheet_cache(config):
+    """
+    The samplesheet cache holds the summary of each samplesheet that has been
+    parsed, along with the size and mtime of the file when it was parsed.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Samplesheet summaries by samplesheet path
+    :rtype: dict[str, object]
     """
+    samplesheet_cache_path = os.path.join(state.get_state_dir(config), 'samplesheet_cache.json')
+    samplesheet_cache = state.load_state(samplesheet_cache_path)
+
+    return samplesheet_cache
+
+
+def save_samplesheet_cache(config, samplesheet_cache):
     """
-    num_covid19_production_samples = 0
+    """
+    samplesheet_cache_path = os.path.join(state.get_state_dir(config), 'samplesheet_cache.json')
+    state.save_state(samplesheet_cache, samplesheet_cache_path)
+
+
+def summarize_samplesheet(samplesheet_path, sequencer_type, samplesheet_cache=None):
+    """
+    Summarize the samples in a samplesheet. If a cache is provided, the
+    samplesheet is only read if its size or mtime has changed since it was
+    last summarized.
+
+    :param samplesheet_path: Path to the samplesheet
+    :type samplesheet_path: str
+    :param sequencer_type: 'miseq' or 'nextseq'
+    :type sequencer_type: str
+    :param samplesheet_cache: Samplesheet cache, updated in-place.
+    :type samplesheet_cache: Optional[dict[str, object]]
+    :return: Number of samples, COVID-19 production samples, and positive and negative controls.
+    :rtype: dict[str, int]
+    """
+    metrics.increment('stat_calls')
+    samplesheet_stat = os.stat(samplesheet_path)
+    if samplesheet_cache is not None and samplesheet_path in samplesheet_cache:
+        cached = samplesheet_cache[samplesheet_path]
+        if cached['size'] == samplesheet_stat.st_size and cached['mtime_ns'] == samplesheet_stat.st_mtime_ns and cached['sequencer_type'] == sequencer_type and cached.get('summary_version') == SAMPLESHEET_SUMMARY_VERSION:
+            return cached['summary']
+
+    data_sections = parse_samplesheet_data_sections(samplesheet_path)
     if sequencer_type == 'nextseq':
-        with open(samplesheet_path, 'r') as f:
-            for row in f:
-                if re.search(',covid-19_production,', row):
-                    num_covid19_production_samples += 1
+        summary = summarize_nextseq_samplesheet(data_sections)
     elif sequencer_type == 'miseq':
-        covid_library_id_regexes = [
-            'S\d{1,3},[ER]\d{10},',                                  # Container ID only
-            'S\d{1,3},[FHSTW]\d{6},',                                # Foreign Container ID
-            'S\d{1,3},X\d{5},',                                      # Foreign Container ID
-            'S\d{1,3},[ER]\d{10}-\d{1,4}-[A-Z0-9]{1,2}-[A-H]\d{2},', # Container ID-Plate Num-Index Set ID-Well
-            'S\d{1,3},POS',                                          # Positive control
-            'S\d{1,3},NEG',                                          # Negative control
-        ]
-        with open(samplesheet_path, 'r') as f:
-            for row in f:
-                library_id_matches = []
-                for r in covid_library_id_regexes:
-                    if re.match(r, row):
-                        library_id_matches.append(re.match(r, row).group(0))
-                    else:
-                        library_id_matches.append(None)
-                if any(library_id_matches):
-                    num_covid19_production_samples += 1
+        summary = summarize_miseq_samplesheet(data_sections)
+    else:
+        summary = {"num_samples": 0, "num_covid19_production_samples": 0, "num_positive_controls": 0, "num_negative_controls": 0}
+    logging.debug(json.dumps({"event_type": "samplesheet_parsed", "samplesheet_path": samplesheet_path, "summary": summary}))
+
+    if samplesheet_cache is not None:
+        samplesheet_cache[samplesheet_path] = {
+            "size": samplesheet_stat.st_size,
+            "mtime_ns": samplesheet_stat.st_mtime_ns,
+            "sequencer_type": sequencer_type,
+            "summary_version": SAMPLESHEET_SUMMARY_VERSION,
+            "summary": summary,
+        }
+
+    return summary
+
+
+def count_covid19_production_samples_in_samplesheet(samplesheet_path, sequencer_type, samplesheet_cache=None):
+    """
+    """
+    summary = summarize_samplesheet(samplesheet_path, sequencer_type, samplesheet_cache)
+    num_covid19_production_samples = summary['num_covid19_production_samples']
 
     return num_covid19_production_samples
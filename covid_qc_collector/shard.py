@@ -0,0 +1,349 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import zlib
+
+import covid_qc_collector.state as state
+
+SHARD_BY_OPTIONS = [
+    'hash',
+    'sequencer',
+]
+
+DEFAULT_SHARD_BY = 'hash'
+DEFAULT_LEASE_DURATION_SECONDS = 600.0
+DEFAULT_SHARD_HEARTBEAT_TIMEOUT_SECONDS = 7200.0
+# Leases on runs being collected are renewed this many times per lease duration
+LEASE_RENEWALS_PER_DURATION = 3
+
+# A shard with no heartbeat yet is given until the heartbeat timeout after
+# this instance started before it's adopted, so that instances that start
+# at the same time don't adopt each other's shards.
+_instance_start_time = time.time()
+
+
+def get_instance_id(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: ID for this collector instance, from config, or based on the hostname and pid.
+    :rtype: str
+    """
+    instance_id = config.get('instance_id', socket.gethostname() + ':' + str(os.getpid()))
+
+    return instance_id
+
+
+def get_shard_config(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Shard index, number of shards, and how runs are assigned to shards.
+    :rtype: tuple[int, int, str]
+    """
+    num_shards = int(config.get('num_shards', 1))
+    shard_index = int(config.get('shard_index', 0))
+    shard_by = config.get('shard_by', DEFAULT_SHARD_BY)
+    if num_shards < 1 or not (0 <= shard_index < num_shards):
+        logging.error(json.dumps({"event_type": "invalid_shard_config", "shard_index": shard_index, "num_shards": num_shards}))
+        num_shards, shard_index = 1, 0
+    if shard_by not in SHARD_BY_OPTIONS:
+        logging.error(json.dumps({"event_type": "invalid_shard_by", "shard_by": shard_by, "valid_shard_by_options": SHARD_BY_OPTIONS}))
+        shard_by = DEFAULT_SHARD_BY
+
+    return shard_index, num_shards, shard_by
+
+
+def is_sharded(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: True if runs are split between more than one collector instance.
+    :rtype: bool
+    """
+    _, num_shards, _ = get_shard_config(config)
+
+    return num_shards > 1
+
+
+def get_shard_for_run(run_id, num_shards, shard_by=DEFAULT_SHARD_BY):
+    """
+    Assign a run to a shard. The assignment only depends on the run ID, so it
+    is the same on every host. With `shard_by` set to 'sequencer', all runs
+    from the same instrument are assigned to the same shard.
+
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :param num_shards: Number of shards
+    :type num_shards: int
+    :param shard_by: One of SHARD_BY_OPTIONS
+    :type shard_by: str
+    :return: Shard index
+    :rtype: int
+    """
+    shard_key = run_id
+    if shard_by == 'sequencer':
+        # Run IDs look like YYMMDD_<instrument_id>_<run_number>_<flowcell_id>
+        run_id_parts = run_id.split('_')
+        if len(run_id_parts) > 1:
+            shard_key = run_id_parts[1]
+    # crc32 is stable across processes and hosts, unlike hash()
+    shard_index = zlib.crc32(shard_key.encode('utf-8')) % num_shards
+
+    return shard_index
+
+
+def get_leases_dir(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Path to the dir that is shared by all instances for leases and heartbeats.
+    :rtype: str
+    """
+    leases_dir = os.path.join(config['output_dir'], '.leases')
+
+    return leases_dir
+
+
+def write_heartbeat(config, instance_id):
+    """
+    Record that this instance is alive and collecting its shard.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param instance_id: ID of this collector instance
+    :type instance_id: str
+    :return: None
+    :rtype: None
+    """
+    shard_index, _, _ = get_shard_config(config)
+    heartbeat_path = os.path.join(get_leases_dir(config), 'shard-' + str(shard_index) + '.heartbeat')
+    tmp_heartbeat_path = state.get_temp_path(heartbeat_path)
+    with open(tmp_heartbeat_path, 'w') as f:
+        json.dump({"instance_id": instance_id, "timestamp": time.time()}, f)
+    os.replace(tmp_heartbeat_path, heartbeat_path)
+
+
+def get_active_shards(config):
+    """
+    Get the shards that this instance should collect: its own, plus any whose
+    heartbeat is older than `shard_heartbeat_timeout_seconds`, because the
+    instance responsible for them has stopped or crashed.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Shard indexes
+    :rtype: set[int]
+    """
+    shard_index, num_shards, _ = get_shard_config(config)
+    heartbeat_timeout = float(config.get('shard_heartbeat_timeout_seconds', DEFAULT_SHARD_HEARTBEAT_TIMEOUT_SECONDS))
+    active_shards = {shard_index}
+    now = time.time()
+    for other_shard_index in range(num_shards):
+        if other_shard_index == shard_index:
+            continue
+        heartbeat_path = os.path.join(get_leases_dir(config), 'shard-' + str(other_shard_index) + '.heartbeat')
+        try:
+            heartbeat_age = now - os.stat(heartbeat_path).st_mtime
+        except FileNotFoundError as e:
+            heartbeat_age = now - _instance_start_time
+        if heartbeat_age > heartbeat_timeout:
+            logging.warning(json.dumps({"event_type": "adopted_shard", "shard_index": other_shard_index, "heartbeat_age_seconds": heartbeat_age}))
+            active_shards.add(other_shard_index)
+
+    return active_shards
+
+
+def get_run_filter(config, active_shards):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param active_shards: Shards that this instance is collecting, as returned by `get_active_shards`
+    :type active_shards: set[int]
+    :return: Predicate that is True for run IDs in one of the active shards.
+    :rtype: Callable[[str], bool]
+    """
+    _, num_shards, shard_by = get_shard_config(config)
+
+    return lambda run_id: get_shard_for_run(run_id, num_shards, shard_by) in active_shards
+
+
+def _read_lease(lease_path):
+    """
+    :return: The lease, or None if it doesn't exist or can't be read.
+    :rtype: Optional[dict[str, object]]
+    """
+    try:
+        with open(lease_path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.decoder.JSONDecodeError) as e:
+        return None
+
+
+def acquire_run_lease(config, run_id, instance_id):
+    """
+    Take a lease on a run, so that no other instance collects it at the same
+    time. Leases are files created with O_EXCL, which is atomic even across
+    hosts on a shared filesystem. A lease that has expired (for example,
+    because the instance holding it crashed) is taken over.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :param instance_id: ID of this collector instance
+    :type instance_id: str
+    :return: True if the lease was acquired.
+    :rtype: bool
+    """
+    lease_duration = float(config.get('lease_duration_seconds', DEFAULT_LEASE_DURATION_SECONDS))
+    lease_path = os.path.join(get_leases_dir(config), run_id + '.lease')
+    now = time.time()
+    lease = {
+        "run_id": run_id,
+        "instance_id": instance_id,
+        "acquired": now,
+        "expires": now + lease_duration,
+    }
+    try:
+        fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+    except FileExistsError as e:
+        existing_lease = _read_lease(lease_path)
+        if existing_lease is not None:
+            lease_expires = existing_lease['expires']
+        else:
+            # A lease that can't be read is either being written right now,
+            # or was left empty by a crash. Either way, it expires after
+            # lease_duration_seconds, like any other lease.
+            try:
+                lease_expires = os.stat(lease_path).st_mtime + lease_duration
+            except FileNotFoundError as e:
+                return acquire_run_lease(config, run_id, instance_id)
+        if lease_expires > now:
+            return False
+        # Move the expired lease aside. Only one instance can succeed. If the
+        # lease we moved isn't the expired one (another instance took it over
+        # in the meantime), it's put back.
+        expired_lease_path = lease_path + '.' + instance_id.replace('/', '_') + '.expired'
+        try:
+            os.rename(lease_path, expired_lease_path)
+        except FileNotFoundError as e:
+            return False
+        if _read_lease(expired_lease_path) != existing_lease:
+            try:
+                os.link(expired_lease_path, lease_path)
+            except FileExistsError as e:
+                pass
+            os.remove(expired_lease_path)
+            return False
+        os.remove(expired_lease_path)
+        logging.warning(json.dumps({"event_type": "expired_run_lease_taken_over", "run_id": run_id, "previous_lease": existing_lease, "instance_id": instance_id}))
+        return acquire_run_lease(config, run_id, instance_id)
+
+    with os.fdopen(fd, 'w') as f:
+        json.dump(lease, f)
+
+    return True
+
+
+def renew_run_lease(config, run_id, instance_id):
+    """
+    Extend this instance's lease on a run by another `lease_duration_seconds`
+    from now.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :param instance_id: ID of this collector instance
+    :type instance_id: str
+    :return: True if the lease was renewed, False if this instance no longer holds it.
+    :rtype: bool
+    """
+    lease_duration = float(config.get('lease_duration_seconds', DEFAULT_LEASE_DURATION_SECONDS))
+    lease_path = os.path.join(get_leases_dir(config), run_id + '.lease')
+    lease = _read_lease(lease_path)
+    if lease is None or lease['instance_id'] != instance_id:
+        return False
+    lease['expires'] = time.time() + lease_duration
+    tmp_lease_path = state.get_temp_path(lease_path)
+    with open(tmp_lease_path, 'w') as f:
+        json.dump(lease, f)
+    os.replace(tmp_lease_path, lease_path)
+
+    return True
+
+
+def start_lease_renewal(config, run_id, instance_id):
+    """
+    Renew this instance's lease on a run (and its shard's heartbeat) in a
+    background thread, LEASE_RENEWALS_PER_DURATION times per lease duration,
+    so that the lease never expires while the run is being collected, no
+    matter how long that takes.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :param instance_id: ID of this collector instance
+    :type instance_id: str
+    :return: Lease renewal, to be passed to `stop_lease_renewal`
+    :rtype: dict[str, object]
+    """
+    lease_duration = float(config.get('lease_duration_seconds', DEFAULT_LEASE_DURATION_SECONDS))
+    stop_requested = threading.Event()
+
+    def renew_lease():
+        while not stop_requested.wait(lease_duration / LEASE_RENEWALS_PER_DURATION):
+            try:
+                if not renew_run_lease(config, run_id, instance_id):
+                    logging.error(json.dumps({"event_type": "run_lease_lost", "run_id": run_id, "instance_id": instance_id}))
+                    return
+                write_heartbeat(config, instance_id)
+            except OSError as e:
+                # Tried again at the next renewal, well before the lease expires
+                logging.warning(json.dumps({"event_type": "renew_run_lease_failed", "run_id": run_id, "instance_id": instance_id, "error": str(e)}))
+
+    renewal_thread = threading.Thread(target=renew_lease, daemon=True)
+    renewal_thread.start()
+    lease_renewal = {
+        "run_id": run_id,
+        "stop_requested": stop_requested,
+        "thread": renewal_thread,
+    }
+
+    return lease_renewal
+
+
+def stop_lease_renewal(lease_renewal):
+    """
+    Stop renewing a lease, and wait for any renewal in progress to finish,
+    so that the lease isn't renewed after it's released.
+
+    :param lease_renewal: Lease renewal, as returned by `start_lease_renewal`
+    :type lease_renewal: dict[str, object]
+    :return: None
+    :rtype: None
+    """
+    lease_renewal['stop_requested'].set()
+    lease_renewal['thread'].join()
+
+
+def release_run_lease(config, run_id, instance_id):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :param instance_id: ID of this collector instance
+    :type instance_id: str
+    :return: None
+    :rtype: None
+    """
+    lease_path = os.path.join(get_leases_dir(config), run_id + '.lease')
+    lease = _read_lease(lease_path)
+    if lease is not None and lease['instance_id'] == instance_id:
+        os.remove(lease_path)
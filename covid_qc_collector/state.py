@@ -0,0 +1,197 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+
+import covid_qc_collector.metrics as metrics
+
+
+def get_state_dir(config):
+    """
+    Get the directory where the collector keeps its own bookkeeping files.
+    Defaults to a hidden directory inside the output dir (with a subdir
+    per shard, if runs are sharded between several instances).
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Path to the state dir.
+    :rtype: str
+    """
+    if 'state_dir' in config:
+        state_dir = config['state_dir']
+    else:
+        state_dir = os.path.join(config['output_dir'], '.covid-qc-collector')
+        # Sharded instances share an output dir, but each keeps its own state.
+        if int(config.get('num_shards', 1)) > 1:
+            state_dir = os.path.join(state_dir, 'shard-' + str(config.get('shard_index', 0)))
+
+    return state_dir
+
+
+def get_temp_path(path):
+    """
+    Files are written to a temporary path and then renamed into place, so
+    that readers never see a partially-written file. The temporary path is
+    unique to the process and thread writing it, so that two writers (eg.
+    the daemon and the `collect` command) never rename each other's files.
+
+    :param path: Path that will be written.
+    :type path: str
+    :return: Temporary path to write to first, ending in `.tmp`.
+    :rtype: str
+    """
+    return path + '.' + str(os.getpid()) + '-' + str(threading.get_ident()) + '.tmp'
+
+
+def get_locks_dir(config):
+    """
+    Run locks are kept alongside the output dir, where every process that
+    writes to it can see them.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Path to the dir where run locks are kept.
+    :rtype: str
+    """
+    return os.path.join(config['output_dir'], '.locks')
+
+
+def acquire_run_lock(config, run_id):
+    """
+    Lock a run, so that no other process on this host (eg. the daemon and the
+    `collect` command) collects or recovers it at the same time. The lock is
+    released by `release_run_lock`, or when the process exits, however it
+    exits. Locks between sharded instances on different hosts are taken with
+    run leases (see `shard.acquire_run_lease`).
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :return: The lock, or None if the run is locked by another process.
+    :rtype: Optional[io.TextIOWrapper]
+    """
+    run_lock = open(os.path.join(get_locks_dir(config), run_id + '.lock'), 'a')
+    try:
+        fcntl.flock(run_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError as e:
+        run_lock.close()
+        return None
+
+    return run_lock
+
+
+def release_run_lock(run_lock):
+    """
+    :param run_lock: Lock, as returned by `acquire_run_lock`
+    :type run_lock: io.TextIOWrapper
+    :return: None
+    :rtype: None
+    """
+    fcntl.flock(run_lock, fcntl.LOCK_UN)
+    run_lock.close()
+
+
+def load_state(state_path):
+    """
+    Load a JSON state file. Missing or unreadable state files are treated as empty.
+
+    :param state_path: Path to the state file.
+    :type state_path: str
+    :return: Parsed state.
+    :rtype: dict[str, object]
+    """
+    state = {}
+    try:
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+    except FileNotFoundError as e:
+        pass
+    except (json.decoder.JSONDecodeError, UnicodeDecodeError) as e:
+        logging.warning(json.dumps({"event_type": "load_state_failed", "state_file": state_path}))
+
+    return state
+
+
+def save_state(state, state_path):
+    """
+    Write a JSON state file.
+
+    :param state: State to write.
+    :type state: dict[str, object]
+    :param state_path: Path to the state file.
+    :type state_path: str
+    :return: None
+    :rtype: None
+    """
+    tmp_state_path = get_temp_path(state_path)
+    with open(tmp_state_path, 'w') as f:
+        json.dump(state, f)
+        metrics.increment('bytes_written', f.tell())
+    os.replace(tmp_state_path, state_path)
+
+
+def get_path_fingerprint(paths):
+    """
+    Record the mtime of each path (or None if the path doesn't exist).
+
+    :param paths: Paths to fingerprint.
+    :type paths: list[str]
+    :return: mtimes (in nanoseconds) by path.
+    :rtype: dict[str, Optional[int]]
+    """
+    fingerprint = {}
+    for path in paths:
+        try:
+            fingerprint[path] = os.stat(path).st_mtime_ns
+        except FileNotFoundError as e:
+            fingerprint[path] = None
+    metrics.increment('stat_calls', len(fingerprint))
+
+    return fingerprint
+
+
+def get_file_fingerprint(path):
+    """
+    :param path: Path to fingerprint.
+    :type path: str
+    :return: The path, with its size and mtime (in nanoseconds), or None if it doesn't exist.
+    :rtype: Optional[dict[str, object]]
+    """
+    metrics.increment('stat_calls')
+    try:
+        path_stat = os.stat(path)
+    except FileNotFoundError as e:
+        return None
+
+    fingerprint = {
+        "path": path,
+        "size": path_stat.st_size,
+        "mtime_ns": path_stat.st_mtime_ns,
+    }
+
+    return fingerprint
+
+
+def fingerprint_unchanged(fingerprint):
+    """
+    Check whether a fingerprint taken earlier still matches the filesystem.
+    Costs one stat per path in the fingerprint.
+
+    :param fingerprint: mtimes by path, as produced by `get_path_fingerprint`
+    :type fingerprint: dict[str, Optional[int]]
+    :return: True if every path still has the recorded mtime.
+    :rtype: bool
+    """
+    return get_path_fingerprint(fingerprint.keys()) == fingerprint
+
+
+def is_run_ready(run_state):
+    """
+    :param run_state: A run's entry in the scan state
+    :type run_state: dict[str, object]
+    :return: True if the run was ready to collect when it was last checked. Entries written before readiness was recorded are ready if the run was collected.
+    :rtype: bool
+    """
+    return run_state.get('ready', run_state['collected'])
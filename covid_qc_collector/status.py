@@ -0,0 +1,283 @@
+import collections
+import datetime
+import http.server
+import json
+import logging
+import threading
+import time
+
+import covid_qc_collector.metrics as metrics
+
+# What the collector is doing. Only one phase is current at a time.
+PHASES = [
+    'starting',
+    'recovering',
+    'plates_by_run',
+    'scanning',
+    'collecting',
+    'waiting',
+    'watching',
+]
+
+# The status server only ever listens on the loopback interface
+STATUS_SERVER_HOST = '127.0.0.1'
+
+# Runs collected per minute is averaged over this many seconds
+RUNS_PER_MINUTE_WINDOW_SECONDS = 600.0
+
+_lock = threading.Lock()
+_start_time = time.monotonic()
+_phase = 'starting'
+_current_runs = {}
+_queue_depth = 0
+_num_runs_collected = 0
+# Times (from time.monotonic) that runs were collected, within the window
+_run_collected_times = collections.deque()
+_last_scan_metrics = None
+_last_scan_completed = None
+_scan_requested = threading.Event()
+
+
+def set_phase(phase):
+    """
+    :param phase: One of PHASES
+    :type phase: str
+    :return: None
+    :rtype: None
+    """
+    global _phase
+    with _lock:
+        _phase = phase
+
+
+def set_queue_depth(queue_depth):
+    """
+    :param queue_depth: Number of runs that are ready to collect, but haven't been started.
+    :type queue_depth: int
+    :return: None
+    :rtype: None
+    """
+    global _queue_depth
+    with _lock:
+        _queue_depth = queue_depth
+
+
+def run_started(run_id):
+    """
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :return: None
+    :rtype: None
+    """
+    with _lock:
+        _current_runs[run_id] = datetime.datetime.now().isoformat()
+
+
+def run_finished(run_id, collected):
+    """
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :param collected: Whether the run was collected (False if it was skipped, or collecting it failed)
+    :type collected: bool
+    :return: None
+    :rtype: None
+    """
+    global _num_runs_collected
+    with _lock:
+        _current_runs.pop(run_id, None)
+        if collected:
+            _num_runs_collected += 1
+            _run_collected_times.append(time.monotonic())
+
+
+def scan_completed(scan_metrics):
+    """
+    :param scan_metrics: Metrics for the scan that just completed, as produced by `metrics.end_scan`
+    :type scan_metrics: dict[str, object]
+    :return: None
+    :rtype: None
+    """
+    global _last_scan_metrics, _last_scan_completed
+    with _lock:
+        _last_scan_metrics = scan_metrics
+        _last_scan_completed = datetime.datetime.now().isoformat()
+
+
+def request_scan():
+    """
+    Start the next scan now, instead of waiting for `scan_interval_seconds`
+    to pass.
+
+    :return: None
+    :rtype: None
+    """
+    _scan_requested.set()
+
+
+def scan_requested():
+    """
+    :return: True if a scan has been requested since the last one started.
+    :rtype: bool
+    """
+    return _scan_requested.is_set()
+
+
+def wait_for_scan_request(timeout):
+    """
+    Wait until a scan is requested, or until `timeout` seconds have passed,
+    whichever comes first. The request is cleared, so that the scan it
+    started doesn't also satisfy the next wait.
+
+    :param timeout: Maximum time to wait, in seconds
+    :type timeout: float
+    :return: True if a scan was requested.
+    :rtype: bool
+    """
+    requested = _scan_requested.wait(timeout)
+    _scan_requested.clear()
+
+    return requested
+
+
+def get_status():
+    """
+    :return: What the collector is doing, and counters since it was started.
+    :rtype: dict[str, object]
+    """
+    now = time.monotonic()
+    with _lock:
+        while _run_collected_times and _run_collected_times[0] < now - RUNS_PER_MINUTE_WINDOW_SECONDS:
+            _run_collected_times.popleft()
+        # Until the window has passed, the rate is averaged over the time
+        # since the collector was started (but at least a minute).
+        window_minutes = min(RUNS_PER_MINUTE_WINDOW_SECONDS, max(now - _start_time, 60.0)) / 60
+        runs_collected_per_minute = len(_run_collected_times) / window_minutes
+        last_scan_duration_seconds = None
+        if _last_scan_metrics is not None:
+            last_scan_duration_seconds = _last_scan_metrics['scan_duration_seconds']
+        collector_status = {
+            "phase": _phase,
+            "current_runs": [{"run_id": run_id, "started": started} for run_id, started in sorted(_current_runs.items())],
+            "queue_depth": _queue_depth,
+            "num_runs_collected": _num_runs_collected,
+            "runs_collected_per_minute": round(runs_collected_per_minute, 3),
+            "last_scan_completed": _last_scan_completed,
+            "last_scan_duration_seconds": last_scan_duration_seconds,
+            "scan_requested": _scan_requested.is_set(),
+            "uptime_seconds": round(now - _start_time, 3),
+        }
+        last_scan_metrics = _last_scan_metrics
+    collector_status['total_counters'] = metrics.get_total_counters()
+    collector_status['last_scan_metrics'] = last_scan_metrics
+
+    return collector_status
+
+
+def format_prometheus(collector_status):
+    """
+    Format the collector's status in the Prometheus text exposition format,
+    followed by the metrics for the last scan (if one has completed).
+
+    :param collector_status: Status, as returned by `get_status`
+    :type collector_status: dict[str, object]
+    :return: Status in Prometheus text format
+    :rtype: str
+    """
+    lines = []
+    metric_name = metrics.PROMETHEUS_METRIC_PREFIX + '_phase'
+    lines.append('# HELP ' + metric_name + ' What the collector is doing (1 for the current phase).')
+    lines.append('# TYPE ' + metric_name + ' gauge')
+    for phase in PHASES:
+        lines.append(metric_name + '{phase="' + phase + '"} ' + ('1' if phase == collector_status['phase'] else '0'))
+
+    gauges = [
+        ('runs_in_progress', 'Runs that are being collected.', len(collector_status['current_runs'])),
+        ('queue_depth', 'Runs that are ready to collect, but have not been started.', collector_status['queue_depth']),
+        ('runs_collected_per_minute', 'Runs collected per minute, over the last ' + str(int(RUNS_PER_MINUTE_WINDOW_SECONDS)) + ' seconds.', collector_status['runs_collected_per_minute']),
+        ('uptime_seconds', 'Time since the collector was started.', collector_status['uptime_seconds']),
+    ]
+    for name, help_text, value in gauges:
+        metric_name = metrics.PROMETHEUS_METRIC_PREFIX + '_' + name
+        lines.append('# HELP ' + metric_name + ' ' + help_text)
+        lines.append('# TYPE ' + metric_name + ' gauge')
+        lines.append(metric_name + ' ' + str(value))
+
+    metric_name = metrics.PROMETHEUS_METRIC_PREFIX + '_runs_collected_total'
+    lines.append('# HELP ' + metric_name + ' Runs collected since the collector was started.')
+    lines.append('# TYPE ' + metric_name + ' counter')
+    lines.append(metric_name + ' ' + str(collector_status['num_runs_collected']))
+
+    if collector_status['last_scan_metrics'] is not None:
+        # Cumulative counters are reported as they are now, not as they were
+        # at the end of the last scan.
+        last_scan_metrics = dict(collector_status['last_scan_metrics'])
+        last_scan_metrics['total_counters'] = collector_status['total_counters']
+        return '\n'.join(lines) + '\n' + metrics.format_prometheus(last_scan_metrics)
+
+    for counter in metrics.COUNTERS:
+        metric_name = metrics.PROMETHEUS_METRIC_PREFIX + '_' + counter + '_total'
+        lines.append('# TYPE ' + metric_name + ' counter')
+        lines.append(metric_name + ' ' + str(collector_status['total_counters'][counter]))
+
+    return '\n'.join(lines) + '\n'
+
+
+class StatusRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    GET /status: Status, as JSON
+    GET /metrics: Status and scan metrics, in Prometheus text format
+    POST /scan: Start the next scan now
+    """
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.send_body(200, 'application/json', json.dumps(get_status(), indent=2) + '\n')
+        elif self.path == '/metrics':
+            self.send_body(200, 'text/plain; version=0.0.4', format_prometheus(get_status()))
+        else:
+            self.send_body(404, 'application/json', json.dumps({"error": "not found"}) + '\n')
+
+    def do_POST(self):
+        if self.path == '/scan':
+            request_scan()
+            logging.info(json.dumps({"event_type": "scan_requested"}))
+            self.send_body(202, 'application/json', json.dumps({"scan_requested": True}) + '\n')
+        else:
+            self.send_body(404, 'application/json', json.dumps({"error": "not found"}) + '\n')
+
+    def send_body(self, status_code, content_type, body):
+        body = body.encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(json.dumps({"event_type": "status_request", "client_address": self.client_address[0], "request": format % args}))
+
+
+def start_status_server(config):
+    """
+    Start serving status on localhost, at `status_port`, in a background
+    thread. Does nothing if `status_port` isn't set.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: The server, or None if it isn't configured or couldn't be started.
+    :rtype: Optional[http.server.ThreadingHTTPServer]
+    """
+    if config.get('status_port', None) is None:
+        return None
+    status_port = int(config['status_port'])
+    try:
+        server = http.server.ThreadingHTTPServer((STATUS_SERVER_HOST, status_port), StatusRequestHandler)
+    except OSError as e:
+        logging.error(json.dumps({"event_type": "start_status_server_failed", "status_port": status_port, "error": str(e)}))
+        return None
+    server.daemon_threads = True
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    logging.info(json.dumps({"event_type": "status_server_started", "host": STATUS_SERVER_HOST, "status_port": server.server_address[1]}))
+
+    return server
@@ -0,0 +1,184 @@
+import concurrent.futures
+import errno
+import json
+import logging
+import os
+import shutil
+import time
+
+import covid_qc_collector.metrics as metrics
+import covid_qc_collector.state as state
+
+# Ordered from cheapest to most expensive. If a transfer fails using the
+# requested mode, each of the following modes is tried in turn.
+TRANSFER_MODES = [
+    'hardlink',
+    'reflink',
+    'copy_file_range',
+    'copy',
+]
+
+DEFAULT_TRANSFER_MODE = 'copy'
+DEFAULT_TRANSFER_WORKERS = 4
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+
+def _hardlink(src, dst):
+    """
+    """
+    os.link(src, dst)
+
+
+def _reflink(src, dst):
+    """
+    """
+    try:
+        import fcntl
+    except ImportError as e:
+        raise OSError(errno.ENOTSUP, "reflink not supported on this platform")
+
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+
+
+def _copy_file_range(src, dst):
+    """
+    Copy using `os.copy_file_range` where available, falling back to
+    `os.sendfile`. Both keep the data in the kernel.
+    """
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        src_fd = src_file.fileno()
+        dst_fd = dst_file.fileno()
+        num_bytes_to_copy = os.fstat(src_fd).st_size
+        copy_chunk_functions = []
+        if hasattr(os, 'copy_file_range'):
+            copy_chunk_functions.append(lambda offset: os.copy_file_range(src_fd, dst_fd, num_bytes_to_copy - offset, offset, offset))
+        if hasattr(os, 'sendfile'):
+            copy_chunk_functions.append(lambda offset: os.sendfile(dst_fd, src_fd, offset, num_bytes_to_copy - offset))
+        if not copy_chunk_functions:
+            raise OSError(errno.ENOTSUP, "copy_file_range and sendfile not supported on this platform")
+        num_bytes_copied = 0
+        while num_bytes_copied < num_bytes_to_copy:
+            try:
+                num_bytes_copied_in_chunk = copy_chunk_functions[0](num_bytes_copied)
+            except OSError as e:
+                # Some filesystems (or older kernels) don't support copy_file_range
+                # between the source and destination, but may still support sendfile.
+                if num_bytes_copied == 0 and len(copy_chunk_functions) > 1:
+                    copy_chunk_functions.pop(0)
+                    continue
+                raise
+            if num_bytes_copied_in_chunk == 0:
+                break
+            num_bytes_copied += num_bytes_copied_in_chunk
+
+
+def _copy(src, dst):
+    """
+    """
+    shutil.copyfile(src, dst)
+
+
+TRANSFER_FUNCTIONS = {
+    'hardlink': _hardlink,
+    'reflink': _reflink,
+    'copy_file_range': _copy_file_range,
+    'copy': _copy,
+}
+
+
+def get_transfer_mode(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Transfer mode from config, or the default if not set or not valid.
+    :rtype: str
+    """
+    transfer_mode = config.get('transfer_mode', DEFAULT_TRANSFER_MODE)
+    if transfer_mode not in TRANSFER_MODES:
+        logging.error(json.dumps({"event_type": "invalid_transfer_mode", "transfer_mode": transfer_mode, "valid_transfer_modes": TRANSFER_MODES}))
+        transfer_mode = DEFAULT_TRANSFER_MODE
+
+    return transfer_mode
+
+
+def transfer_file(src, dst, transfer_mode=DEFAULT_TRANSFER_MODE):
+    """
+    Transfer `src` to `dst`, using the requested transfer mode if possible.
+    If it fails, the remaining (more expensive) modes are tried in order.
+
+    :param src: Source file path
+    :type src: str
+    :param dst: Destination file path
+    :type dst: str
+    :param transfer_mode: One of TRANSFER_MODES
+    :type transfer_mode: str
+    :return: The transfer mode that was used, and the number of bytes transferred.
+    :rtype: tuple[str, int]
+    """
+    tmp_dst = state.get_temp_path(dst)
+    fallback_modes = TRANSFER_MODES[TRANSFER_MODES.index(transfer_mode):]
+    for mode in fallback_modes:
+        try:
+            if os.path.exists(tmp_dst):
+                os.remove(tmp_dst)
+            TRANSFER_FUNCTIONS[mode](src, tmp_dst)
+            os.replace(tmp_dst, dst)
+            num_bytes = os.stat(dst).st_size
+            return mode, num_bytes
+        except OSError as e:
+            if os.path.exists(tmp_dst):
+                os.remove(tmp_dst)
+            if mode == fallback_modes[-1]:
+                raise
+            logging.debug(json.dumps({"event_type": "transfer_mode_failed", "transfer_mode": mode, "src_file": src, "dst_file": dst, "error": str(e)}))
+
+
+def transfer_files(transfers, transfer_mode=DEFAULT_TRANSFER_MODE, max_workers=DEFAULT_TRANSFER_WORKERS):
+    """
+    Transfer several files concurrently. Each transfer is a dict with
+    `src_file` and `dst_file` keys, plus an `event_type` to log when
+    the transfer is complete. Any other keys are included in the log event.
+
+    :param transfers: Files to transfer
+    :type transfers: list[dict[str, object]]
+    :param transfer_mode: One of TRANSFER_MODES
+    :type transfer_mode: str
+    :param max_workers: Maximum number of concurrent transfers
+    :type max_workers: int
+    :return: Total number of bytes transferred
+    :rtype: int
+    """
+    total_bytes = 0
+    if not transfers:
+        return total_bytes
+
+    def timed_transfer(t):
+        start = time.perf_counter()
+        mode, num_bytes = transfer_file(t['src_file'], t['dst_file'], transfer_mode)
+        return mode, num_bytes, time.perf_counter() - start
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(timed_transfer, t) for t in transfers]
+        for t, future in zip(transfers, futures):
+            mode, num_bytes, duration_seconds = future.result()
+            total_bytes += num_bytes
+            # Hardlinks share the source's data, so nothing is copied.
+            if mode != 'hardlink':
+                metrics.increment('bytes_copied', num_bytes)
+            throughput_megabytes_per_second = None
+            if duration_seconds > 0:
+                throughput_megabytes_per_second = round(num_bytes / duration_seconds / 1_000_000, 3)
+            event = {"event_type": t['event_type']}
+            event.update({k: v for k, v in t.items() if k != 'event_type'})
+            event.update({
+                "transfer_mode": mode,
+                "bytes_transferred": num_bytes,
+                "duration_seconds": round(duration_seconds, 6),
+                "throughput_megabytes_per_second": throughput_megabytes_per_second,
+            })
+            logging.info(json.dumps(event))
+
+    return total_bytes
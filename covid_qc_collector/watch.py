@@ -0,0 +1,307 @@
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import json
+import logging
+import os
+import re
+import select
+import struct
+import time
+
+import covid_qc_collector.layout as layout
+import covid_qc_collector.state as state
+
+DEFAULT_WATCH_POLL_INTERVAL_SECONDS = 60.0
+
+# 'auto' uses inotify, unless the analysis_by_run_dir is on a network
+# filesystem, where inotify only sees changes made by this host.
+WATCH_METHODS = [
+    'auto',
+    'inotify',
+    'poll',
+]
+
+DEFAULT_WATCH_METHOD = 'auto'
+
+# Filesystem types (as listed in /proc/mounts) that are shared between hosts
+NETWORK_FILESYSTEM_TYPES = {
+    '9p',
+    'afs',
+    'beegfs',
+    'ceph',
+    'cifs',
+    'fuse.glusterfs',
+    'fuse.sshfs',
+    'glusterfs',
+    'gpfs',
+    'lustre',
+    'nfs',
+    'nfs4',
+    'panfs',
+    'smb3',
+    'smbfs',
+}
+
+MOUNTS_PATH = '/proc/mounts'
+
+# From sys/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+INOTIFY_EVENT_HEADER = struct.Struct('iIII')
+INOTIFY_WATCH_MASK = IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE | IN_ONLYDIR
+
+# Depth of each watched directory below the analysis_by_run_dir
+ANALYSIS_BY_RUN_DEPTH = 0
+RUN_DEPTH = 1
+ARTIC_OUTPUT_DEPTH = 2
+NCOV_TOOLS_OUTPUT_DEPTH = 3
+
+
+class WatchUnavailable(Exception):
+    pass
+
+
+def get_watch_method(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Watch method from config, or the default if not set or not valid.
+    :rtype: str
+    """
+    watch_method = config.get('watch_method', DEFAULT_WATCH_METHOD)
+    if watch_method not in WATCH_METHODS:
+        logging.error(json.dumps({"event_type": "invalid_watch_method", "watch_method": watch_method, "valid_watch_methods": WATCH_METHODS}))
+        watch_method = DEFAULT_WATCH_METHOD
+
+    return watch_method
+
+
+def get_filesystem_type(path):
+    """
+    Find the type of the filesystem that `path` is on, from the mount with
+    the longest mount point that contains it.
+
+    :param path: Path to check.
+    :type path: str
+    :return: Filesystem type (eg. 'ext4', 'nfs4'), or None if it can't be determined.
+    :rtype: Optional[str]
+    """
+    real_path = os.path.realpath(path)
+    filesystem_type = None
+    longest_mount_point = ''
+    try:
+        with open(MOUNTS_PATH, 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # Spaces (and other special characters) in mount points are octal-escaped, eg. '\040'
+                mount_point = re.sub('\\\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), fields[1])
+                is_under_mount_point = mount_point == '/' or real_path == mount_point or real_path.startswith(mount_point + '/')
+                if is_under_mount_point and len(mount_point) >= len(longest_mount_point):
+                    longest_mount_point = mount_point
+                    filesystem_type = fields[2]
+    except OSError as e:
+        return None
+
+    return filesystem_type
+
+
+def _load_libc():
+    """
+    :return: libc, if it provides inotify. Otherwise None.
+    :rtype: Optional[ctypes.CDLL]
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError) as e:
+        return None
+
+    return libc
+
+
+def _add_inotify_watch(libc, inotify_fd, watches, path, run_id, depth):
+    """
+    Add a watch on `path`, and record it in `watches` (by watch descriptor).
+
+    :raises WatchUnavailable: If the watch couldn't be added because of a resource limit.
+    """
+    wd = libc.inotify_add_watch(inotify_fd, os.fsencode(path), INOTIFY_WATCH_MASK)
+    if wd < 0:
+        err = ctypes.get_errno()
+        if err in (errno.ENOSPC, errno.ENOMEM):
+            raise WatchUnavailable(os.strerror(err))
+        # The dir may have disappeared before we could watch it
+        logging.debug(json.dumps({"event_type": "add_watch_failed", "path": path, "error": os.strerror(err)}))
+        return
+    watches[wd] = (path, run_id, depth)
+
+
+def _add_run_watches(libc, inotify_fd, watches, run_dir_path, watch_contents):
+    """
+    Watch a run dir for new artic output dirs. If `watch_contents` is True,
+    also watch the existing artic and ncov-tools output dirs inside it for
+    `analysis_complete.json` markers.
+    """
+    run_id = os.path.basename(run_dir_path)
+    _add_inotify_watch(libc, inotify_fd, watches, run_dir_path, run_id, RUN_DEPTH)
+    if not watch_contents:
+        return
+    try:
+        for artic_output_dir in os.scandir(run_dir_path):
+            if artic_output_dir.is_dir() and fnmatch.fnmatch(artic_output_dir.name, layout.ARTIC_OUTPUT_DIR_GLOB):
+                _add_inotify_watch(libc, inotify_fd, watches, artic_output_dir.path, run_id, ARTIC_OUTPUT_DEPTH)
+                for ncov_tools_output_dir in os.scandir(artic_output_dir.path):
+                    if ncov_tools_output_dir.is_dir() and fnmatch.fnmatch(ncov_tools_output_dir.name, layout.NCOV_TOOLS_OUTPUT_DIR_GLOB):
+                        _add_inotify_watch(libc, inotify_fd, watches, ncov_tools_output_dir.path, run_id, NCOV_TOOLS_OUTPUT_DEPTH)
+    except FileNotFoundError as e:
+        pass
+
+
+def _inotify_watch(libc, analysis_by_run_dir, scan_state, timeout_seconds):
+    """
+    Watch the analysis_by_run_dir using inotify. Every run dir is watched for
+    new analysis output dirs, and runs that aren't ready to collect yet are
+    also watched for `analysis_complete.json` markers.
+    """
+    inotify_fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+    if inotify_fd < 0:
+        raise WatchUnavailable(os.strerror(ctypes.get_errno()))
+
+    try:
+        watches = {}
+        _add_inotify_watch(libc, inotify_fd, watches, analysis_by_run_dir, None, ANALYSIS_BY_RUN_DEPTH)
+        for run_dir in os.scandir(analysis_by_run_dir):
+            if not run_dir.is_dir():
+                continue
+            run_state = scan_state['runs'].get(run_dir.name, None)
+            watch_contents = run_state is None or not state.is_run_ready(run_state)
+            _add_run_watches(libc, inotify_fd, watches, os.path.abspath(run_dir.path), watch_contents)
+        logging.info(json.dumps({"event_type": "watch_started", "watch_method": "inotify", "num_watches": len(watches)}))
+
+        while True:
+            changed_run_ids = set()
+            readable, _, _ = select.select([inotify_fd], [], [], timeout_seconds)
+            if readable:
+                try:
+                    buf = os.read(inotify_fd, 65536)
+                except BlockingIOError as e:
+                    buf = b''
+                offset = 0
+                while offset < len(buf):
+                    wd, mask, cookie, name_length = INOTIFY_EVENT_HEADER.unpack_from(buf, offset)
+                    offset += INOTIFY_EVENT_HEADER.size
+                    name = os.fsdecode(buf[offset:offset + name_length].rstrip(b'\0'))
+                    offset += name_length
+                    if mask & IN_Q_OVERFLOW:
+                        # Events were dropped. We'll need to wait for the next full scan to catch up.
+                        logging.warning(json.dumps({"event_type": "watch_event_queue_overflow"}))
+                        continue
+                    if mask & IN_IGNORED:
+                        watches.pop(wd, None)
+                        continue
+                    if wd not in watches:
+                        continue
+                    path, run_id, depth = watches[wd]
+                    child_path = os.path.join(path, name)
+                    is_dir = bool(mask & IN_ISDIR)
+                    if depth == ANALYSIS_BY_RUN_DEPTH and is_dir:
+                        _add_run_watches(libc, inotify_fd, watches, child_path, True)
+                        changed_run_ids.add(name)
+                    elif depth == RUN_DEPTH and is_dir and fnmatch.fnmatch(name, layout.ARTIC_OUTPUT_DIR_GLOB):
+                        _add_inotify_watch(libc, inotify_fd, watches, child_path, run_id, ARTIC_OUTPUT_DEPTH)
+                        changed_run_ids.add(run_id)
+                    elif depth == ARTIC_OUTPUT_DEPTH and is_dir and fnmatch.fnmatch(name, layout.NCOV_TOOLS_OUTPUT_DIR_GLOB):
+                        _add_inotify_watch(libc, inotify_fd, watches, child_path, run_id, NCOV_TOOLS_OUTPUT_DEPTH)
+                        changed_run_ids.add(run_id)
+                    elif depth >= ARTIC_OUTPUT_DEPTH and name == layout.ANALYSIS_COMPLETE_FILE:
+                        changed_run_ids.add(run_id)
+            yield changed_run_ids
+    finally:
+        os.close(inotify_fd)
+
+
+def _poll_watch(analysis_by_run_dir, scan_state, timeout_seconds):
+    """
+    Watch the analysis_by_run_dir by polling directory mtimes. New run dirs
+    are found by listing the analysis_by_run_dir only when its mtime
+    changes. Runs that aren't ready to collect are checked against their
+    full fingerprint, and collected runs only by the mtime of their run dir.
+    """
+    analysis_by_run_dir_mtime = os.stat(analysis_by_run_dir).st_mtime_ns
+    known_run_ids = set(os.listdir(analysis_by_run_dir))
+    logging.info(json.dumps({"event_type": "watch_started", "watch_method": "poll", "poll_interval_seconds": timeout_seconds}))
+
+    while True:
+        time.sleep(timeout_seconds)
+        changed_run_ids = set()
+        current_mtime = os.stat(analysis_by_run_dir).st_mtime_ns
+        if current_mtime != analysis_by_run_dir_mtime:
+            analysis_by_run_dir_mtime = current_mtime
+            current_run_ids = set(os.listdir(analysis_by_run_dir))
+            changed_run_ids.update(current_run_ids - known_run_ids)
+            known_run_ids = current_run_ids
+
+        for run_id, run_state in list(scan_state['runs'].items()):
+            fingerprint = run_state['fingerprint']
+            if state.is_run_ready(run_state):
+                run_dir_path = next(iter(fingerprint))
+                fingerprint = {run_dir_path: fingerprint[run_dir_path]}
+            if not state.fingerprint_unchanged(fingerprint):
+                changed_run_ids.add(run_id)
+
+        yield changed_run_ids
+
+
+def watch_analysis_by_run_dir(config, scan_state, timeout_seconds=DEFAULT_WATCH_POLL_INTERVAL_SECONDS):
+    """
+    Watch the analysis_by_run_dir for new run dirs and for `analysis_complete.json`
+    markers, using the `watch_method` from config. With 'auto', inotify is
+    used where available, unless the analysis_by_run_dir is on a network
+    filesystem (where changes made by other hosts aren't reported). If
+    inotify can't be used, directory mtimes are polled instead.
+
+    :param config: Application config.
+    :type config: dict[str, object]
+    :param scan_state: Scan state, used to decide which runs need to be watched closely.
+    :type scan_state: dict[str, object]
+    :param timeout_seconds: Maximum time to wait before yielding (possibly with no changes).
+    :type timeout_seconds: float
+    :return: IDs of runs that may have changed. An empty set if nothing changed before the timeout.
+    :rtype: Iterator[set[str]]
+    """
+    analysis_by_run_dir = os.path.abspath(config['analysis_by_run_dir'])
+    watch_method = get_watch_method(config)
+    libc = None
+    if watch_method == 'auto':
+        filesystem_type = get_filesystem_type(analysis_by_run_dir)
+        if filesystem_type in NETWORK_FILESYSTEM_TYPES:
+            logging.info(json.dumps({"event_type": "inotify_skipped_network_filesystem", "analysis_by_run_dir": analysis_by_run_dir, "filesystem_type": filesystem_type}))
+        else:
+            libc = _load_libc()
+    elif watch_method == 'inotify':
+        libc = _load_libc()
+        if libc is None:
+            logging.warning(json.dumps({"event_type": "inotify_watch_unavailable", "error": "libc does not provide inotify"}))
+    if libc is not None:
+        watcher = _inotify_watch(libc, analysis_by_run_dir, scan_state, timeout_seconds)
+        try:
+            yield from watcher
+        except WatchUnavailable as e:
+            logging.warning(json.dumps({"event_type": "inotify_watch_unavailable", "error": str(e)}))
+        finally:
+            watcher.close()
+
+    yield from _poll_watch(analysis_by_run_dir, scan_state, timeout_seconds)
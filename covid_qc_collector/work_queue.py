@@ -0,0 +1,95 @@
+import heapq
+import json
+import logging
+import os
+import re
+
+import covid_qc_collector.status as status
+
+RUN_DATE_REGEX = re.compile("(\\d{6})_")
+
+
+def get_run_date(run_id):
+    """
+    :param run_id: Sequencing run ID, beginning with the run date (YYMMDD_)
+    :type run_id: str
+    :return: Run date as YYMMDD, or None if the run ID doesn't start with a date.
+    :rtype: Optional[str]
+    """
+    run_date = None
+    run_date_match = RUN_DATE_REGEX.match(run_id)
+    if run_date_match:
+        run_date = run_date_match.group(1)
+
+    return run_date
+
+
+def get_run_priority(run_id, scan_state=None, priority_runs=None):
+    """
+    Runs that operators have bumped come first, then runs that have never
+    been collected, then runs being re-collected (backfill). Within each of
+    those groups, the newest runs come first.
+
+    :param run_id: Sequencing run ID
+    :type run_id: str
+    :param scan_state: Scan state, used to determine whether the run has been collected before.
+    :type scan_state: Optional[dict[str, object]]
+    :param priority_runs: Run IDs that have been bumped by operators.
+    :type priority_runs: Optional[set[str]]
+    :return: Priority. Lower values are collected first.
+    :rtype: tuple
+    """
+    is_priority_run = priority_runs is not None and run_id in priority_runs
+    previously_collected = False
+    if scan_state is not None and run_id in scan_state['runs']:
+        previously_collected = scan_state['runs'][run_id].get('collected', False)
+    run_date = int(get_run_date(run_id) or 0)
+
+    priority = (not is_priority_run, previously_collected, -run_date, run_id)
+
+    return priority
+
+
+def iter_by_priority(runs, scan_state=None, priority_runs=None):
+    """
+    Queue runs that are ready to collect, then yield them in priority order
+    (see `get_run_priority`). Every run is queued before the first is yielded,
+    so a newer run found late in the scan is still collected first.
+
+    :param runs: Runs that are ready to collect (or None), as yielded by `core.scan`
+    :type runs: Iterator[Optional[dict[str, object]]]
+    :param scan_state: Scan state
+    :type scan_state: Optional[dict[str, object]]
+    :param priority_runs: Run IDs that have been bumped by operators.
+    :type priority_runs: Optional[set[str]]
+    :return: Runs, highest priority first
+    :rtype: Iterator[dict[str, object]]
+    """
+    queue = []
+    num_priority_runs = 0
+    num_backfill_runs = 0
+    for run in runs:
+        if run is None:
+            continue
+        run_id = os.path.basename(run['path'])
+        priority = get_run_priority(run_id, scan_state, priority_runs)
+        if not priority[0]:
+            num_priority_runs += 1
+        if priority[1]:
+            num_backfill_runs += 1
+        # The run ID is the last element of the priority, so priorities are
+        # unique, and the runs themselves are never compared.
+        heapq.heappush(queue, (priority, run))
+        status.set_queue_depth(len(queue))
+
+    logging.info(json.dumps({
+        "event_type": "work_queue_ready",
+        "num_runs": len(queue),
+        "num_priority_runs": num_priority_runs,
+        "num_backfill_runs": num_backfill_runs,
+    }))
+
+    while queue:
+        priority, run = heapq.heappop(queue)
+        status.set_queue_depth(len(queue))
+        yield run
@@ -0,0 +1,180 @@
+import gzip
+import itertools
+import json
+import logging
+import os
+
+import covid_qc_collector.metrics as metrics
+import covid_qc_collector.parsers as parsers
+import covid_qc_collector.state as state
+
+# 'pretty' is identical to `json.dump(records, f, indent=2)`. 'compact' is a
+# JSON array with no whitespace, and 'gzip' is the same, gzip-compressed.
+# 'ndjson' writes one record per line.
+OUTPUT_ENCODINGS = [
+    'pretty',
+    'compact',
+    'ndjson',
+    'gzip',
+]
+
+DEFAULT_OUTPUT_ENCODING = 'pretty'
+
+OUTPUT_FILE_EXTENSIONS = {
+    'pretty': '.json',
+    'compact': '.json',
+    'ndjson': '.ndjson',
+    'gzip': '.json.gz',
+}
+
+# Number of records encoded at a time
+ENCODE_BATCH_SIZE = 1000
+
+# Level 6 compresses almost as well as the default (9), in much less time
+GZIP_COMPRESSLEVEL = 6
+
+
+def get_output_encoding(config):
+    """
+    :param config: Application config.
+    :type config: dict[str, object]
+    :return: Output encoding from config, or the default if not set or not valid.
+    :rtype: str
+    """
+    output_encoding = config.get('output_encoding', DEFAULT_OUTPUT_ENCODING)
+    if output_encoding not in OUTPUT_ENCODINGS:
+        logging.error(json.dumps({"event_type": "invalid_output_encoding", "output_encoding": output_encoding, "valid_output_encodings": OUTPUT_ENCODINGS}))
+        output_encoding = DEFAULT_OUTPUT_ENCODING
+
+    return output_encoding
+
+
+def get_output_filename(basename, output_encoding=DEFAULT_OUTPUT_ENCODING):
+    """
+    :param basename: Output filename, without extension (eg. `<run_id>_qc`)
+    :type basename: str
+    :param output_encoding: One of OUTPUT_ENCODINGS
+    :type output_encoding: str
+    :return: Output filename, with the extension for the encoding.
+    :rtype: str
+    """
+    return basename + OUTPUT_FILE_EXTENSIONS[output_encoding]
+
+
+def iter_encoded(records, output_encoding=DEFAULT_OUTPUT_ENCODING):
+    """
+    Encode records a batch at a time, so that they never need to be held in
+    memory all together. Each batch is encoded as a JSON array in one call
+    to the encoder, and the array's brackets are stripped, which is much
+    faster than encoding each record on its own.
+
+    :param records: Records to encode. Parsed records are converted to dicts a batch at a time, as they're encoded.
+    :type records: Iterable[Union[dict[str, object], parsers.Record]]
+    :param output_encoding: One of OUTPUT_ENCODINGS
+    :type output_encoding: str
+    :return: Encoded output, in chunks
+    :rtype: Iterator[str]
+    """
+    records = iter(records)
+    if output_encoding == 'pretty':
+        # A non-empty array is encoded as '[\n' + items + '\n]'
+        encode_batch = lambda batch: json.dumps(batch, indent=2)[2:-2]
+        start, separator, end = '[\n', ',\n', '\n]'
+    elif output_encoding == 'ndjson':
+        encode_batch = lambda batch: '\n'.join(json.dumps(record, separators=(',', ':')) for record in batch)
+        start, separator, end = '', '\n', '\n'
+    else:
+        encode_batch = lambda batch: json.dumps(batch, separators=(',', ':'))[1:-1]
+        start, separator, end = '[', ',', ']'
+
+    records = (record.to_dict() if isinstance(record, parsers.Record) else record for record in records)
+    batch = list(itertools.islice(records, ENCODE_BATCH_SIZE))
+    if not batch:
+        if output_encoding != 'ndjson':
+            yield '[]'
+        return
+
+    yield start
+    while batch:
+        yield encode_batch(batch)
+        batch = list(itertools.islice(records, ENCODE_BATCH_SIZE))
+        if batch:
+            yield separator
+    yield end
+
+
+def _write_chunks(chunks, dst_file, compress=False):
+    """
+    Write chunks of encoded output to `dst_file`.
+
+    :return: Number of bytes written
+    :rtype: int
+    """
+    tmp_dst_file = state.get_temp_path(dst_file)
+    try:
+        with open(tmp_dst_file, 'wb') as f:
+            if compress:
+                # mtime=0 so that the same records always produce the same file
+                with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=GZIP_COMPRESSLEVEL, mtime=0) as gz:
+                    for chunk in chunks:
+                        gz.write(chunk.encode('utf-8'))
+            else:
+                for chunk in chunks:
+                    f.write(chunk.encode('utf-8'))
+            num_bytes = f.tell()
+        os.replace(tmp_dst_file, dst_file)
+    except BaseException as e:
+        if os.path.exists(tmp_dst_file):
+            os.remove(tmp_dst_file)
+        raise
+    metrics.increment('bytes_written', num_bytes)
+
+    return num_bytes
+
+
+def write_records(records, dst_file, output_encoding=DEFAULT_OUTPUT_ENCODING):
+    """
+    Stream records to a file.
+
+    :param records: Records to write
+    :type records: Iterable[dict[str, object]]
+    :param dst_file: Path to write to.
+    :type dst_file: str
+    :param output_encoding: One of OUTPUT_ENCODINGS
+    :type output_encoding: str
+    :return: Number of bytes written
+    :rtype: int
+    """
+    return _write_chunks(iter_encoded(records, output_encoding), dst_file, output_encoding == 'gzip')
+
+
+def get_object_filename(basename, output_encoding=DEFAULT_OUTPUT_ENCODING):
+    """
+    :param basename: Output filename, without extension
+    :type basename: str
+    :param output_encoding: One of OUTPUT_ENCODINGS
+    :type output_encoding: str
+    :return: Filename for an output written by `write_object`.
+    :rtype: str
+    """
+    if output_encoding == 'gzip':
+        return basename + '.json.gz'
+
+    return basename + '.json'
+
+
+def write_object(obj, dst_file, output_encoding=DEFAULT_OUTPUT_ENCODING):
+    """
+    Write a single JSON object (rather than a list of records) as compact
+    JSON, gzip-compressed if the output encoding is 'gzip'.
+
+    :param obj: Object to write
+    :type obj: dict[str, object]
+    :param dst_file: Path to write to.
+    :type dst_file: str
+    :param output_encoding: One of OUTPUT_ENCODINGS
+    :type output_encoding: str
+    :return: Number of bytes written
+    :rtype: int
+    """
+    return _write_chunks([json.dumps(obj, separators=(',', ':'))], dst_file, output_encoding == 'gzip')